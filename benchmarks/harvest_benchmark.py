@@ -0,0 +1,188 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.oai_server import OAIStandInServer
+
+# The harvest stages that are benchmarked. Every stage runs in its own process with its own scratch database, so that
+# the peak RSS of a stage is not influenced by the other stages.
+# fetch:                        Download and parse the XML pages (ZoraAPI.iterate_record_pages)
+# parse:                        fetch + parse the records into metadata dictionaries (ZoraAPI.iterate_metadata_dict_chunks)
+# classify:                     parse + classify the papers (ServerLogic.classify_metadata_dicts)
+# zora_pull:                    A complete pull into an empty database (ServerLogic.zora_pull)
+# zora_pull_repeat:             A second complete pull, in which all papers already exist
+# archive_reparse:              Parse, classify and store all records of the record archive again after a pull
+# import_legacy_annotations:    Import the legacy annotations into a database without papers
+STAGES = ['fetch', 'parse', 'classify', 'zora_pull', 'zora_pull_repeat', 'archive_reparse',
+          'import_legacy_annotations']
+
+
+# Runs all (or the selected) stages in separate processes and returns their results
+def run_benchmarks(args):
+    results = []
+    for stage in args.stages:
+        command = [sys.executable, '-m', 'benchmarks.harvest_benchmark', '--run-stage', stage,
+                   '--records', str(args.records), '--page-size', str(args.page_size),
+                   '--latency', str(args.latency), '--deleted-every', str(args.deleted_every),
+                   '--untyped-every', str(args.untyped_every),
+                   '--chunk-size', str(args.chunk_size), '--parse-workers', str(args.parse_workers),
+                   '--partitions', str(args.partitions), '--partition-mode', args.partition_mode]
+        print('Running stage ' + stage + '...', file=sys.stderr)
+        output = subprocess.run(command, stdout=subprocess.PIPE, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+
+        # The result is printed as the last line of the output (the server prints its own messages before)
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+    return results
+
+
+# Runs one stage in this process. The greenzora app is started against a scratch database and the local stand-in server.
+def run_stage(args):
+    server = OAIStandInServer(args.records, args.page_size, args.latency, args.deleted_every,
+                              untyped_every=args.untyped_every)
+    server.start()
+    scratch_dir = tempfile.mkdtemp(prefix='greenzora_benchmark_')
+    os.environ['GREENZORA_DATABASE_URI'] = 'sqlite:///' + os.path.join(scratch_dir, 'database.db')
+    os.environ['GREENZORA_ZORA_URL'] = server.get_url()
+    os.environ['GREENZORA_SCHEDULE_JOBS'] = '0'
+    os.environ['GREENZORA_ZORA_ARCHIVE_PATH'] = os.path.join(scratch_dir, 'archive')
+    os.environ['GREENZORA_ML_MODEL_PATH'] = os.path.join(scratch_dir, 'models')
+    os.environ['GREENZORA_ML_FEATURE_CACHE_PATH'] = os.path.join(scratch_dir, 'feature_cache')
+
+    # NOTE: Importing greenzora initializes the database and the server logic, therefore we import it only now
+    from sqlalchemy import event
+    from greenzora import db, server_logic
+    from greenzora.models import Paper, ServerSetting, OperationParameter
+
+    ServerSetting.set('zora_pull_chunk_size', args.chunk_size)
+    ServerSetting.set('zora_parse_workers', args.parse_workers)
+    ServerSetting.set('zora_pull_partitions', args.partitions)
+    ServerSetting.set('zora_pull_partition_mode', args.partition_mode)
+    db.session.commit()
+
+    # Count the SQL statements that are sent to the database (an executemany counts as one statement)
+    query_counter = {'queries': 0}
+
+    @event.listens_for(db.engine, 'before_cursor_execute')
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        query_counter['queries'] += 1
+
+    # Prepare the stage (e.g. the repeated pull needs a first pull), then reset the counters
+    if args.run_stage in ['zora_pull_repeat', 'archive_reparse']:
+        server_logic.zora_pull()
+        OperationParameter.set('last_zora_pull', None)
+        db.session.commit()
+    elif args.run_stage == 'import_legacy_annotations':
+        Paper.bulk_delete([uid for uid, in db.session.query(Paper.uid)])
+        OperationParameter.set('legacy_annotations_imported', False)
+        db.session.commit()
+    startup_rss = get_peak_rss_mb()
+    query_counter['queries'] = 0
+    request_count = server.request_count
+
+    start = time.perf_counter()
+    records = run_stage_function(args.run_stage, server_logic, args.records)
+    duration = time.perf_counter() - start
+
+    server.stop()
+    peak_rss = get_peak_rss_mb()
+    db.session.remove()
+    db.engine.dispose()
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    return {'stage': args.run_stage,
+            'records': records,
+            'seconds': round(duration, 3),
+            'records_per_second': round(records / duration, 1) if duration > 0 else None,
+            'queries': query_counter['queries'],
+            'requests': server.request_count - request_count,
+            'startup_peak_rss_mb': startup_rss,
+            'peak_rss_mb': peak_rss,
+            'settings': {'records': args.records, 'page_size': args.page_size, 'latency': args.latency,
+                         'deleted_every': args.deleted_every, 'untyped_every': args.untyped_every,
+                         'chunk_size': args.chunk_size,
+                         'parse_workers': args.parse_workers, 'partitions': args.partitions,
+                         'partition_mode': args.partition_mode}}
+
+
+# Runs the function of a stage and returns the amount of records that were processed
+def run_stage_function(stage, server_logic, record_count):
+    from greenzora import server_app
+    from greenzora.models import ServerSetting
+
+    zora_api = server_logic.zoraAPI
+    zora_api.load_name_lookup()
+    chunk_size = ServerSetting.get('zora_pull_chunk_size')
+    parse_workers = ServerSetting.get('zora_parse_workers')
+    records = 0
+    if stage == 'fetch':
+        for record_list, resumption_token in zora_api.iterate_record_pages(None):
+            payload_list = [zora_api.get_record_payload(record) for record in record_list]
+            records += len(payload_list)
+    elif stage in ['parse', 'classify']:
+        for metadata_dict_list, resumption_token in zora_api.iterate_metadata_dict_chunks(None, chunk_size, None,
+                                                                                          parse_workers):
+            if stage == 'classify':
+                server_logic.classify_metadata_dicts([metadata_dict for metadata_dict in metadata_dict_list
+                                                      if not metadata_dict.get('deleted')])
+            records += len(metadata_dict_list)
+    elif stage in ['zora_pull', 'zora_pull_repeat']:
+        server_logic.zora_pull()
+        records = record_count
+    elif stage == 'archive_reparse':
+        records = server_logic.reparse_archive(reclassify_all=True)
+    elif stage == 'import_legacy_annotations':
+        file_path = server_app.config['LEGACY_ANNOTATIONS_PATH']
+        with open(file_path, 'rt') as file:
+            records = len(json.load(file))
+        server_logic.import_legacy_annotations(file_path)
+    return records
+
+
+# Returns the peak resident set size of this process (or of its largest terminated child process) in MB
+def get_peak_rss_mb(who=resource.RUSAGE_SELF):
+    peak_rss = resource.getrusage(who).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(peak_rss / divisor, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of the ZORA harvest against a local stand-in')
+    parser.add_argument('--records', type=int, default=10000, help='amount of records (e.g. 10000, 100000, 1000000)')
+    parser.add_argument('--page-size', type=int, default=100, help='records per OAI-PMH page')
+    parser.add_argument('--latency', type=float, default=0.0, help='latency per request in seconds')
+    parser.add_argument('--deleted-every', type=int, default=20, help='every n-th record is deleted (0: none)')
+    parser.add_argument('--untyped-every', type=int, default=0,
+                        help='every n-th record has no resource type (0: none)')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='zora_pull_chunk_size setting')
+    parser.add_argument('--parse-workers', type=int, default=0, help='zora_parse_workers setting')
+    parser.add_argument('--partitions', type=int, default=0, help='zora_pull_partitions setting')
+    parser.add_argument('--partition-mode', default='dates', help='zora_pull_partition_mode setting')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES, help='stages to run')
+    parser.add_argument('--output', help='file to write the results to (JSON)')
+    parser.add_argument('--run-stage', choices=STAGES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        print(json.dumps(run_stage(args)))
+        return
+
+    results = run_benchmarks(args)
+    if args.output:
+        with open(args.output, 'wt') as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import date, timedelta
+
+from benchmarks.harvest_benchmark import get_peak_rss_mb
+from benchmarks.oai_server import OAIStandInServer
+
+# The stages of the machine learning tool that are benchmarked. The synthetic corpus is generated once into a scratch
+# database, then every stage runs in its own process on its own copy of that database, so that the peak RSS of a stage
+# is not influenced by the other stages.
+# training_data:        Read the data and the labels of the annotated papers (ServerLogic.get_training_data)
+# train:                Train a new classifier with the annotated papers (MLTool.train_classifier)
+# classify:             Classify the texts of all papers that are not annotated (MLTool.classify)
+# reclassify:           Classify all papers again and store the labels (ServerLogic.reclassify_papers)
+# reclassify_warm:      reclassify, after all papers were classified once (e.g. the feature cache is filled)
+# create_new_model:     Train a new model in the background and classify all papers again (ServerLogic.create_new_model)
+STAGES = ['training_data', 'train', 'classify', 'reclassify', 'reclassify_warm', 'create_new_model']
+
+# The settings of the machine learning tool that can be compared, with the environment variables they are passed with
+# (see config.py)
+ML_SETTINGS = [('feature_mode', 'GREENZORA_ML_FEATURE_MODE'),
+               ('hashing_features', 'GREENZORA_ML_HASHING_FEATURES'),
+               ('tfidf', 'GREENZORA_ML_TFIDF'),
+               ('online_updates', 'GREENZORA_ML_ONLINE_UPDATES'),
+               ('reclassify_chunk_size', 'GREENZORA_ML_RECLASSIFY_CHUNK_SIZE'),
+               ('classify_workers', 'GREENZORA_ML_CLASSIFY_WORKERS'),
+               ('classify_batch_size', 'GREENZORA_ML_CLASSIFY_BATCH_SIZE')]
+
+# The papers of the synthetic corpus are inserted in chunks of this size
+CORPUS_CHUNK_SIZE = 10000
+
+
+# The SyntheticCorpus generates the titles and descriptions of papers from a vocabulary with a Zipf-like word frequency.
+# A part of the papers is about sustainability and uses more words of a small set of topic words, so that the classifier
+# learns something. The corpus is generated from a seed, so the same arguments always give the same corpus.
+class SyntheticCorpus:
+    SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'te', 'vo', 'zi', 'bar', 'con', 'dis', 'en', 'for', 'gra', 'hy',
+                 'in', 'ject', 'lat', 'mor', 'nal', 'op', 'pre', 'quo', 'rel', 'struc', 'tion', 'ul', 'ver', 'xan']
+    TOPIC_WORDS = ['climate', 'energy', 'renewable', 'sustainable', 'emission', 'biodiversity', 'water', 'carbon',
+                   'soil', 'forest', 'ocean', 'agriculture', 'poverty', 'recycling', 'ecosystem', 'pollution']
+    EARLIEST_DATE = date(1990, 1, 1)
+
+    def __init__(self, vocabulary_size, words_per_description, sustainable_share, seed):
+        self.random = random.Random(seed)
+        self.words_per_description = words_per_description
+        self.sustainable_share = sustainable_share
+
+        # The vocabulary consists of made-up words with two or three syllables. The i-th word has the weight 1 / (i + 1).
+        vocabulary = set()
+        while len(vocabulary) < vocabulary_size:
+            vocabulary.add(''.join(self.random.choice(SyntheticCorpus.SYLLABLES)
+                                   for i in range(self.random.randint(2, 3))))
+        self.vocabulary = sorted(vocabulary)
+        self.random.shuffle(self.vocabulary)
+        self.cumulative_weights = []
+        total = 0.0
+        for rank in range(len(self.vocabulary)):
+            total += 1.0 / (rank + 1)
+            self.cumulative_weights.append(total)
+
+    # Returns a text of the given amount of words. The texts of sustainable papers contain about 10% topic words.
+    def get_text(self, word_count, sustainable):
+        word_list = self.random.choices(self.vocabulary, cum_weights=self.cumulative_weights, k=word_count)
+        if sustainable:
+            for position in self.random.sample(range(word_count), max(word_count // 10, 1)):
+                word_list[position] = self.random.choice(SyntheticCorpus.TOPIC_WORDS)
+        return ' '.join(word_list)
+
+    # Returns the metadata dictionary (see ZoraAPI) of the paper with the given index. Annotated papers get their label.
+    def get_metadata_dict(self, index, annotated):
+        sustainable = self.random.random() < self.sustainable_share
+        publish_date = SyntheticCorpus.EARLIEST_DATE + timedelta(days=self.random.randrange(10000))
+        metadata_dict = {'uid': 'oai:synthetic.local:' + str(index),
+                         'title': self.get_text(8, sustainable),
+                         'description': self.get_text(self.words_per_description, sustainable),
+                         'date': publish_date.isoformat()}
+        if annotated:
+            metadata_dict['annotated'] = True
+            metadata_dict['sustainable'] = sustainable
+        return metadata_dict
+
+
+# Generates the corpus in the scratch database, then runs all (or the selected) stages in separate processes and returns
+# their results. The local stand-in server is shared by all processes, since its URL is stored in the corpus database.
+# It only serves the institutes and the resource types, the papers come from the corpus.
+def run_benchmarks(args):
+    server = OAIStandInServer(0)
+    server.start()
+    args.zora_url = server.get_url()
+    corpus_dir = tempfile.mkdtemp(prefix='greenzora_ml_benchmark_')
+    try:
+        print('Generating corpus...', file=sys.stderr)
+        corpus = run_subprocess(args, ['--generate-corpus', corpus_dir])
+        print(json.dumps(corpus), file=sys.stderr)
+
+        results = []
+        commit = get_commit()
+        for stage in args.stages:
+            print('Running stage ' + stage + '...', file=sys.stderr)
+            result = run_subprocess(args, ['--run-stage', stage, '--corpus-dir', corpus_dir])
+            result['commit'] = commit
+            result['corpus'] = corpus
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+        return results
+    finally:
+        server.stop()
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+
+
+# Runs this module in a separate process with the settings of the benchmark and the given arguments and returns the JSON
+# result it prints
+def run_subprocess(args, extra_argument_list):
+    command = [sys.executable, '-m', 'benchmarks.ml_benchmark', '--docs', str(args.docs),
+               '--annotated', str(args.annotated), '--words', str(args.words), '--vocabulary', str(args.vocabulary),
+               '--sustainable-share', str(args.sustainable_share), '--seed', str(args.seed),
+               '--zora-url', args.zora_url]
+    for name, variable in ML_SETTINGS:
+        value = getattr(args, name)
+        if value is not None:
+            command += ['--' + name.replace('_', '-'), str(value)]
+    output = subprocess.run(command + extra_argument_list, stdout=subprocess.PIPE, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+
+    # The result is printed as the last line of the output (greenzora prints its own messages before)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+# Returns the git commit of the working directory (with a '-dirty' suffix if there are changes), or None
+def get_commit():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Points greenzora to the scratch directory and the local stand-in server and passes the settings of the machine learning
+# tool
+def configure_environment(args, scratch_dir):
+    os.environ['GREENZORA_DATABASE_URI'] = 'sqlite:///' + os.path.join(scratch_dir, 'database.db')
+    os.environ['GREENZORA_ZORA_URL'] = args.zora_url
+    os.environ['GREENZORA_SCHEDULE_JOBS'] = '0'
+    os.environ['GREENZORA_ZORA_ARCHIVE_PATH'] = ''
+    os.environ['GREENZORA_ML_MODEL_PATH'] = os.path.join(scratch_dir, 'models')
+    os.environ['GREENZORA_ML_FEATURE_CACHE_PATH'] = os.path.join(scratch_dir, 'feature_cache')
+    for name, variable in ML_SETTINGS:
+        value = getattr(args, name)
+        if value is not None:
+            os.environ[variable] = str(value)
+
+
+# Generates the synthetic corpus into the database of the corpus directory and returns its statistics
+def generate_corpus(args):
+    configure_environment(args, args.generate_corpus)
+
+    # NOTE: Importing greenzora initializes the database and the server logic, therefore we import it only now
+    from greenzora import db
+    from greenzora.models import Paper
+
+    start = time.perf_counter()
+    corpus = SyntheticCorpus(args.vocabulary, args.words, args.sustainable_share, args.seed)
+    for chunk_start in range(0, args.docs, CORPUS_CHUNK_SIZE):
+        chunk_end = min(chunk_start + CORPUS_CHUNK_SIZE, args.docs)
+        Paper.bulk_create_or_update([corpus.get_metadata_dict(index, index < args.annotated)
+                                     for index in range(chunk_start, chunk_end)])
+        db.session.commit()
+    duration = time.perf_counter() - start
+
+    paper_count = db.session.query(Paper).count()
+    annotated_count = db.session.query(Paper).filter(Paper.annotated == True).count()
+    db.session.remove()
+    db.engine.dispose()
+
+    # The models and the feature cache of the startup are not part of the corpus
+    shutil.rmtree(os.path.join(args.generate_corpus, 'models'), ignore_errors=True)
+    shutil.rmtree(os.path.join(args.generate_corpus, 'feature_cache'), ignore_errors=True)
+    return {'papers': paper_count, 'annotated': annotated_count, 'seconds': round(duration, 3)}
+
+
+# Runs one stage in this process on a copy of the corpus database
+def run_stage(args):
+    scratch_dir = tempfile.mkdtemp(prefix='greenzora_ml_benchmark_')
+    shutil.copy(os.path.join(args.corpus_dir, 'database.db'), os.path.join(scratch_dir, 'database.db'))
+    configure_environment(args, scratch_dir)
+
+    # NOTE: Importing greenzora initializes the database and the server logic (which trains the startup model), therefore
+    # we import it only now
+    from greenzora import db, server_app, server_logic
+
+    startup_rss = get_peak_rss_mb()
+    duration, docs = run_stage_function(args.run_stage, server_logic)
+    peak_rss = get_peak_rss_mb()
+    children_peak_rss = get_peak_rss_mb(resource.RUSAGE_CHILDREN)
+
+    db.session.remove()
+    db.engine.dispose()
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    return {'stage': args.run_stage,
+            'docs': docs,
+            'seconds': round(duration, 3),
+            'docs_per_second': round(docs / duration, 1) if duration > 0 else None,
+            'startup_peak_rss_mb': startup_rss,
+            'peak_rss_mb': peak_rss,
+            'children_peak_rss_mb': children_peak_rss,
+            'settings': {'docs': args.docs, 'annotated': args.annotated, 'words': args.words,
+                         'vocabulary': args.vocabulary, 'sustainable_share': args.sustainable_share, 'seed': args.seed,
+                         'feature_mode': server_app.config['ML_FEATURE_MODE'],
+                         'hashing_features': server_app.config['ML_HASHING_FEATURES'],
+                         'tfidf': server_app.config['ML_TFIDF'],
+                         'online_updates': server_app.config['ML_ONLINE_UPDATES'],
+                         'reclassify_chunk_size': server_app.config['ML_RECLASSIFY_CHUNK_SIZE'],
+                         'classify_workers': server_app.config['ML_CLASSIFY_WORKERS'],
+                         'classify_batch_size': server_app.config['ML_CLASSIFY_BATCH_SIZE']}}
+
+
+# Runs the function of a stage and returns its duration and the amount of papers it processed. The preparation of a
+# stage (e.g. reading the texts that are classified) is not part of the duration.
+def run_stage_function(stage, server_logic):
+    import scipy.sparse as sp
+    from greenzora import db, server_app
+    from greenzora.models import Paper
+    from greenzora.server_logic import ServerLogic
+
+    unannotated_count = db.session.query(Paper).filter(Paper.annotated == False).count()
+    if stage == 'training_data':
+        start = time.perf_counter()
+        training_data, labels = server_logic.get_training_data()
+        return time.perf_counter() - start, len(labels)
+    elif stage == 'train':
+        training_data, labels = server_logic.get_training_data()
+        ml_tool = ServerLogic.create_ml_tool()
+        start = time.perf_counter()
+        if sp.issparse(training_data):
+            ml_tool.train_classifier_with_term_counts(training_data, labels)
+        else:
+            ml_tool.train_classifier(training_data, labels)
+        return time.perf_counter() - start, len(labels)
+    elif stage == 'classify':
+        duration = 0.0
+        for data in iterate_unannotated_texts(server_app.config['ML_RECLASSIFY_CHUNK_SIZE']):
+            start = time.perf_counter()
+            server_logic.ml_tool.classify(data)
+            duration += time.perf_counter() - start
+        return duration, unannotated_count
+    elif stage in ['reclassify', 'reclassify_warm']:
+        if stage == 'reclassify_warm':
+            server_logic.reclassify_papers()
+        start = time.perf_counter()
+        server_logic.reclassify_papers()
+        return time.perf_counter() - start, unannotated_count
+    elif stage == 'create_new_model':
+        start = time.perf_counter()
+        server_logic.create_new_model()
+        while server_logic.get_model_status()['state'] not in [ServerLogic.MODEL_STATE_FINISHED,
+                                                               ServerLogic.MODEL_STATE_FAILED]:
+            time.sleep(0.1)
+        duration = time.perf_counter() - start
+        model_status = server_logic.get_model_status()
+        if model_status['state'] == ServerLogic.MODEL_STATE_FAILED:
+            raise RuntimeError('Model job failed (' + str(model_status['error']) + ')')
+        return duration, unannotated_count
+
+
+# Yields the texts (see ServerLogic.get_classification_data) of the papers that are not annotated in chunks
+def iterate_unannotated_texts(chunk_size):
+    import pandas as pd
+    from greenzora import db
+    from greenzora.models import Paper
+    from greenzora.server_logic import ServerLogic
+
+    last_uid = None
+    while True:
+        query = db.session.query(Paper.uid, Paper.title, Paper.description).filter(Paper.annotated == False)
+        if last_uid is not None:
+            query = query.filter(Paper.uid > last_uid)
+        row_list = query.order_by(Paper.uid).limit(chunk_size).all()
+        if not row_list:
+            break
+        yield pd.Series([ServerLogic.get_classification_data(title, description) for uid, title, description in row_list])
+        last_uid = row_list[-1][0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the training and the classification of the machine '
+                                                 'learning tool on a synthetic corpus')
+    parser.add_argument('--docs', type=int, default=10000, help='amount of papers (e.g. 10000, 100000, 1000000)')
+    parser.add_argument('--annotated', type=int, default=1000, help='amount of annotated papers')
+    parser.add_argument('--words', type=int, default=150, help='words per description')
+    parser.add_argument('--vocabulary', type=int, default=20000, help='words in the vocabulary')
+    parser.add_argument('--sustainable-share', type=float, default=0.2, help='share of sustainable papers')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the corpus')
+    parser.add_argument('--feature-mode', choices=['count', 'hashing'], help='ML_FEATURE_MODE setting')
+    parser.add_argument('--hashing-features', type=int, help='ML_HASHING_FEATURES setting')
+    parser.add_argument('--tfidf', type=int, choices=[0, 1], help='ML_TFIDF setting')
+    parser.add_argument('--online-updates', type=int, choices=[0, 1], help='ML_ONLINE_UPDATES setting')
+    parser.add_argument('--reclassify-chunk-size', type=int, help='ML_RECLASSIFY_CHUNK_SIZE setting')
+    parser.add_argument('--classify-workers', type=int, help='ML_CLASSIFY_WORKERS setting')
+    parser.add_argument('--classify-batch-size', type=int, help='ML_CLASSIFY_BATCH_SIZE setting')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES, help='stages to run')
+    parser.add_argument('--output', help='file to write the results to (JSON)')
+    parser.add_argument('--generate-corpus', help=argparse.SUPPRESS)
+    parser.add_argument('--run-stage', choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument('--corpus-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--zora-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # The online mode needs the hashing feature mode
+    if args.online_updates == 1 and args.feature_mode is None:
+        args.feature_mode = 'hashing'
+
+    if args.generate_corpus:
+        print(json.dumps(generate_corpus(args)))
+        return
+    if args.run_stage:
+        print(json.dumps(run_stage(args)))
+        return
+
+    results = run_benchmarks(args)
+    if args.output:
+        with open(args.output, 'wt') as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+import argparse
+import random
+import time
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+
+# The OAIStandInServer is a local stand-in for the OAI-PMH interface of ZORA. It serves a configurable amount of
+# synthetic oai_dc records with resumption tokens, deleted records, records without a resource type and an optional
+# latency per request, so that ZoraAPI and zora_pull can be benchmarked reproducibly without the live ZORA endpoint.
+#
+# The records are generated from their index, so the server does not keep them in memory. Record i has the datestamp
+# EARLIEST_DATESTAMP + i * interval, which lets us answer from/until requests with index arithmetic.
+#
+# Usage: python -m benchmarks.oai_server --records 100000 --port 8000 [--latency 0.05] [--deleted-every 20]
+#        [--untyped-every 50]
+class OAIStandInServer:
+    EARLIEST_DATESTAMP = datetime(2000, 1, 1)
+    LATEST_DATESTAMP = datetime(2019, 1, 1)
+    DATESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+    IDENTIFIER_PREFIX = 'oai:benchmark.local:'
+
+    RESOURCE_TYPES = ['Journal Article', 'Conference or Workshop Item', 'Dissertation', 'Book Section', 'Working Paper']
+    FACULTIES = ['Faculty of Science', 'Faculty of Medicine', 'Faculty of Arts', 'Faculty of Economics']
+    INSTITUTES_PER_FACULTY = 8
+    DDCS = ['570 Life sciences; biology', '330 Economics', '000 Computer science, knowledge & systems',
+            '610 Medicine & health', '300 Social sciences, sociology & anthropology', '550 Earth sciences']
+    LANGUAGES = ['eng', 'ger', 'fre']
+
+    # The words of the titles and abstracts. Some of them are typical for sustainable papers, so that the classifier
+    # has something to do.
+    WORDS = ['climate', 'energy', 'renewable', 'sustainable', 'emission', 'biodiversity', 'water', 'carbon', 'soil',
+             'health', 'protein', 'cell', 'market', 'finance', 'policy', 'social', 'history', 'language', 'model',
+             'analysis', 'study', 'patients', 'treatment', 'network', 'algorithm', 'data', 'theory', 'effect', 'risk',
+             'growth', 'urban', 'forest', 'ocean', 'agriculture', 'poverty', 'education', 'migration', 'law', 'ethics']
+    LAST_NAMES = ['Muster', 'Meier', 'Keller', 'Weber', 'Huber', 'Schneider', 'Steiner', 'Fischer', 'Brunner', 'Baumann',
+                  'Frei', 'Zimmermann', 'Moser', 'Widmer', 'Wyss', 'Graf', 'Roth', 'Suter', 'Bachmann', 'Kaufmann']
+    FIRST_NAMES = ['Hans', 'Anna', 'Peter', 'Maria', 'Daniel', 'Sarah', 'Thomas', 'Laura', 'Martin', 'Julia']
+
+    def __init__(self, record_count, page_size=100, latency=0.0, deleted_every=20, host='127.0.0.1', port=0,
+                 untyped_every=0):
+        self.record_count = record_count
+        self.page_size = page_size
+        self.latency = latency
+        self.deleted_every = deleted_every
+        self.untyped_every = untyped_every
+        self.interval = (OAIStandInServer.LATEST_DATESTAMP - OAIStandInServer.EARLIEST_DATESTAMP) / max(record_count, 1)
+        self.request_count = 0
+        self.http_server = ThreadingHTTPServer((host, port), self.create_request_handler())
+        self.http_server.daemon_threads = True
+        self.thread = None
+
+    # Returns the URL of the OAI-PMH interface
+    def get_url(self):
+        host, port = self.http_server.server_address
+        return 'http://' + host + ':' + str(port) + '/oai'
+
+    # Starts the server in a background thread
+    def start(self):
+        self.thread = Thread(target=self.http_server.serve_forever, daemon=True)
+        self.thread.start()
+
+    # Stops the server
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+    # Creates the request handler class, which passes all requests to this server
+    def create_request_handler(self):
+        server = self
+
+        class OAIRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.handle_arguments(parse_qs(urlparse(self.path).query))
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self.handle_arguments(parse_qs(self.rfile.read(length).decode('utf-8')))
+
+            def handle_arguments(self, query):
+                args = {name: value_list[0] for name, value_list in query.items()}
+                body = server.handle_request(args).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # We don't want a log line for every request
+            def log_message(self, format, *args):
+                pass
+
+        return OAIRequestHandler
+
+    # Handles an OAI-PMH request and returns the XML response
+    def handle_request(self, args):
+        self.request_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+        verb = args.get('verb')
+        if verb == 'Identify':
+            content = self.identify()
+        elif verb == 'ListSets':
+            content = self.list_sets()
+        elif verb == 'ListRecords':
+            content = self.list_records(args)
+        elif verb == 'ListIdentifiers':
+            content = self.list_records(args, 'ListIdentifiers')
+        elif verb == 'GetRecord':
+            content = self.get_record(args)
+        else:
+            content = self.error('badVerb', 'Illegal verb')
+        return ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/" '
+                'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+                '<responseDate>' + datetime.utcnow().strftime(OAIStandInServer.DATESTAMP_FORMAT) + '</responseDate>'
+                '<request>' + escape(self.get_url()) + '</request>' + content + '</OAI-PMH>')
+
+    @staticmethod
+    def error(code, message):
+        return '<error code="' + code + '">' + escape(message) + '</error>'
+
+    def identify(self):
+        return ('<Identify>'
+                '<repositoryName>GreenZora benchmark stand-in</repositoryName>'
+                '<baseURL>' + escape(self.get_url()) + '</baseURL>'
+                '<protocolVersion>2.0</protocolVersion>'
+                '<adminEmail>admin@benchmark.local</adminEmail>'
+                '<earliestDatestamp>' + OAIStandInServer.EARLIEST_DATESTAMP.strftime(OAIStandInServer.DATESTAMP_FORMAT) +
+                '</earliestDatestamp>'
+                '<deletedRecord>persistent</deletedRecord>'
+                '<granularity>YYYY-MM-DDThh:mm:ssZ</granularity>'
+                '</Identify>')
+
+    # Returns the sets in the same form as ZORA ('Type = ...' and 'Subjects = ...')
+    def list_sets(self):
+        content = '<ListSets>'
+        for index, resource_type in enumerate(OAIStandInServer.RESOURCE_TYPES):
+            content += self.set_xml(self.get_type_set_spec(index), 'Type = ' + resource_type)
+        for faculty_index, faculty in enumerate(OAIStandInServer.FACULTIES):
+            content += self.set_xml('subjects=' + str(faculty_index), 'Subjects = ' + faculty)
+            for institute_index in range(OAIStandInServer.INSTITUTES_PER_FACULTY):
+                content += self.set_xml('subjects=' + str(faculty_index) + '-' + str(institute_index),
+                                        'Subjects = ' + faculty + ': ' + self.get_institute_name(faculty_index, institute_index))
+        return content + '</ListSets>'
+
+    @staticmethod
+    def set_xml(set_spec, set_name):
+        return '<set><setSpec>' + escape(set_spec) + '</setSpec><setName>' + escape(set_name) + '</setName></set>'
+
+    @staticmethod
+    def get_type_set_spec(type_index):
+        return 'type=' + str(type_index)
+
+    @staticmethod
+    def get_institute_name(faculty_index, institute_index):
+        return 'Institute ' + str(faculty_index) + '.' + str(institute_index)
+
+    # Returns a page of records (or only of their headers, if the verb is ListIdentifiers). The resumption token encodes
+    # the position of the next page and the selection, so the server does not need to store anything between requests.
+    def list_records(self, args, verb='ListRecords'):
+        if 'resumptionToken' in args:
+            try:
+                cursor, first_index, last_index, step = [int(value) for value in args['resumptionToken'].split(',')]
+            except ValueError:
+                return self.error('badResumptionToken', 'The resumption token is invalid')
+        else:
+            if args.get('metadataPrefix') != 'oai_dc':
+                return self.error('cannotDisseminateFormat', 'Only oai_dc is supported')
+            first_index, last_index, step = self.get_selection(args)
+            cursor = 0
+
+        # The selected records are first_index, first_index + step, ... up to last_index
+        selection_size = (last_index - first_index) // step + 1 if last_index >= first_index else 0
+        if selection_size <= 0:
+            return self.error('noRecordsMatch', 'No records match the request')
+        page_end = min(cursor + self.page_size, selection_size)
+        content = '<' + verb + '>'
+        for position in range(cursor, page_end):
+            index = first_index + position * step
+
+            # A selection of a set (step > 1) leaves out the records without a resource type
+            if step > 1 and self.is_untyped(index):
+                continue
+            content += self.record_xml(index) if verb == 'ListRecords' else self.header_xml(index)
+        if page_end < selection_size:
+            token = ','.join(str(value) for value in [page_end, first_index, last_index, step])
+            content += ('<resumptionToken completeListSize="' + str(selection_size) + '" cursor="' + str(cursor) + '">' +
+                        token + '</resumptionToken>')
+        elif cursor > 0:
+            content += '<resumptionToken completeListSize="' + str(selection_size) + '" cursor="' + str(cursor) + '"/>'
+        return content + '</' + verb + '>'
+
+    # Translates the from, until and set arguments into a selection of record indices (first_index, last_index, step)
+    def get_selection(self, args):
+        first_index = 0
+        last_index = self.record_count - 1
+        if 'from' in args:
+            from_ = datetime.strptime(args['from'], OAIStandInServer.DATESTAMP_FORMAT)
+            first_index = max(first_index, -int(-(from_ - OAIStandInServer.EARLIEST_DATESTAMP) // self.interval))
+        if 'until' in args:
+            until = datetime.strptime(args['until'], OAIStandInServer.DATESTAMP_FORMAT)
+            last_index = min(last_index, int((until - OAIStandInServer.EARLIEST_DATESTAMP) // self.interval))
+        step = 1
+        if 'set' in args and args['set'].startswith('type='):
+
+            # Record i has the resource type i % len(RESOURCE_TYPES)
+            type_count = len(OAIStandInServer.RESOURCE_TYPES)
+            type_index = int(args['set'][len('type='):])
+            first_index += (type_index - first_index) % type_count
+            step = type_count
+        return first_index, last_index, step
+
+    def get_record(self, args):
+        identifier = args.get('identifier', '')
+        try:
+            index = int(identifier[len(OAIStandInServer.IDENTIFIER_PREFIX):])
+        except ValueError:
+            index = -1
+        if not identifier.startswith(OAIStandInServer.IDENTIFIER_PREFIX) or not 0 <= index < self.record_count:
+            return self.error('idDoesNotExist', 'Unknown identifier')
+        return '<GetRecord>' + self.record_xml(index) + '</GetRecord>'
+
+    def get_datestamp(self, index):
+        return OAIStandInServer.EARLIEST_DATESTAMP + index * self.interval
+
+    # Returns True if the record with the given index has no resource type (every untyped_every-th record). Such a
+    # record is not in any Type set.
+    def is_untyped(self, index):
+        return self.untyped_every and index % self.untyped_every == self.untyped_every - 1
+
+    # Generates the header of the record with the given index. Every deleted_every-th record is deleted.
+    def header_xml(self, index):
+        type_index = index % len(OAIStandInServer.RESOURCE_TYPES)
+        datestamp = self.get_datestamp(index).replace(microsecond=0).strftime(OAIStandInServer.DATESTAMP_FORMAT)
+        header_content = ('<identifier>' + OAIStandInServer.IDENTIFIER_PREFIX + str(index) + '</identifier>'
+                          '<datestamp>' + datestamp + '</datestamp>')
+        if not self.is_untyped(index):
+            header_content += '<setSpec>' + self.get_type_set_spec(type_index) + '</setSpec>'
+        if self.deleted_every and index % self.deleted_every == self.deleted_every - 1:
+            return '<header status="deleted">' + header_content + '</header>'
+        return '<header>' + header_content + '</header>'
+
+    # Generates the record with the given index
+    def record_xml(self, index):
+        type_index = index % len(OAIStandInServer.RESOURCE_TYPES)
+        header = self.header_xml(index)
+        if self.deleted_every and index % self.deleted_every == self.deleted_every - 1:
+            return '<record>' + header + '</record>'
+
+        rng = random.Random(index)
+        title = ' '.join(rng.choice(OAIStandInServer.WORDS) for _ in range(rng.randint(4, 12))).capitalize()
+        description = ' '.join(rng.choice(OAIStandInServer.WORDS) for _ in range(rng.randint(60, 200))).capitalize() + '.'
+        faculty_index = rng.randrange(len(OAIStandInServer.FACULTIES))
+        elements = [('title', title)]
+        for _ in range(rng.randint(1, 4)):
+            elements.append(('creator', rng.choice(OAIStandInServer.LAST_NAMES) + ', ' + rng.choice(OAIStandInServer.FIRST_NAMES)))
+        elements.append(('subject', rng.choice(OAIStandInServer.DDCS)))
+        elements.append(('subject', self.get_institute_name(faculty_index, rng.randrange(OAIStandInServer.INSTITUTES_PER_FACULTY))))
+        elements.append(('subject', ', '.join(rng.sample(OAIStandInServer.WORDS, rng.randint(2, 5)))))
+        elements.append(('description', description))
+        elements.append(('publisher', 'Publisher ' + str(rng.randrange(50))))
+        elements.append(('date', str(rng.randint(1990, 2018)) + '-' + str(rng.randint(1, 12)).zfill(2) + '-' +
+                         str(rng.randint(1, 28)).zfill(2)))
+        if not self.is_untyped(index):
+            elements.append(('type', OAIStandInServer.RESOURCE_TYPES[type_index]))
+        elements.append(('type', 'info:eu-repo/semantics/article'))
+        elements.append(('language', rng.choice(OAIStandInServer.LANGUAGES)))
+        elements.append(('relation', 'https://benchmark.local/' + str(index) + '/'))
+        metadata_content = ''.join('<dc:' + name + '>' + escape(value) + '</dc:' + name + '>' for name, value in elements)
+        return ('<record>' + header + '<metadata>'
+                '<oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" '
+                'xmlns:dc="http://purl.org/dc/elements/1.1/">' + metadata_content + '</oai_dc:dc>'
+                '</metadata></record>')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local OAI-PMH stand-in for the ZORA repository')
+    parser.add_argument('--records', type=int, default=10000, help='amount of records (e.g. 10000, 100000, 1000000)')
+    parser.add_argument('--page-size', type=int, default=100, help='records per page')
+    parser.add_argument('--latency', type=float, default=0.0, help='latency per request in seconds')
+    parser.add_argument('--deleted-every', type=int, default=20, help='every n-th record is deleted (0: none)')
+    parser.add_argument('--untyped-every', type=int, default=0,
+                        help='every n-th record has no resource type (0: none)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    server = OAIStandInServer(args.records, args.page_size, args.latency, args.deleted_every, args.host, args.port,
+                              args.untyped_every)
+    print('Serving ' + str(args.records) + ' records at ' + server.get_url())
+    try:
+        server.http_server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,82 @@
 import os
+from sqlalchemy.pool import QueuePool
 from greenzora import server_app
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(BASE_DIR, 'database.db')
+# The database, the default ZORA URL, the periodic jobs and the settings of the machine learning tool can be overridden
+# with environment variables. The benchmarks use this to run against a scratch database and the local OAI-PMH stand-in
+# server (see benchmarks/oai_server.py) and to compare the settings of the machine learning tool.
+SQLALCHEMY_DATABASE_URI = os.environ.get('GREENZORA_DATABASE_URI', 'sqlite:///' + os.path.join(BASE_DIR, 'database.db'))
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# SQLite access mode (see greenzora/database.py). In WAL mode, the pages can read the database while a ZORA pull writes.
+SQLITE_WAL = os.environ.get('GREENZORA_SQLITE_WAL', '1') == '1'
+SQLITE_SYNCHRONOUS = 'NORMAL'                           # NORMAL never corrupts the database in WAL mode
+SQLITE_CACHE_SIZE = 64 * 1024                           # KiB per connection
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024                    # bytes
+SQLITE_BUSY_TIMEOUT = 30000                             # milliseconds to wait for a lock
+SQLITE_READ_POOL_SIZE = 5                               # connections of the read-only engine of the pages
+SQLITE_WRITE_POOL_SIZE = 5                              # connections of the engine of db.session
+
+# The connections of db.session are kept in a pool, so that they are configured only once (SQLAlchemy opens a new
+# connection for every session of a SQLite file otherwise). The pool shares them between the threads of the server.
+if SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+    SQLALCHEMY_ENGINE_OPTIONS = {'poolclass': QueuePool, 'pool_size': SQLITE_WRITE_POOL_SIZE,
+                                 'pool_timeout': SQLITE_BUSY_TIMEOUT / 1000,
+                                 'connect_args': {'check_same_thread': False, 'timeout': SQLITE_BUSY_TIMEOUT / 1000}}
+
+# Result pages of the papers (see greenzora/pagination.py)
+RESULTS_PAGE_SIZE = 50                                  # papers per page
+RESULTS_MAX_PAGE_SIZE = 500                             # papers per page a request can ask for
+
 # Settings default values
 DEFAULT_ZORA_PULL_INTERVAL = 1                          # days
 DEFAULT_RESOURCE_TYPE_UPDATE_INTERVAL = 14              # days
 DEFAULT_INSTITUTE_UPDATE_INTERVAL = 14                  # days
-DEFAULT_ZORA_URL = 'https://www.zora.uzh.ch/cgi/oai2'
+DEFAULT_ZORA_URL = os.environ.get('GREENZORA_ZORA_URL', 'https://www.zora.uzh.ch/cgi/oai2')
+DEFAULT_ZORA_PULL_CHUNK_SIZE = 1000                     # papers per committed chunk
+DEFAULT_ZORA_PARSE_WORKERS = 0                          # processes (0: parse in the pulling thread)
+DEFAULT_ZORA_PULL_PARTITIONS = 0                        # threads for full pulls (0: no partitions)
+DEFAULT_ZORA_PULL_PARTITION_MODE = 'dates'              # 'dates' or 'sets'
 DEFAULT_ANNOTATION_TIMEOUT = 60                         # minutes
 
+# Record archive, which stores the raw XML of the harvested records for reparsing. It is disabled by default, since it
+# is never compacted and grows with every pull, and reading it loads the index of all records into memory. It is
+# enabled by setting a path (e.g. GREENZORA_ZORA_ARCHIVE_PATH=archive).
+ZORA_ARCHIVE_PATH = os.environ.get('GREENZORA_ZORA_ARCHIVE_PATH') or None
+ZORA_ARCHIVE_SEGMENT_SIZE = 64 * 1024 * 1024            # bytes
+
+# Periodic jobs (ZORA pull, institute and resource type updates)
+SCHEDULE_JOBS = os.environ.get('GREENZORA_SCHEDULE_JOBS', '1') == '1'
+
+# Annotation queue, which contains the papers that are handed out for annotation next
+ANNOTATION_QUEUE_MODE = 'uncertainty'                   # 'uncertainty' (most uncertain papers first) or 'random'
+ANNOTATION_QUEUE_SIZE = 1000                            # papers
+ANNOTATION_QUEUE_LOW_WATER_MARK = 200                   # papers left in the queue before it is refilled
+ANNOTATION_QUEUE_REFILL_INTERVAL = 10                   # minutes
+ANNOTATION_LEASE_REAP_INTERVAL = 5                      # minutes
+
 # Machine Learning Tool
-LEGACY_ANNOTATIONS_PATH = os.path.join(BASE_DIR, 'greenzora\static\legacy_annotations.json')
+LEGACY_ANNOTATIONS_PATH = os.path.join(BASE_DIR, 'greenzora', 'static', 'legacy_annotations.json')
+ML_FEATURE_MODE = os.environ.get('GREENZORA_ML_FEATURE_MODE', 'count')  # 'count' (learned vocabulary) or 'hashing' (fixed width)
+ML_HASHING_FEATURES = int(os.environ.get('GREENZORA_ML_HASHING_FEATURES', 2 ** 20))  # features of the hashing vectorizer
+ML_TFIDF = os.environ.get('GREENZORA_ML_TFIDF', '0') == '1'  # weight the term counts with TF-IDF
+# Online updates of the classifier with new annotations (hashing only). The updates are only applied to the model of
+# the process that received the annotations and are not saved, so they are meant for single-process deployments and are
+# lost at a restart (the next training includes the annotations).
+ML_ONLINE_UPDATES = os.environ.get('GREENZORA_ML_ONLINE_UPDATES', '0') == '1'
+ML_UPDATE_BATCH_SIZE = 10                               # annotations per update
+ML_RECLASSIFY_CHUNK_SIZE = int(os.environ.get('GREENZORA_ML_RECLASSIFY_CHUNK_SIZE', 5000))  # papers per chunk when all papers are classified again
+ML_CLASSIFY_WORKERS = int(os.environ.get('GREENZORA_ML_CLASSIFY_WORKERS', 0))  # processes for reclassifying all papers (0: no processes)
+ML_CLASSIFY_BATCH_SIZE = int(os.environ.get('GREENZORA_ML_CLASSIFY_BATCH_SIZE', 500))  # papers per batch of a classifier process
+
+# The trained models are saved in this directory and loaded at startup if the annotations did not change (an empty path
+# disables the saving)
+ML_MODEL_PATH = os.environ.get('GREENZORA_ML_MODEL_PATH', os.path.join(BASE_DIR, 'models'))
+
+# The term counts of the papers are cached in this directory (hashing feature mode only, an empty path disables the cache)
+ML_FEATURE_CACHE_PATH = os.environ.get('GREENZORA_ML_FEATURE_CACHE_PATH', os.path.join(BASE_DIR, 'feature_cache'))
+ML_FEATURE_CACHE_MAX_SEGMENTS = 32                      # segments before the cache is compacted
 
 SECRET_KEY = os.urandom(32)
 server_app.config['SECRET_KEY'] = SECRET_KEY
@@ -1,3 +1,6 @@
+import multiprocessing
+import sys
+
 from flask import Flask
 from flask_login import LoginManager
 from flask_sqlalchemy import SQLAlchemy
@@ -15,10 +18,17 @@ db = SQLAlchemy(server_app)
 login_manager = LoginManager(server_app)
 
 # NOTE: These imports are not at the top of the file to avoid circular imports (we need server_app)
-from greenzora import models, server_logic, routes
+from greenzora import database, models, server_logic, routes, cli
+
+# Processes that are spawned by the server (see ServerLogic.train_ml_tool_in_background) import greenzora to get the
+# functions they run, but must neither initialize the database nor start another server. They are recognized by their
+# name, or by their main module, which a spawned process imports again as __mp_main__ before it gets its name.
+is_spawned_process = multiprocessing.current_process().name != 'MainProcess' or \
+    getattr(sys.modules.get('__main__'), '__name__', None) == '__mp_main__'
+if not is_spawned_process:
 
-# Initialize the database
-models.initialize_db()
+    # Initialize the database
+    models.initialize_db()
 
-# Initialize the greenzora logic, which includes the ZORA API, machine learning tool, task scheduler and jobs
-server_logic = server_logic.ServerLogic()
+    # Initialize the greenzora logic, which includes the ZORA API, machine learning tool, task scheduler and jobs
+    server_logic = server_logic.ServerLogic()
@@ -0,0 +1,181 @@
+import mmap
+import os
+import re
+import zlib
+
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: the archive can only be shared by the threads of one process
+    fcntl = None
+
+
+# The RecordArchive stores the raw XML of the records that are harvested from ZORA on the disk, so that the records can
+# be parsed and classified again without harvesting them from ZORA again.
+#
+# The records are appended to segment files, in which every record is compressed on its own. A segment is closed when
+# it reaches the segment size and a new one is started. Next to every segment there is an index file, which contains
+# one line per record: uid <TAB> datestamp <TAB> offset <TAB> length. The files are never rewritten. If a record is
+# harvested again, it is simply appended again and the reader only returns its latest version (by datestamp, and by
+# position if the datestamps are equal).
+#
+# The archive can be shared by several server processes (and the threads of a process). The appends hold the lock file
+# of the archive exclusively, and every append goes to the end of the latest segment, which another process might have
+# appended to or started meanwhile. The archive is never compacted, so it grows with every pull (see ZORA_ARCHIVE_PATH).
+class RecordArchive:
+    SEGMENT_FILE_FORMAT = 'segment-{:06d}.dat'
+    INDEX_FILE_FORMAT = 'segment-{:06d}.idx'
+    LOCK_FILE_NAME = 'archive.lock'
+    SEGMENT_FILE_REGEX = re.compile(r'^segment-(\d{6})\.dat$')
+
+    # The compression level of zlib. Level 6 (the default of zlib) compresses the XML of a record about 3-4 times.
+    COMPRESSION_LEVEL = 6
+
+    # In the constructor, we create the archive directory if it does not exist yet
+    def __init__(self, path, segment_size):
+        self.path = path
+        self.segment_size = segment_size
+        self.lock = Lock()
+        self.segment_number = None
+        self.segment_file = None
+        self.index_file = None
+        os.makedirs(path, exist_ok=True)
+
+    # Returns the numbers of all segments in ascending order
+    def get_segment_numbers(self):
+        segment_number_list = []
+        for file_name in os.listdir(self.path):
+            match = RecordArchive.SEGMENT_FILE_REGEX.match(file_name)
+            if match:
+                segment_number_list.append(int(match.group(1)))
+        return sorted(segment_number_list)
+
+    # Returns the paths of the segment file and the index file of a segment
+    def get_segment_paths(self, segment_number):
+        return (os.path.join(self.path, RecordArchive.SEGMENT_FILE_FORMAT.format(segment_number)),
+                os.path.join(self.path, RecordArchive.INDEX_FILE_FORMAT.format(segment_number)))
+
+    # Appends a list of records to the archive. A record is a tuple (uid, datestamp, xml), where the datestamp is a
+    # string in the OAI-PMH format and the xml is a bytes object. The records are flushed to the disk before this method
+    # returns. The method is thread-safe and process-safe (see the class comment), so the threads of a partitioned
+    # harvest and other server processes can share the archive.
+    def add_records(self, record_list):
+        if not record_list:
+            return
+        with self.lock:
+            with open(os.path.join(self.path, RecordArchive.LOCK_FILE_NAME), 'a') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    self.open_segment()
+                    for uid, datestamp, xml in record_list:
+                        data = zlib.compress(xml, RecordArchive.COMPRESSION_LEVEL)
+                        offset = self.segment_file.tell()
+                        self.segment_file.write(data)
+                        self.index_file.write(uid + '\t' + datestamp + '\t' + str(offset) + '\t' + str(len(data)) + '\n')
+
+                    # The data is flushed before the index, so that the index never points to data that is not on the
+                    # disk. Both are flushed before the lock is released.
+                    self.segment_file.flush()
+                    self.index_file.flush()
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Opens the latest segment and moves to its end, since another process might have appended to it. If the latest
+    # segment has reached the segment size, a new segment is started. Has to be called with the lock file held.
+    def open_segment(self):
+        segment_number_list = self.get_segment_numbers()
+        segment_number = segment_number_list[-1] if segment_number_list else 1
+        segment_path, index_path = self.get_segment_paths(segment_number)
+        if os.path.exists(segment_path) and os.path.getsize(segment_path) >= self.segment_size:
+            segment_number += 1
+            segment_path, index_path = self.get_segment_paths(segment_number)
+        if segment_number != self.segment_number:
+            self.close()
+            self.segment_number = segment_number
+            self.segment_file = open(segment_path, 'ab')
+            self.index_file = open(index_path, 'at', encoding='utf-8')
+        self.segment_file.seek(0, os.SEEK_END)
+
+    # Closes the segment the records are appended to
+    def close(self):
+        if self.segment_file:
+            self.segment_file.close()
+            self.index_file.close()
+        self.segment_number = None
+        self.segment_file = None
+        self.index_file = None
+
+    # Reads the index files and returns a dictionary {uid: (datestamp, segment number, offset, length)} that contains the
+    # latest version of every record. Incomplete lines (e.g. after a crash while writing) are ignored.
+    def load_index(self):
+        index_dict = {}
+        for segment_number in self.get_segment_numbers():
+            segment_path, index_path = self.get_segment_paths(segment_number)
+            if not os.path.exists(index_path):
+                continue
+            with open(index_path, 'rt', encoding='utf-8') as index_file:
+                for line in index_file:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 4 or not line.endswith('\n'):
+                        continue
+                    uid, datestamp, offset, length = fields
+                    existing_entry = index_dict.get(uid)
+                    if not existing_entry or existing_entry[0] <= datestamp:
+                        index_dict[uid] = (datestamp, segment_number, int(offset), int(length))
+        return index_dict
+
+    # Yields the latest version of every record in the archive as a tuple (uid, datestamp, xml). The records are read
+    # segment by segment in the order they were written, so the segment files are read sequentially. If use_mmap is
+    # True, the segment files are memory-mapped instead of being read with file operations.
+    def iterate_records(self, use_mmap=False):
+        index_dict = self.load_index()
+
+        # Group the entries by segment and sort them by offset
+        segment_entries = {}
+        for uid, (datestamp, segment_number, offset, length) in index_dict.items():
+            segment_entries.setdefault(segment_number, []).append((offset, length, uid, datestamp))
+        del index_dict
+
+        for segment_number in sorted(segment_entries):
+            entry_list = sorted(segment_entries.pop(segment_number))
+            segment_path, index_path = self.get_segment_paths(segment_number)
+            with open(segment_path, 'rb') as segment_file:
+                if use_mmap:
+                    with mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ) as segment_map:
+                        for offset, length, uid, datestamp in entry_list:
+                            yield uid, datestamp, zlib.decompress(segment_map[offset:offset + length])
+                else:
+                    for offset, length, uid, datestamp in entry_list:
+                        segment_file.seek(offset)
+                        yield uid, datestamp, zlib.decompress(segment_file.read(length))
+
+    # Returns the XML of the latest version of a record, or None if the record is not in the archive
+    def get_record(self, uid):
+        entry = self.load_index().get(uid)
+        if not entry:
+            return None
+        datestamp, segment_number, offset, length = entry
+        segment_path, index_path = self.get_segment_paths(segment_number)
+        with open(segment_path, 'rb') as segment_file:
+            segment_file.seek(offset)
+            return zlib.decompress(segment_file.read(length))
+
+    # Returns a dictionary with the statistics of the archive (segments, stored records, unique records and bytes)
+    def get_statistics(self):
+        segment_number_list = self.get_segment_numbers()
+        stored_records = 0
+        size = 0
+        for segment_number in segment_number_list:
+            segment_path, index_path = self.get_segment_paths(segment_number)
+            size += os.path.getsize(segment_path)
+            if os.path.exists(index_path):
+                with open(index_path, 'rt', encoding='utf-8') as index_file:
+                    stored_records += sum(1 for line in index_file)
+        return {'segments': len(segment_number_list),
+                'stored_records': stored_records,
+                'unique_records': len(self.load_index()),
+                'bytes': size}
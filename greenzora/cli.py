@@ -0,0 +1,53 @@
+import click
+import json
+
+from greenzora import server_app
+
+
+# The command line interface of greenzora. The commands are run with the flask command, e.g.:
+# FLASK_APP=greenzora GREENZORA_SCHEDULE_JOBS=0 flask archive-reparse
+#
+# NOTE: The server logic is imported in the commands, since it is only initialized after this module was imported.
+
+# Parses the records in the record archive again and stores the papers (see ServerLogic.reparse_archive)
+@server_app.cli.command('archive-reparse')
+@click.option('--mmap', 'use_mmap', is_flag=True, help='Memory-map the segment files of the archive.')
+@click.option('--all', 'reclassify_all', is_flag=True, help='Classify and store the papers whose metadata did not change as well.')
+def archive_reparse(use_mmap, reclassify_all):
+    from greenzora import server_logic
+    server_logic.reparse_archive(use_mmap, reclassify_all)
+
+
+# Prints the statistics of the record archive
+@server_app.cli.command('archive-stats')
+def archive_stats():
+    from greenzora import server_logic
+    if not server_logic.record_archive:
+        print('The record archive is disabled')
+        return
+    print(json.dumps(server_logic.record_archive.get_statistics(), indent=2))
+
+
+# Computes the statistics of the dashboard again from the papers (see YearStatistic and EntityStatistic). The triggers
+# keep them up to date, so this is only needed if the papers were changed with the triggers disabled.
+@server_app.cli.command('statistics-rebuild')
+def statistics_rebuild():
+    from greenzora import db
+    from greenzora.models import YearStatistic, EntityStatistic
+    YearStatistic.rebuild()
+    EntityStatistic.rebuild()
+    db.session.commit()
+    print('Statistics rebuilt')
+
+
+# Indexes all papers in the full-text search table again (see search.rebuild_search_index)
+@server_app.cli.command('search-rebuild')
+def search_rebuild():
+    from greenzora import db
+    from greenzora.search import is_search_index_available, rebuild_search_index
+    if not is_search_index_available(db.session):
+        print('Full-text search not available')
+        return
+    rebuild_search_index()
+    db.session.commit()
+    print('Search index rebuilt')
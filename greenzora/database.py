@@ -0,0 +1,71 @@
+import sqlite3
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from greenzora import server_app, db
+
+# The access mode of the SQLite database. The database runs in WAL mode, in which the readers don't block the writer and
+# the writer doesn't block the readers, so the pages can be served while a ZORA pull writes its chunks. Every connection
+# is configured with the pragmas of the config once it is opened (see configure_connection). The connections of both
+# engines are pooled, so this happens once per connection and not once per session.
+#
+# The pages that only read the database use the read_session. It is bound to a separate engine, whose connections are
+# opened read-only and kept in their own pool, so that their page cache and memory map survive between requests. All
+# writes go through db.session as before.
+
+
+# Returns the path of the SQLite database file, or None if the database is not a SQLite file (e.g. in memory)
+def get_database_path(engine):
+    if engine.url.get_backend_name() != 'sqlite' or engine.url.database in [None, '', ':memory:']:
+        return None
+    return engine.url.database
+
+
+# Configures a new SQLite connection with the pragmas of the config. The journal mode is stored in the database file, so
+# it is only set by the connections that can write.
+def configure_connection(dbapi_connection, read_only):
+    cursor = dbapi_connection.cursor()
+    if not read_only:
+        cursor.execute('PRAGMA journal_mode = ' + ('WAL' if server_app.config['SQLITE_WAL'] else 'DELETE'))
+    cursor.execute('PRAGMA synchronous = ' + server_app.config['SQLITE_SYNCHRONOUS'])
+    cursor.execute('PRAGMA cache_size = ' + str(-server_app.config['SQLITE_CACHE_SIZE']))
+    cursor.execute('PRAGMA mmap_size = ' + str(server_app.config['SQLITE_MMAP_SIZE']))
+    cursor.execute('PRAGMA busy_timeout = ' + str(server_app.config['SQLITE_BUSY_TIMEOUT']))
+    cursor.close()
+
+
+# Creates the engine of the read_session. The connections are opened with the read-only mode of the SQLite URI, so a
+# write through this engine fails instead of taking the write lock. They are shared between the threads of the server
+# through the pool, which is why the same thread check of sqlite3 is disabled.
+def create_read_engine(path):
+    def connect():
+        connection = sqlite3.connect('file:' + path + '?mode=ro', uri=True, check_same_thread=False,
+                                     timeout=server_app.config['SQLITE_BUSY_TIMEOUT'] / 1000)
+        configure_connection(connection, read_only=True)
+        return connection
+
+    return create_engine('sqlite://', creator=connect, poolclass=QueuePool,
+                         pool_size=server_app.config['SQLITE_READ_POOL_SIZE'], max_overflow=0,
+                         pool_timeout=server_app.config['SQLITE_BUSY_TIMEOUT'] / 1000)
+
+
+# Configure the connections of db.session. If the database is not a SQLite file, the read_session uses the same engine.
+database_path = get_database_path(db.engine)
+if database_path:
+    @event.listens_for(db.engine, 'connect')
+    def configure_write_connection(dbapi_connection, connection_record):
+        configure_connection(dbapi_connection, read_only=False)
+
+    read_engine = create_read_engine(database_path)
+else:
+    read_engine = db.engine
+
+# The session of the pages that only read the database. It is removed at the end of every request.
+read_session = scoped_session(sessionmaker(bind=read_engine, autoflush=False))
+
+
+@server_app.teardown_appcontext
+def remove_read_session(exception=None):
+    read_session.remove()
@@ -0,0 +1,256 @@
+import json
+import numpy as np
+import os
+import scipy.sparse as sp
+
+from contextlib import contextmanager
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: the cache can only be shared by the threads of one process
+    fcntl = None
+
+
+# The FeatureCache stores the term counts of the papers (the rows of the document-term matrix) on the disk, so that the
+# titles and descriptions don't have to be tokenized again whenever a model is trained or all papers are classified
+# again. It can only be used with the hashing feature mode of the MLTool, since the term counts of the count mode depend
+# on the vocabulary of the trained model.
+#
+# The rows are stored in segments. A segment is a CSR matrix that is stored as .npy files (data, indices, indptr), so
+# that it can be memory-mapped, together with the uid and the metadata digest of every row and a deleted flag. Segments
+# are never changed: new and changed papers are appended as a new segment, deleted papers as empty rows with the deleted
+# flag. The latest row of a uid is the valid one. The manifest lists the segments in the order they were written. When
+# there are more than max_segments segments or more outdated rows than valid rows, the cache is compacted into a single
+# segment.
+#
+# The cache is shared by all server processes (and the threads of a process). Every access holds the lock file of the
+# cache: reading shared, writing and compacting exclusive. Since another process might have written or compacted the
+# cache meanwhile, the manifest is read again at the start of every access and the index is updated with the new
+# segments (or rebuilt after a compaction). The lock is taken on a separate file, because the manifest is replaced on
+# every write. Papers without a digest are not cached, since their term counts can't be told apart from outdated ones.
+class FeatureCache:
+    VERSION = 1
+    MANIFEST_FILE_NAME = 'manifest.json'
+    LOCK_FILE_NAME = 'manifest.lock'
+    SEGMENT_FILE_FORMAT = 'segment-{}.{}.npy'
+    ARRAY_NAMES = ['data', 'indices', 'indptr', 'uids', 'digests', 'deleted']
+
+    # In the constructor, we load the manifest and build the index of the valid rows. If the cache was created with
+    # another version or another amount of features, it is cleared.
+    def __init__(self, path, n_features, max_segments):
+        self.path = path
+        self.n_features = n_features
+        self.max_segments = max_segments
+        self.lock = Lock()
+        self.segments = []
+        self.next_segment_number = 1
+        self.row_count = 0
+
+        # The index of the valid rows {uid: (segment, row, digest)}
+        self.index = {}
+
+        os.makedirs(path, exist_ok=True)
+        with self.locked(exclusive=True):
+            pass
+
+    # Holds the lock of the cache (see the class comment) and brings the index up to date with the manifest
+    @contextmanager
+    def locked(self, exclusive):
+        with self.lock:
+            with open(os.path.join(self.path, FeatureCache.LOCK_FILE_NAME), 'a') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                try:
+                    self.load(exclusive)
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Loads the manifest and adds the uids, digests and deleted flags of the segments that are not in the index yet. If
+    # the cache was compacted meanwhile, the index is rebuilt. If the cache was created with another version or another
+    # amount of features, it is cleared (only with the exclusive lock, otherwise it is treated as empty).
+    def load(self, exclusive):
+        manifest_path = os.path.join(self.path, FeatureCache.MANIFEST_FILE_NAME)
+        manifest = None
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'rt') as file:
+                manifest = json.load(file)
+        if not manifest or manifest.get('version') != FeatureCache.VERSION or manifest.get('n_features') != self.n_features:
+            if exclusive:
+                self.clear()
+            else:
+                self.segments = []
+                self.row_count = 0
+                self.index = {}
+            return
+        segment_list = manifest['segments']
+        if segment_list[:len(self.segments)] == self.segments:
+            new_segment_list = segment_list[len(self.segments):]
+        else:
+            self.row_count = 0
+            self.index = {}
+            new_segment_list = segment_list
+        for segment in new_segment_list:
+            uids = self.load_array(segment, 'uids')
+            digests = self.load_array(segment, 'digests')
+            deleted = self.load_array(segment, 'deleted')
+            self.add_to_index(segment, uids.tolist(), digests.tolist(), deleted.tolist())
+        self.segments = list(segment_list)
+        self.next_segment_number = manifest['next_segment_number']
+
+    # Removes all segments and writes an empty manifest (the caller holds the exclusive lock)
+    def clear(self):
+        for file_name in os.listdir(self.path):
+            if file_name.startswith('segment-') and file_name.endswith('.npy'):
+                os.remove(os.path.join(self.path, file_name))
+        self.segments = []
+        self.next_segment_number = 1
+        self.row_count = 0
+        self.index = {}
+        self.write_manifest()
+
+    # Writes the manifest. It is written to a temporary file first, so that it is never half-written.
+    def write_manifest(self):
+        manifest_path = os.path.join(self.path, FeatureCache.MANIFEST_FILE_NAME)
+        with open(manifest_path + '.tmp', 'wt') as file:
+            json.dump({'version': FeatureCache.VERSION,
+                       'n_features': self.n_features,
+                       'next_segment_number': self.next_segment_number,
+                       'segments': self.segments}, file)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    # Returns the path of an array of a segment
+    def get_array_path(self, segment, array_name):
+        return os.path.join(self.path, FeatureCache.SEGMENT_FILE_FORMAT.format(segment, array_name))
+
+    # Loads an array of a segment (memory-mapped)
+    def load_array(self, segment, array_name):
+        return np.load(self.get_array_path(segment, array_name), mmap_mode='r', allow_pickle=False)
+
+    # Loads the matrix of a segment (memory-mapped)
+    def load_matrix(self, segment):
+        indptr = self.load_array(segment, 'indptr')
+        return sp.csr_matrix((self.load_array(segment, 'data'), self.load_array(segment, 'indices'), indptr),
+                             shape=(len(indptr) - 1, self.n_features))
+
+    # Updates the index with the rows of a segment
+    def add_to_index(self, segment, uid_list, digest_list, deleted_list):
+        for row, (uid, digest, deleted) in enumerate(zip(uid_list, digest_list, deleted_list)):
+            if deleted:
+                self.index.pop(uid, None)
+            else:
+                self.index[uid] = (segment, row, digest)
+        self.row_count += len(uid_list)
+
+    # Writes a new segment with the given rows and adds it to the manifest and the index (the caller holds the exclusive
+    # lock)
+    def write_segment(self, uid_list, digest_list, term_counts, deleted_list):
+        segment = '{:06d}'.format(self.next_segment_number)
+        term_counts = sp.csr_matrix(term_counts, dtype=np.float32)
+        array_dict = {'data': term_counts.data,
+                      'indices': term_counts.indices.astype(np.int32),
+                      'indptr': term_counts.indptr.astype(np.int64),
+                      'uids': np.array(uid_list, dtype=str),
+                      'digests': np.array(digest_list, dtype=str),
+                      'deleted': np.array(deleted_list, dtype=bool)}
+        for array_name in FeatureCache.ARRAY_NAMES:
+            np.save(self.get_array_path(segment, array_name), array_dict[array_name], allow_pickle=False)
+
+        # The segment only becomes part of the cache when it is in the manifest
+        self.segments.append(segment)
+        self.next_segment_number += 1
+        self.write_manifest()
+        self.add_to_index(segment, uid_list, digest_list, deleted_list)
+        return segment
+
+    # Removes the files of a segment
+    def remove_segment_files(self, segment):
+        for array_name in FeatureCache.ARRAY_NAMES:
+            try:
+                os.remove(self.get_array_path(segment, array_name))
+            except OSError:
+                pass
+
+    # Adds the term counts (a sparse matrix with one row per paper) of new or changed papers to the cache. Papers without
+    # a digest are skipped.
+    def add_rows(self, uid_list, digest_list, term_counts):
+        position_list = [position for position, digest in enumerate(digest_list) if digest is not None]
+        if not position_list:
+            return
+        if len(position_list) < len(uid_list):
+            uid_list = [uid_list[position] for position in position_list]
+            digest_list = [digest_list[position] for position in position_list]
+            term_counts = sp.csr_matrix(term_counts)[position_list]
+        with self.locked(exclusive=True):
+            self.write_segment(uid_list, [str(digest) for digest in digest_list], term_counts, [False] * len(uid_list))
+            self.compact_if_necessary()
+
+    # Removes the rows of deleted papers from the cache
+    def delete_rows(self, uid_list):
+        with self.locked(exclusive=True):
+            uid_list = [uid for uid in uid_list if uid in self.index]
+            if not uid_list:
+                return
+            self.write_segment(uid_list, [''] * len(uid_list), sp.csr_matrix((len(uid_list), self.n_features)),
+                               [True] * len(uid_list))
+            self.compact_if_necessary()
+
+    # Returns the rows of the papers with the given uids and digests. Rows are only returned if the digest matches, i.e.
+    # the term counts belong to the current metadata of the paper. Returns the sorted positions (in uid_list) of the
+    # papers that were found and a matrix with their rows in the same order.
+    def get_rows(self, uid_list, digest_list):
+        position_list = []
+        part_list = []
+        with self.locked(exclusive=False):
+            segment_rows = {}
+            for position, (uid, digest) in enumerate(zip(uid_list, digest_list)):
+                entry = self.index.get(uid)
+                if entry and digest is not None and entry[2] == str(digest):
+                    segment_rows.setdefault(entry[0], []).append((entry[1], position))
+            for segment, row_position_list in segment_rows.items():
+                part_list.append(self.load_matrix(segment)[[row for row, position in row_position_list]])
+                position_list.extend(position for row, position in row_position_list)
+        if not part_list:
+            return [], sp.csr_matrix((0, self.n_features), dtype=np.float32)
+        order = np.argsort(position_list, kind='stable')
+        return [position_list[index] for index in order], sp.vstack(part_list, format='csr')[order]
+
+    # Compacts the cache if there are too many segments or too many outdated rows (the caller holds the exclusive lock)
+    def compact_if_necessary(self):
+        if len(self.segments) > self.max_segments or self.row_count - len(self.index) > len(self.index):
+            self.compact()
+
+    # Writes all valid rows into a single new segment and removes the old segments (the caller holds the exclusive lock)
+    def compact(self):
+        old_segment_list = self.segments
+        uid_list = []
+        digest_list = []
+        part_list = []
+        for segment in old_segment_list:
+            uids = self.load_array(segment, 'uids').tolist()
+            row_list = []
+            for row, uid in enumerate(uids):
+                entry = self.index.get(uid)
+                if entry and entry[0] == segment and entry[1] == row:
+                    row_list.append(row)
+                    uid_list.append(uid)
+                    digest_list.append(entry[2])
+            if row_list:
+                part_list.append(self.load_matrix(segment)[row_list])
+        term_counts = sp.vstack(part_list, format='csr') if part_list else sp.csr_matrix((0, self.n_features))
+
+        self.segments = []
+        self.index = {}
+        self.row_count = 0
+        self.write_segment(uid_list, digest_list, term_counts, [False] * len(uid_list))
+        for segment in old_segment_list:
+            self.remove_segment_files(segment)
+        print('Feature cache compacted (' + str(len(uid_list)) + ' rows)')
+
+    # Returns a dictionary with the statistics of the cache (segments, rows and valid rows)
+    def get_statistics(self):
+        with self.locked(exclusive=False):
+            return {'segments': len(self.segments), 'rows': self.row_count, 'valid_rows': len(self.index)}
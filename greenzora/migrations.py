@@ -0,0 +1,174 @@
+from greenzora import db
+from greenzora.models import OperationParameter, YearStatistic, EntityStatistic
+from greenzora.search import SEARCH_TABLE, create_search_index, is_search_index_available, rebuild_search_index
+from greenzora.utils import is_debug
+
+
+# The schema migrations of the database. db.create_all only creates the tables that don't exist yet, so changes of
+# existing tables (new columns, new indexes) are applied by migrations. The migrations are applied in order at startup
+# and every migration is applied only once: the version of the schema (the amount of applied migrations) is stored in
+# the operation parameter schema_version.
+#
+# To change the schema, change the models and append a migration to MIGRATIONS. A new database gets the current schema
+# from db.create_all and initialize_schema and starts at the current version, so the migrations only run on existing
+# databases. Triggers and tables that db.create_all does not create have to be added to initialize_schema as well.
+
+# Adds the columns of the models that don't exist in the database yet
+def add_missing_columns():
+    for table in db.metadata.sorted_tables:
+        existing_column_set = {row[1] for row in db.session.execute('PRAGMA table_info(' + table.name + ')')}
+        for column in table.columns:
+            if column.name not in existing_column_set:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                db.session.execute('ALTER TABLE ' + table.name + ' ADD COLUMN ' + column.name + ' ' + column_type)
+                print('Column ' + table.name + '.' + column.name + ' added')
+
+
+# Creates the indexes that are declared in the models (index=True or __table_args__) and don't exist in the database
+# yet, and drops the indexes that are not declared anymore. Only the indexes with the ix_ prefix of SQLAlchemy are
+# dropped, the indexes SQLite creates for primary keys and unique columns are not touched.
+def synchronize_indexes():
+    declared_index_set = set()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            declared_index_set.add(index.name)
+            column_names = ', '.join(column.name for column in index.columns)
+            db.session.execute('CREATE ' + ('UNIQUE ' if index.unique else '') + 'INDEX IF NOT EXISTS ' + index.name +
+                               ' ON ' + table.name + ' (' + column_names + ')')
+    index_query = "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix\\_%' ESCAPE '\\'"
+    for index_name, in db.session.execute(index_query).fetchall():
+        if index_name not in declared_index_set:
+            db.session.execute('DROP INDEX ' + index_name)
+            print('Index ' + index_name + ' dropped')
+
+
+# Adds the indexes of the columns the papers and their associations are filtered, joined and sorted by. The statistics
+# of the query planner are updated afterwards, so that it knows how selective the new indexes are.
+def add_query_indexes():
+    synchronize_indexes()
+    db.session.execute('ANALYZE')
+
+
+# The year of a paper in the statistics (NULL if the paper has no date)
+YEAR_EXPRESSION = "strftime('%Y', {}.date)"
+
+
+# Creates the triggers that maintain the statistics tables (see YearStatistic and EntityStatistic). Existing triggers are
+# replaced, so that changed triggers can be installed by calling this function in a new migration.
+#
+# - A new, deleted or changed paper changes the counts of its old and new year.
+# - A paper that becomes sustainable (or not) changes the counts of the entities it is associated with. Since it might
+#   be associated with an entity more than once, the change is multiplied with the amount of its associations.
+# - A new or deleted association of a sustainable paper changes the count of the entity.
+def create_statistics_triggers():
+    year_table = YearStatistic.__tablename__
+    entity_table = EntityStatistic.__tablename__
+    new_year = YEAR_EXPRESSION.format('NEW')
+    old_year = YEAR_EXPRESSION.format('OLD')
+    trigger_dict = {}
+
+    # The year statistics
+    add_new_year = ('INSERT OR IGNORE INTO ' + year_table + ' (year, paper_count, sustainable_count) '
+                    'SELECT ' + new_year + ', 0, 0 WHERE ' + new_year + ' IS NOT NULL; '
+                    'UPDATE ' + year_table + ' SET paper_count = paper_count + 1, '
+                    'sustainable_count = sustainable_count + (NEW.sustainable IS 1) WHERE year = ' + new_year + ';')
+    remove_old_year = ('UPDATE ' + year_table + ' SET paper_count = paper_count - 1, '
+                       'sustainable_count = sustainable_count - (OLD.sustainable IS 1) WHERE year = ' + old_year + ';')
+    trigger_dict['papers_year_statistics_insert'] = 'AFTER INSERT ON papers BEGIN ' + add_new_year + ' END'
+    trigger_dict['papers_year_statistics_delete'] = 'AFTER DELETE ON papers BEGIN ' + remove_old_year + ' END'
+    trigger_dict['papers_year_statistics_update'] = ('AFTER UPDATE OF sustainable, date ON papers '
+                                                     'WHEN (OLD.sustainable IS 1) != (NEW.sustainable IS 1) '
+                                                     'OR OLD.date IS NOT NEW.date '
+                                                     'BEGIN ' + remove_old_year + ' ' + add_new_year + ' END')
+
+    # The entity statistics
+    paper_update_list = []
+    for entity_type, association_table, entity_column in EntityStatistic.ENTITY_ASSOCIATIONS:
+        paper_update_list.append(
+            'INSERT OR IGNORE INTO ' + entity_table + ' (entity_type, entity_id, sustainable_count) '
+            "SELECT '" + entity_type + "', " + entity_column + ', 0 FROM ' + association_table + ' '
+            'WHERE paper_uid = NEW.uid AND ' + entity_column + ' IS NOT NULL; '
+            'UPDATE ' + entity_table + ' SET sustainable_count = sustainable_count + '
+            '((NEW.sustainable IS 1) - (OLD.sustainable IS 1)) * (SELECT COUNT(*) FROM ' + association_table + ' '
+            'WHERE paper_uid = NEW.uid AND ' + entity_column + ' = ' + entity_table + '.entity_id) '
+            "WHERE entity_type = '" + entity_type + "' AND entity_id IN "
+            '(SELECT ' + entity_column + ' FROM ' + association_table + ' WHERE paper_uid = NEW.uid);')
+        is_sustainable = '(SELECT sustainable FROM papers WHERE uid = {}.paper_uid) IS 1'
+        trigger_dict[association_table + '_statistics_insert'] = (
+            'AFTER INSERT ON ' + association_table + ' '
+            'WHEN NEW.' + entity_column + ' IS NOT NULL AND ' + is_sustainable.format('NEW') + ' '
+            'BEGIN INSERT OR IGNORE INTO ' + entity_table + ' (entity_type, entity_id, sustainable_count) '
+            "VALUES ('" + entity_type + "', NEW." + entity_column + ', 0); '
+            'UPDATE ' + entity_table + ' SET sustainable_count = sustainable_count + 1 '
+            "WHERE entity_type = '" + entity_type + "' AND entity_id = NEW." + entity_column + '; END')
+        trigger_dict[association_table + '_statistics_delete'] = (
+            'AFTER DELETE ON ' + association_table + ' '
+            'WHEN OLD.' + entity_column + ' IS NOT NULL AND ' + is_sustainable.format('OLD') + ' '
+            'BEGIN UPDATE ' + entity_table + ' SET sustainable_count = sustainable_count - 1 '
+            "WHERE entity_type = '" + entity_type + "' AND entity_id = OLD." + entity_column + '; END')
+    trigger_dict['papers_entity_statistics_update'] = ('AFTER UPDATE OF sustainable ON papers '
+                                                       'WHEN (OLD.sustainable IS 1) != (NEW.sustainable IS 1) '
+                                                       'BEGIN ' + ' '.join(paper_update_list) + ' END')
+
+    for trigger_name, trigger_definition in trigger_dict.items():
+        db.session.execute('DROP TRIGGER IF EXISTS ' + trigger_name)
+        db.session.execute('CREATE TRIGGER ' + trigger_name + ' ' + trigger_definition)
+
+
+# Adds the statistics tables of the dashboard: installs their triggers and computes them from the existing papers
+def add_statistics():
+    create_statistics_triggers()
+    YearStatistic.rebuild()
+    EntityStatistic.rebuild()
+    synchronize_indexes()
+
+
+# Adds the full-text search index of the papers (see search.py) and indexes the existing papers
+def add_search_index():
+    if create_search_index():
+        rebuild_search_index()
+
+
+# Keys the full-text search table on the uids of the papers instead of their rowids, which a VACUUM may change, and
+# replaces the triggers on the keyword associations (see search.py). The old table is dropped and the papers are
+# indexed again.
+def rekey_search_index():
+    for trigger_name in ['paper_keyword_search_insert', 'paper_keyword_search_delete']:
+        db.session.execute('DROP TRIGGER IF EXISTS ' + trigger_name)
+    db.session.execute('DROP TABLE IF EXISTS papers_fts_deferred')
+    if is_search_index_available(db.session):
+        db.session.execute('DROP TABLE ' + SEARCH_TABLE)
+    add_search_index()
+
+
+# The migrations in the order they are applied. Version n of the schema means that the first n migrations are applied.
+# 1: The metadata digest of the papers (papers.digest)
+# 2: The indexes of the filtered, joined and sorted columns
+# 3: The statistics tables of the dashboard (year_statistics and entity_statistics) and their triggers
+# 4: The full-text search table of the papers (papers_fts) and its triggers
+# 5: The uid in the index of the sustainable papers by date (ix_papers_sustainable_date_uid), for the result pages
+# 6: The full-text search table keyed on the uids of the papers (papers_fts_keys)
+MIGRATIONS = [add_missing_columns, add_query_indexes, add_statistics, add_search_index, add_query_indexes,
+              rekey_search_index]
+
+
+# Creates the parts of the current schema that db.create_all does not create (the triggers of the statistics and the
+# full-text search table) in a new database and records the current schema version, so that no migration is applied.
+# The caller commits.
+def initialize_schema():
+    create_statistics_triggers()
+    create_search_index()
+    OperationParameter.set('schema_version', len(MIGRATIONS))
+
+
+# Applies the migrations that were not applied to the database yet. Every migration is committed together with the new
+# schema version, so an interrupted migration is applied again at the next startup.
+def migrate_schema():
+    schema_version = OperationParameter.get('schema_version') or 0
+    for version in range(schema_version + 1, len(MIGRATIONS) + 1):
+        print('Migrating the database schema to version ' + str(version) + '...')
+        MIGRATIONS[version - 1]()
+        OperationParameter.set('schema_version', version)
+        db.session.commit()
+    if is_debug():
+        print('Database schema version: ' + str(len(MIGRATIONS)))
@@ -1,33 +1,243 @@
+import joblib
+import numpy as np
+import os
 import pandas as pd
 
-from sklearn.feature_extraction.text import CountVectorizer
+from multiprocessing import Pool
+from scipy.sparse import issparse
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer, TfidfTransformer
 from sklearn.naive_bayes import MultinomialNB
+from threading import Lock
 
 
 # The MLTool class stores a vectorizer and a classifier that are used to classify papers into the categories
 # 'sustainable' and 'not sustainable'. It also contains all relevant methods to train the model and classify papers.
+#
+# There are two feature modes. In the 'count' mode, the vectorizer learns a vocabulary of all terms of the training
+# data. In the 'hashing' mode, the terms are hashed into a fixed amount of features (n_features), so the memory usage
+# does not grow with the corpus and the vectorizer does not have to be fitted. In both modes, the term counts can be
+# weighted with TF-IDF.
+#
+# In the online mode (hashing mode only), the classifier can be updated with new annotations (update_classifier)
+# without training it again with all annotated papers. The TF-IDF weights are only learned during the training.
+#
+# A trained tool can be saved to an artifact on the disk (save) and loaded again (load). The artifact contains the
+# version of its format and a fingerprint of the training data, so that outdated artifacts can be recognized.
 class MLTool:
-    def __init__(self):
-        # initialize the vectorizer
-        self.vectorizer = CountVectorizer()
+    FEATURE_MODE_COUNT = 'count'
+    FEATURE_MODE_HASHING = 'hashing'
+
+    # The classes of the classifier ('not sustainable' and 'sustainable'). They have to be known before the first update,
+    # since an update might only contain papers of one class.
+    CLASSES = [False, True]
+
+    # The version of the artifact format. Artifacts of other versions are not loaded.
+    ARTIFACT_VERSION = 1
+
+    def __init__(self, feature_mode=FEATURE_MODE_COUNT, n_features=2 ** 20, tfidf=False, online=False):
+        if online and feature_mode != MLTool.FEATURE_MODE_HASHING:
+            raise ValueError('The online mode needs the hashing feature mode')
+        self.feature_mode = feature_mode
+        self.n_features = n_features
+        self.tfidf = tfidf
+        self.online = online
+
+        # The fingerprint of the training data and the path of the artifact of a saved or loaded tool
+        self.fingerprint = None
+        self.artifact_path = None
+
+        # initialize the vectorizer. The hashing vectorizer counts the terms like the count vectorizer (no alternating
+        # signs, no normalization), since this is what the naive bayes classifier expects.
+        if feature_mode == MLTool.FEATURE_MODE_HASHING:
+            self.vectorizer = HashingVectorizer(n_features=n_features, alternate_sign=False, norm=None)
+        elif feature_mode == MLTool.FEATURE_MODE_COUNT:
+            self.vectorizer = CountVectorizer()
+        else:
+            raise ValueError('Unknown feature mode: ' + str(feature_mode))
+        self.tfidf_transformer = TfidfTransformer() if tfidf else None
 
         # initialize the classifier
         self.classifier = MultinomialNB()
 
+        # The lock makes sure that two updates of the classifier do not run at the same time
+        self.update_lock = Lock()
+
     # This method creates the vocabulary and trains the classifier based on the trainings data and labels provided.
     def train_classifier(self, training_data: pd.Series, labels: pd.Series):
 
-        # Learn data vocabulary, then use it to create a document-term matrix
-        training_data_dtm = self.vectorizer.fit_transform(training_data)
+        # Learn data vocabulary (count mode only), then use it to create a document-term matrix
+        if self.feature_mode == MLTool.FEATURE_MODE_HASHING:
+            training_data_dtm = self.vectorizer.transform(training_data)
+        else:
+            training_data_dtm = self.vectorizer.fit_transform(training_data)
 
         # Train the model using X_train_dtm
+        self.train_classifier_with_term_counts(training_data_dtm, labels)
+
+    # Trains the classifier with the term counts of the training data (see get_term_counts) and the labels provided. The
+    # TF-IDF weights are learned from the term counts.
+    def train_classifier_with_term_counts(self, training_data_dtm, labels):
+        if self.tfidf_transformer:
+            training_data_dtm = self.tfidf_transformer.fit_transform(training_data_dtm)
+
+        # In the online mode, the classifier is trained with partial_fit, so that it knows both classes even if the
+        # training data only contains one of them.
+        if self.online:
+            with self.update_lock:
+                self.classifier = MultinomialNB()
+                self.classifier.partial_fit(training_data_dtm, labels, classes=MLTool.CLASSES)
+            return
         self.classifier.fit(training_data_dtm, labels)
 
+    # This method updates the trained classifier with additional training data and labels (online mode only). The class
+    # and feature counts of the classifier are updated, so the cost only depends on the amount of new data.
+    def update_classifier(self, training_data: pd.Series, labels: pd.Series):
+        if not self.online:
+            raise ValueError('The classifier can only be updated in the online mode')
+        training_data_dtm = self.apply_weights(self.get_term_counts(training_data))
+        with self.update_lock:
+            self.classifier.partial_fit(training_data_dtm, labels, classes=MLTool.CLASSES)
+
     # This method classifies the given papers by the data provided
     def classify(self, data: pd.Series):
 
-        # Transform data (using fitted vocabulary of vectorizer) into a document-term matrix
-        data_dtm = self.vectorizer.transform(data)
+        # Transform data (using fitted vocabulary of vectorizer) into a document-term matrix, then predict the labels
+        return self.classify_term_counts(self.get_term_counts(data))
+
+    # Classifies the papers by their term counts (see get_term_counts)
+    def classify_term_counts(self, data_dtm):
+        return self.classifier.predict(self.apply_weights(data_dtm))
+
+    # Returns the certainty of the classifier for the given papers as an array of values between 0 (both classes are
+    # equally likely) and 1 (the paper certainly belongs to one class)
+    def get_certainty(self, data: pd.Series):
+        return self.get_certainty_term_counts(self.get_term_counts(data))
+
+    # Returns the certainty of the classifier (see get_certainty) for the papers with the given term counts
+    def get_certainty_term_counts(self, data_dtm):
+        probabilities = self.classifier.predict_proba(self.apply_weights(data_dtm))
+        return np.abs(probabilities[:, 1] - probabilities[:, 0])
+
+    # Returns the term counts (document-term matrix) of the data. In the hashing mode, the term counts do not depend on
+    # the training, so they can be cached (see FeatureCache).
+    def get_term_counts(self, data: pd.Series):
+        return self.vectorizer.transform(data)
+
+    # Weights the term counts with TF-IDF if it is enabled
+    def apply_weights(self, data_dtm):
+        if self.tfidf_transformer:
+            return self.tfidf_transformer.transform(data_dtm)
+        return data_dtm
+
+    # The lock cannot be pickled, so it is left out when a tool is sent to another process and created again afterwards
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['update_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.update_lock = Lock()
+
+    # Returns the parameters of the tool, which are needed to create it again
+    def get_parameters(self):
+        return {'feature_mode': self.feature_mode,
+                'n_features': self.n_features,
+                'tfidf': self.tfidf,
+                'online': self.online}
+
+    # Saves the trained tool to an artifact at the given path together with the fingerprint of its training data. The
+    # artifact is written to a temporary file first, so that no other process loads a half-written artifact.
+    def save(self, path, fingerprint):
+        temporary_path = path + '.tmp'
+        joblib.dump({'version': MLTool.ARTIFACT_VERSION,
+                     'fingerprint': fingerprint,
+                     'parameters': self.get_parameters(),
+                     'vectorizer': self.vectorizer,
+                     'tfidf_transformer': self.tfidf_transformer,
+                     'classifier': self.classifier}, temporary_path)
+        os.replace(temporary_path, path)
+        self.fingerprint = fingerprint
+        self.artifact_path = path
+
+    # Loads a tool from an artifact. The large arrays (e.g. the feature counts of the classifier) are memory-mapped
+    # copy-on-write, so they are shared between processes until the classifier is updated. Raises a ValueError if the
+    # artifact has another version.
+    @classmethod
+    def load(cls, path):
+        artifact = joblib.load(path, mmap_mode='c')
+        if not isinstance(artifact, dict) or artifact.get('version') != MLTool.ARTIFACT_VERSION:
+            raise ValueError('The artifact ' + path + ' has an unsupported version')
+        ml_tool = cls(**artifact['parameters'])
+        ml_tool.vectorizer = artifact['vectorizer']
+        ml_tool.tfidf_transformer = artifact['tfidf_transformer']
+        ml_tool.classifier = artifact['classifier']
+        ml_tool.fingerprint = artifact['fingerprint']
+        ml_tool.artifact_path = path
+        return ml_tool
+
+    # Creates a pool of processes that classify papers with this tool (see classify_in_pool). If the tool was saved or
+    # loaded, every worker loads it from its artifact once (memory-mapped, so the workers share the pages of the large
+    # arrays). Otherwise the workers get a copy of the tool when they are started.
+    #
+    # NOTE: The workers are started with the default start method of multiprocessing (see ZoraAPI.create_parser_pool)
+    def create_classifier_pool(self, workers):
+        if self.artifact_path and os.path.exists(self.artifact_path):
+            initargs = (self.artifact_path, None)
+        else:
+            initargs = (None, self)
+        return Pool(processes=workers, initializer=initialize_classifier_worker, initargs=initargs)
+
+    # Classifies the data (a Series of texts or a sparse matrix of term counts) in a pool of classifier workers (see
+    # create_classifier_pool). The data is split into batches of batch_size papers that are classified in parallel. The
+    # labels are returned in the order of the data.
+    @staticmethod
+    def classify_in_pool(classifier_pool, data, batch_size):
+        if issparse(data):
+            size = data.shape[0]
+        else:
+            data = list(data)
+            size = len(data)
+        batch_list = [data[start:start + batch_size] for start in range(0, size, batch_size)]
+        label_list = classifier_pool.map(classify_batch, batch_list, chunksize=1)
+        return np.concatenate(label_list) if label_list else np.array([], dtype=bool)
+
+
+# ------------ TRAINING WORKERS ---------------
+
+# Trains a new machine learning tool in a training worker process. The training data is either a list of texts or a
+# sparse matrix of term counts (see MLTool.get_term_counts). If a path is given, the tool is saved to an artifact at that
+# path (see MLTool.save) and None is returned. Otherwise the tool itself is returned.
+def train_ml_tool(parameters, training_data, labels, path=None, fingerprint=None):
+    ml_tool = MLTool(**parameters)
+    if issparse(training_data):
+        ml_tool.train_classifier_with_term_counts(training_data, pd.Series(labels))
+    else:
+        ml_tool.train_classifier(pd.Series(training_data), pd.Series(labels))
+    if path:
+        ml_tool.save(path, fingerprint)
+        return None
+    return ml_tool
+
+# ------------ END TRAINING WORKERS ---------------
+
+
+# ------------ CLASSIFIER WORKERS ---------------
+
+# The machine learning tool of a classifier worker process
+worker_ml_tool = None
+
+
+# Initializes a classifier worker process with the tool from the artifact at the given path or with the given tool
+def initialize_classifier_worker(path, ml_tool):
+    global worker_ml_tool
+    worker_ml_tool = MLTool.load(path) if path else ml_tool
+
+
+# Classifies a batch of papers (a list of texts or a sparse matrix of term counts) in a classifier worker process
+def classify_batch(batch):
+    if issparse(batch):
+        return worker_ml_tool.classify_term_counts(batch)
+    return worker_ml_tool.classify(pd.Series(batch))
 
-        # Predict the label and store it
-        return self.classifier.predict(data_dtm)
+# ------------ END CLASSIFIER WORKERS ---------------
@@ -1,14 +1,16 @@
 import dateutil.parser
+import hashlib
+import json
 import mpld3
 
 from matplotlib import pyplot
 from datetime import datetime
 from flask_login import UserMixin
-from sqlalchemy.sql import func
+from sqlalchemy.sql import and_
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from greenzora import server_app, db, login_manager
-from greenzora.utils import is_debug
+from greenzora.utils import is_debug, split_list, MAX_SQL_VARIABLES
 
 # Set the default font for the papers per year plot
 pyplot.rcParams['font.sans-serif'] = "Arial"
@@ -32,6 +34,7 @@ pyplot.rcParams['font.family'] = "sans-serif"
 # relation:             The link to the ZORA page of the paper
 # sustainable:          Flag that tells us whether a paper is sustainable or not
 # annotated:            Flag that tells us whether a paper is annotated or not
+# digest:               Digest of the normalized metadata, used to recognize unchanged papers during a ZORA pull
 class Paper(db.Model):
     __tablename__ = 'papers'
     uid = db.Column(db.String(256), primary_key=True)
@@ -50,6 +53,19 @@ class Paper(db.Model):
     relation = db.Column(db.String(256))
     sustainable = db.Column(db.Boolean)
     annotated = db.Column(db.Boolean, default=False)
+    digest = db.Column(db.String(40))
+
+    # The indexes of the columns the papers are filtered and sorted by: the sustainable papers in the order of their date
+    # and uid (statistics and result pages), the annotated or not annotated papers in the order of their uid (training
+    # and reclassification) and the papers of a language or publisher
+    __table_args__ = (db.Index('ix_papers_sustainable_date_uid', 'sustainable', 'date', 'uid'),
+                      db.Index('ix_papers_annotated_uid', 'annotated', 'uid'),
+                      db.Index('ix_papers_language_id_sustainable', 'language_id', 'sustainable'),
+                      db.Index('ix_papers_publisher_id', 'publisher_id'))
+
+    # The metadata fields that are part of the digest
+    DIGEST_FIELDS = ['title', 'creators', 'institutes', 'ddcs', 'keywords', 'description', 'publisher', 'date',
+                     'resource_types', 'language', 'relation']
 
     # Method that defines how an object of this class is printed. If no value is set, print 'NULL'.
     def __repr__(self):
@@ -87,20 +103,13 @@ class Paper(db.Model):
         description = metadata_dict['description'] if 'description' in metadata_dict else None
         publisher = metadata_dict['publisher'] if 'publisher' in metadata_dict else None
         date_string = metadata_dict['date'] if 'date' in metadata_dict else None
-
-        # Zora has some invalid up dates (ex. 2009-11-31). If we encounter a invalid date, we set it to None.
-        try:
-            publish_date = dateutil.parser.parse(date_string, default=datetime(1970, 1, 1)).date()
-        except ValueError as error:
-            if is_debug():
-                print('Date "' + date_string + '" could not be parsed: ' + str(error))
-            publish_date = None
-
+        publish_date = cls.parse_date(date_string)
         resource_type_list = metadata_dict['resource_types'] if 'resource_types' in metadata_dict else []
         language = metadata_dict['language'] if 'language' in metadata_dict else None
         relation = metadata_dict['relation'] if 'relation' in metadata_dict else None
         sustainable = metadata_dict['sustainable'] if 'sustainable' in metadata_dict else None
         annotated = metadata_dict['annotated'] if 'annotated' in metadata_dict else False
+        digest = metadata_dict['digest'] if 'digest' in metadata_dict else cls.compute_digest(metadata_dict)
 
         # Create creators if they don't exist
         creators = []
@@ -160,17 +169,190 @@ class Paper(db.Model):
                     language=language,
                     relation=relation,
                     sustainable=sustainable,
-                    annotated=annotated)
+                    annotated=annotated,
+                    digest=digest)
 
         # If there already exists a paper with the same uid, it will be merged (updated) and otherwise created.
         paper = db.session.merge(paper)
 
         return paper
 
-    # Creates a html plot of how many sustainable papers were published each year
+    # Creates or updates a whole batch of Papers based on their metadata dictionaries. In contrast to create_or_update,
+    # the Creators, Institutes, Dewey Decimal Classifications, Keywords, Publishers, ResourceTypes and Languages of all
+    # papers are resolved with a few set based queries, and the papers and their associations are written with bulk
+    # statements. The papers are not loaded into the session.
+    #
+    # NOTE: If a metadata dictionary does not contain 'annotated', an already annotated paper keeps its annotation
+    # (sustainable and annotated are not overwritten).
+    @classmethod
+    def bulk_create_or_update(cls, metadata_dict_list):
+
+        # If a paper occurs more than once, the last metadata dictionary wins
+        metadata_dict_list = list({metadata_dict['uid']: metadata_dict for metadata_dict in metadata_dict_list}.values())
+        if not metadata_dict_list:
+            return
+
+        # Resolve all referenced entities at once and create the ones that don't exist
+        creator_ids = Creator.bulk_get_or_create({cls.split_creator_name(creator_name)
+                                                  for metadata_dict in metadata_dict_list
+                                                  for creator_name in metadata_dict.get('creators', [])})
+        institute_ids = Institute.bulk_get_or_create({institute_name
+                                                      for metadata_dict in metadata_dict_list
+                                                      for institute_name in metadata_dict.get('institutes', [])})
+        ddc_numbers = DDC.bulk_get_or_create({cls.split_ddc_string(ddc_string)
+                                              for metadata_dict in metadata_dict_list
+                                              for ddc_string in metadata_dict.get('ddcs', [])})
+        keyword_ids = Keyword.bulk_get_or_create({keyword_name
+                                                  for metadata_dict in metadata_dict_list
+                                                  for keyword_name in metadata_dict.get('keywords', [])})
+        resource_type_ids = ResourceType.bulk_get_or_create({resource_type_name
+                                                             for metadata_dict in metadata_dict_list
+                                                             for resource_type_name in metadata_dict.get('resource_types', [])})
+        publisher_ids = Publisher.bulk_get_or_create({metadata_dict['publisher']
+                                                      for metadata_dict in metadata_dict_list
+                                                      if metadata_dict.get('publisher')})
+        language_ids = Language.bulk_get_or_create({metadata_dict['language']
+                                                    for metadata_dict in metadata_dict_list
+                                                    if metadata_dict.get('language')})
+
+        # Find out which papers already exist and whether they are annotated
+        uid_list = [metadata_dict['uid'] for metadata_dict in metadata_dict_list]
+        annotated_dict = {}
+        for uid_sublist in split_list(uid_list, MAX_SQL_VARIABLES):
+            for uid, annotated in db.session.query(cls.uid, cls.annotated).filter(cls.uid.in_(uid_sublist)):
+                annotated_dict[uid] = annotated
+
+        # Build the paper rows and the rows of the association tables
+        new_paper_list = []
+        existing_paper_list = []
+        association_dict = {PaperCreator: [], PaperInstitute: [], PaperDDC: [], PaperKeyword: [], PaperResourceType: []}
+        for metadata_dict in metadata_dict_list:
+            uid = metadata_dict['uid']
+            publisher_name = metadata_dict.get('publisher')
+            language_name = metadata_dict.get('language')
+            paper_row = {'uid': uid,
+                         'title': metadata_dict.get('title'),
+                         'description': metadata_dict.get('description'),
+                         'publisher_id': publisher_ids[publisher_name] if publisher_name else None,
+                         'date': cls.parse_date(metadata_dict.get('date')),
+                         'language_id': language_ids[language_name] if language_name else None,
+                         'relation': metadata_dict.get('relation'),
+                         'digest': metadata_dict['digest'] if 'digest' in metadata_dict else cls.compute_digest(metadata_dict)}
+            if uid not in annotated_dict:
+                paper_row['sustainable'] = metadata_dict.get('sustainable')
+                paper_row['annotated'] = metadata_dict.get('annotated', False)
+                new_paper_list.append(paper_row)
+            else:
+                if 'annotated' in metadata_dict:
+                    paper_row['sustainable'] = metadata_dict.get('sustainable')
+                    paper_row['annotated'] = metadata_dict['annotated']
+                elif not annotated_dict[uid]:
+                    paper_row['sustainable'] = metadata_dict.get('sustainable')
+                existing_paper_list.append(paper_row)
+
+            creator_id_list = [creator_ids[cls.split_creator_name(creator_name)]
+                               for creator_name in metadata_dict.get('creators', [])]
+            institute_id_list = [institute_ids[institute_name] for institute_name in metadata_dict.get('institutes', [])]
+            ddc_number_list = [ddc_numbers[cls.split_ddc_string(ddc_string)] for ddc_string in metadata_dict.get('ddcs', [])]
+            keyword_id_list = [keyword_ids[keyword_name] for keyword_name in metadata_dict.get('keywords', [])]
+            resource_type_id_list = [resource_type_ids[resource_type_name]
+                                     for resource_type_name in metadata_dict.get('resource_types', [])]
+
+            # dict.fromkeys removes duplicates, but keeps the order
+            for creator_id in dict.fromkeys(creator_id_list):
+                association_dict[PaperCreator].append({'paper_uid': uid, 'creator_id': creator_id})
+            for institute_id in dict.fromkeys(institute_id_list):
+                association_dict[PaperInstitute].append({'paper_uid': uid, 'institute_id': institute_id})
+            for ddc_number in dict.fromkeys(ddc_number_list):
+                association_dict[PaperDDC].append({'paper_uid': uid, 'ddc_dewey_number': ddc_number})
+            for keyword_id in dict.fromkeys(keyword_id_list):
+                association_dict[PaperKeyword].append({'paper_uid': uid, 'keyword_id': keyword_id})
+            for resource_type_id in dict.fromkeys(resource_type_id_list):
+                association_dict[PaperResourceType].append({'paper_uid': uid, 'resource_type_id': resource_type_id})
+
+        # Write the papers
+        if new_paper_list:
+            db.session.bulk_insert_mappings(cls, new_paper_list)
+        if existing_paper_list:
+            db.session.bulk_update_mappings(cls, existing_paper_list)
+
+        # Replace the associations of the papers and index their keywords for the full-text search (see search.py)
+        # NOTE: This import is not at the top of the file to avoid circular imports
+        from greenzora.search import index_keywords
+        for association_class, association_list in association_dict.items():
+            for uid_sublist in split_list(uid_list, MAX_SQL_VARIABLES):
+                db.session.execute(association_class.__table__.delete().where(association_class.paper_uid.in_(uid_sublist)))
+            if association_list:
+                db.session.execute(association_class.__table__.insert(), association_list)
+        index_keywords(uid_list)
+
+    # Deletes a batch of Papers (and their associations) with bulk statements
+    @classmethod
+    def bulk_delete(cls, uid_list):
+        for uid_sublist in split_list(list(uid_list), MAX_SQL_VARIABLES):
+            for association_class in [PaperCreator, PaperInstitute, PaperDDC, PaperKeyword, PaperResourceType,
+                                      AnnotationQueueEntry, AnnotationLease]:
+                db.session.execute(association_class.__table__.delete().where(association_class.paper_uid.in_(uid_sublist)))
+            db.session.execute(cls.__table__.delete().where(cls.uid.in_(uid_sublist)))
+
+    # Sets the sustainable flag of a batch of Papers with bulk statements
+    @classmethod
+    def bulk_set_sustainable(cls, uid_list, sustainable):
+        for uid_sublist in split_list(list(uid_list), MAX_SQL_VARIABLES):
+            db.session.execute(cls.__table__.update().where(cls.uid.in_(uid_sublist)).values(sustainable=sustainable))
+
+    # Computes the digest of the normalized metadata of a paper. Two metadata dictionaries with the same values in the
+    # DIGEST_FIELDS (in any order within the lists) have the same digest.
+    @classmethod
+    def compute_digest(cls, metadata_dict):
+        normalized_dict = {}
+        for field in cls.DIGEST_FIELDS:
+            value = metadata_dict.get(field)
+            normalized_dict[field] = sorted(value) if isinstance(value, list) else value
+        normalized_string = json.dumps(normalized_dict, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(normalized_string.encode('utf-8')).hexdigest()
+
+    # Returns a dictionary {uid: digest} of the papers with the given uids that exist in the database
+    @classmethod
+    def get_digests(cls, uid_list):
+        digest_dict = {}
+        for uid_sublist in split_list(list(uid_list), MAX_SQL_VARIABLES):
+            for uid, digest in db.session.query(cls.uid, cls.digest).filter(cls.uid.in_(uid_sublist)):
+                digest_dict[uid] = digest
+        return digest_dict
+
+    # Parses the date of a paper. Zora has some invalid up dates (ex. 2009-11-31). If we encounter a invalid date, we
+    # return None.
+    @staticmethod
+    def parse_date(date_string):
+        if not date_string:
+            return None
+        try:
+            return dateutil.parser.parse(date_string, default=datetime(1970, 1, 1)).date()
+        except ValueError as error:
+            if is_debug():
+                print('Date "' + date_string + '" could not be parsed: ' + str(error))
+            return None
+
+    # Splits a creator name of ZORA ('last name, first name') into a tuple (first_name, last_name)
+    @staticmethod
+    def split_creator_name(creator_name):
+        split = creator_name.split(',')
+        last_name = split[0]
+        first_name = split[1] if len(split) >= 2 else None
+        return first_name, last_name
+
+    # Splits a dewey decimal classification of ZORA ('000 Computer science, ...') into a tuple (dewey_number, name)
+    @staticmethod
+    def split_ddc_string(ddc_string):
+        dewey_number, name = ddc_string.split(' ', 1)
+        return int(dewey_number), name
+
+    # Creates a html plot of how many sustainable papers were published each year. The counts are read from the year
+    # statistics (see YearStatistic).
     @classmethod
     def get_sustainable_papers_per_year(cls):
-        papers_per_year = db.session.query(func.strftime('%Y', cls.date), func.count(cls.uid)).filter(cls.sustainable == True).group_by(func.strftime('%Y', cls.date)).order_by(cls.date).all()
+        papers_per_year = YearStatistic.get_sustainable_papers_per_year()
         years = []
         counts = []
         current_year = papers_per_year[0][0]
@@ -198,6 +380,9 @@ class Creator(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     first_name = db.Column(db.String(64))
     last_name = db.Column(db.String(64))
+
+    # The creators are looked up by their last name (bulk_get_or_create) or by their full name (get_or_create)
+    __table_args__ = (db.Index('ix_creators_last_name_first_name', 'last_name', 'first_name'),)
     papers = db.relationship('Paper', secondary='paper_creator_association_table')
 
     def __init__(self, first_name, last_name):
@@ -213,10 +398,27 @@ class Creator(db.Model):
             db.session.add(creator)
         return creator
 
+    # Returns a dictionary {(first_name, last_name): id} for the given (first_name, last_name) tuples. Creators that
+    # don't exist yet are created.
+    @classmethod
+    def bulk_get_or_create(cls, names):
+        id_dict = {}
+        last_name_list = list({last_name for first_name, last_name in names})
+        for last_name_sublist in split_list(last_name_list, MAX_SQL_VARIABLES):
+            query = db.session.query(cls.id, cls.first_name, cls.last_name).filter(cls.last_name.in_(last_name_sublist))
+            for id_, first_name, last_name in query.order_by(cls.id.desc()):
+                id_dict[(first_name, last_name)] = id_
+        missing_name_list = [name for name in names if name not in id_dict]
+        if missing_name_list:
+            db.session.execute(cls.__table__.insert(), [{'first_name': first_name, 'last_name': last_name}
+                                                        for first_name, last_name in missing_name_list])
+            id_dict.update(cls.bulk_get_or_create(missing_name_list))
+        return id_dict
+
     # Returns a list of the top 10 creators of sustainable papers based on how many publications they made
     @classmethod
     def get_top10_authors(cls):
-        author_list = db.session.query(cls.first_name, cls.last_name, func.count(cls.id).label('count')).join(Paper, Creator.papers).filter(Paper.sustainable == True).group_by(cls.id).order_by('count DESC').limit(10).all()
+        author_list = EntityStatistic.get_top10(EntityStatistic.ENTITY_TYPE_CREATOR, cls.id, cls.first_name, cls.last_name)
         return author_list
 
 
@@ -229,14 +431,19 @@ class PaperCreator(db.Model):
     paper = db.relationship(Paper, backref=db.backref('paper_creator_association_table', cascade='all, delete-orphan'))
     creator = db.relationship(Creator, backref=db.backref('paper_creator_association_table', cascade='all, delete-orphan'))
 
+    # The associations are looked up from both sides: by paper (loading and replacing the associations of a paper)
+    # and by the associated entity (joins of the statistics and filters of the search)
+    __table_args__ = (db.Index('ix_paper_creator_association_table_paper_uid', 'paper_uid', 'creator_id'),
+                      db.Index('ix_paper_creator_association_table_creator_id', 'creator_id', 'paper_uid'))
+
 
 # The Institute table stores all institutes of the university of zurich. The institutes have a property children/parent
 # that contains all child/parent institutes.
 class Institute(db.Model):
     __tablename__ = 'institutes'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    name = db.Column(db.String(256))
-    parent_id = db.Column(db.Integer, db.ForeignKey('institutes.id'))
+    name = db.Column(db.String(256), index=True)
+    parent_id = db.Column(db.Integer, db.ForeignKey('institutes.id'), index=True)
     children = db.relationship('Institute', backref=db.backref('parent', remote_side=id))
     papers = db.relationship('Paper', secondary='paper_institute_association_table')
 
@@ -252,10 +459,15 @@ class Institute(db.Model):
             db.session.add(institute)
         return institute
 
+    # Returns a dictionary {name: id} for the given names. Names that don't exist yet are created.
+    @classmethod
+    def bulk_get_or_create(cls, names):
+        return get_or_create_ids_by_name(cls, names)
+
     # Returns a list of the top 10 institutes based on how many sustainable papers were published from that institute
     @classmethod
     def get_top10_institutes(cls):
-        institute_list = db.session.query(cls.name, func.count(cls.id).label('count')).join(Paper, Institute.papers).filter(Paper.sustainable == True).group_by(cls.id).order_by('count DESC').limit(10).all()
+        institute_list = EntityStatistic.get_top10(EntityStatistic.ENTITY_TYPE_INSTITUTE, cls.id, cls.name)
         return institute_list
 
 
@@ -268,6 +480,10 @@ class PaperInstitute(db.Model):
     paper = db.relationship(Paper, backref=db.backref('paper_institute_association_table', cascade='all, delete-orphan'))
     institute = db.relationship(Institute, backref=db.backref('paper_institute_association_table', cascade='all, delete-orphan'))
 
+    # The associations are looked up from both sides (see PaperCreator)
+    __table_args__ = (db.Index('ix_paper_institute_association_table_paper_uid', 'paper_uid', 'institute_id'),
+                      db.Index('ix_paper_institute_association_table_institute_id', 'institute_id', 'paper_uid'))
+
 
 # The Dewey Decimal Classifications table stores the different DDCs that were used in the papers. A DDC consists of a
 # dewey_number and a name (ex. '000 Computer science, innformation & general works')
@@ -290,10 +506,25 @@ class DDC(db.Model):
             db.session.add(ddc)
         return ddc
 
+    # Returns a dictionary {(dewey_number, name): dewey_number} for the given (dewey_number, name) tuples. DDCs that
+    # don't exist yet are created.
+    @classmethod
+    def bulk_get_or_create(cls, ddcs):
+        existing_number_set = set()
+        number_list = list({dewey_number for dewey_number, name in ddcs})
+        for number_sublist in split_list(number_list, MAX_SQL_VARIABLES):
+            for dewey_number, in db.session.query(cls.dewey_number).filter(cls.dewey_number.in_(number_sublist)):
+                existing_number_set.add(dewey_number)
+        missing_ddc_dict = {dewey_number: name for dewey_number, name in ddcs if dewey_number not in existing_number_set}
+        if missing_ddc_dict:
+            db.session.execute(cls.__table__.insert(), [{'dewey_number': dewey_number, 'name': name}
+                                                        for dewey_number, name in missing_ddc_dict.items()])
+        return {(dewey_number, name): dewey_number for dewey_number, name in ddcs}
+
     # Returns the top 10 ddcs based on how many sustainable papers got published in that area
     @classmethod
     def get_top10_ddcs(cls):
-        ddc_list = db.session.query(cls.dewey_number, cls.name, func.count(cls.id).label('count')).join(Paper, DDC.papers).filter(Paper.sustainable == True).group_by(cls.id).order_by('count DESC').limit(10).all()
+        ddc_list = EntityStatistic.get_top10(EntityStatistic.ENTITY_TYPE_DDC, cls.dewey_number, cls.dewey_number, cls.name)
         return ddc_list
 
 
@@ -306,6 +537,10 @@ class PaperDDC(db.Model):
     paper = db.relationship(Paper, backref=db.backref('paper_ddc_association_table', cascade='all, delete-orphan'))
     ddc = db.relationship(DDC, backref=db.backref('paper_ddc_association_table', cascade='all, delete-orphan'))
 
+    # The associations are looked up from both sides (see PaperCreator)
+    __table_args__ = (db.Index('ix_paper_ddc_association_table_paper_uid', 'paper_uid', 'ddc_dewey_number'),
+                      db.Index('ix_paper_ddc_association_table_ddc_dewey_number', 'ddc_dewey_number', 'paper_uid'))
+
 
 # The Keyword table contains all keywords that are used in the papers.
 # NOTE: Some keywords that ZORA provides are not comma separated. Those will be stored as one single expression.
@@ -327,10 +562,15 @@ class Keyword(db.Model):
             db.session.add(keyword)
         return keyword
 
+    # Returns a dictionary {name: id} for the given names. Names that don't exist yet are created.
+    @classmethod
+    def bulk_get_or_create(cls, names):
+        return get_or_create_ids_by_name(cls, names)
+
     # Returns the top 10 keywords that were used in sustainable papers
     @classmethod
     def get_top10_keywords(cls):
-        keyword_list = db.session.query(cls.name, func.count(cls.id).label('count')).join(Paper, Keyword.papers).filter(Paper.sustainable == True).group_by(cls.id).order_by('count DESC').limit(10).all()
+        keyword_list = EntityStatistic.get_top10(EntityStatistic.ENTITY_TYPE_KEYWORD, cls.id, cls.name)
         return keyword_list
 
 
@@ -343,12 +583,16 @@ class PaperKeyword(db.Model):
     paper = db.relationship(Paper, backref=db.backref('paper_keyword_association_table', cascade='all, delete-orphan'))
     keyword = db.relationship(Keyword, backref=db.backref('paper_keyword_association_table', cascade='all, delete-orphan'))
 
+    # The associations are looked up from both sides (see PaperCreator)
+    __table_args__ = (db.Index('ix_paper_keyword_association_table_paper_uid', 'paper_uid', 'keyword_id'),
+                      db.Index('ix_paper_keyword_association_table_keyword_id', 'keyword_id', 'paper_uid'))
+
 
 # The Publisher table stores all publishers of the papers
 class Publisher(db.Model):
     __tablename__ = 'publishers'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    name = db.Column(db.String(256))
+    name = db.Column(db.String(256), index=True)
 
     def __init__(self, name):
         self.name = name
@@ -362,12 +606,17 @@ class Publisher(db.Model):
             db.session.add(publisher)
         return publisher
 
+    # Returns a dictionary {name: id} for the given names. Names that don't exist yet are created.
+    @classmethod
+    def bulk_get_or_create(cls, names):
+        return get_or_create_ids_by_name(cls, names)
+
 
 # The ResourceType table stores all the different types that the papers can be (Journal, Paper, etc.)
 class ResourceType(db.Model):
     __tablename__ = 'resource_types'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    name = db.Column(db.String(64))
+    name = db.Column(db.String(64), index=True)
     papers = db.relationship('Paper', secondary='paper_resource_type_association_table')
 
     def __init__(self, name):
@@ -382,6 +631,11 @@ class ResourceType(db.Model):
             db.session.add(resource_type)
         return resource_type
 
+    # Returns a dictionary {name: id} for the given names. Names that don't exist yet are created.
+    @classmethod
+    def bulk_get_or_create(cls, names):
+        return get_or_create_ids_by_name(cls, names)
+
 
 # Relational table that stores the association information between Paper(s) and ResourceType(s)
 class PaperResourceType(db.Model):
@@ -392,12 +646,16 @@ class PaperResourceType(db.Model):
     paper = db.relationship(Paper, backref=db.backref('paper_resource_type_association_table', cascade='all, delete-orphan'))
     resource_type = db.relationship(ResourceType, backref=db.backref('paper_resource_type_association_table', cascade='all, delete-orphan'))
 
+    # The associations are looked up from both sides (see PaperCreator)
+    __table_args__ = (db.Index('ix_paper_resource_type_association_table_paper_uid', 'paper_uid', 'resource_type_id'),
+                      db.Index('ix_paper_resource_type_association_table_resource_type_id', 'resource_type_id', 'paper_uid'))
+
 
 # The Language table stores the languages in which the papers are written
 class Language(db.Model):
     __tablename__ = 'languages'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    name = db.Column(db.String(64))
+    name = db.Column(db.String(64), index=True)
 
     def __init__(self, name):
         self.name = name
@@ -411,6 +669,172 @@ class Language(db.Model):
             db.session.add(language)
         return language
 
+    # Returns a dictionary {name: id} for the given names. Names that don't exist yet are created.
+    @classmethod
+    def bulk_get_or_create(cls, names):
+        return get_or_create_ids_by_name(cls, names)
+
+
+# The YearStatistic table stores the amount of papers and sustainable papers per publishing year, so that the dashboard
+# doesn't have to count the papers. The table is maintained by triggers on the papers table (see
+# migrations.create_statistics_triggers), so it stays up to date with every ZORA pull, annotation and reclassification.
+# year:                 The publishing year ('YYYY')
+# paper_count:          The amount of papers that were published in the year
+# sustainable_count:    The amount of sustainable papers that were published in the year
+class YearStatistic(db.Model):
+    __tablename__ = 'year_statistics'
+    year = db.Column(db.String(4), primary_key=True)
+    paper_count = db.Column(db.Integer, nullable=False, default=0)
+    sustainable_count = db.Column(db.Integer, nullable=False, default=0)
+
+    # Returns a list of (year, amount of sustainable papers) of the years with sustainable papers, ordered by year
+    @classmethod
+    def get_sustainable_papers_per_year(cls):
+        return db.session.query(cls.year, cls.sustainable_count).filter(cls.sustainable_count > 0).order_by(cls.year).all()
+
+    # Computes the statistics again from the papers
+    @classmethod
+    def rebuild(cls):
+        db.session.execute('DELETE FROM ' + cls.__tablename__)
+        db.session.execute('INSERT INTO ' + cls.__tablename__ + ' (year, paper_count, sustainable_count) '
+                           "SELECT strftime('%Y', date), COUNT(*), SUM(sustainable IS 1) FROM papers "
+                           "WHERE strftime('%Y', date) IS NOT NULL GROUP BY strftime('%Y', date)")
+
+
+# The EntityStatistic table stores the amount of sustainable papers per creator, institute, ddc and keyword, so that the
+# top 10 lists are read from the index instead of joining all sustainable papers. Like the papers, an entity is counted
+# once per association. The table is maintained by triggers on the papers and the association tables (see
+# migrations.create_statistics_triggers). Entities only get a row once they are associated with a sustainable paper.
+# entity_type:          The type of the entity ('creator', 'institute', 'ddc' or 'keyword')
+# entity_id:            The id of the entity (the dewey number for ddcs)
+# sustainable_count:    The amount of sustainable papers of the entity
+class EntityStatistic(db.Model):
+    __tablename__ = 'entity_statistics'
+    entity_type = db.Column(db.String(16), primary_key=True)
+    entity_id = db.Column(db.Integer, primary_key=True)
+    sustainable_count = db.Column(db.Integer, nullable=False, default=0)
+
+    # The top 10 lists read the entities of a type ordered by their count
+    __table_args__ = (db.Index('ix_entity_statistics_entity_type_sustainable_count', 'entity_type', 'sustainable_count'),)
+
+    ENTITY_TYPE_CREATOR = 'creator'
+    ENTITY_TYPE_INSTITUTE = 'institute'
+    ENTITY_TYPE_DDC = 'ddc'
+    ENTITY_TYPE_KEYWORD = 'keyword'
+
+    # The association table and its entity column of every entity type
+    ENTITY_ASSOCIATIONS = [(ENTITY_TYPE_CREATOR, PaperCreator.__table__.name, 'creator_id'),
+                           (ENTITY_TYPE_INSTITUTE, PaperInstitute.__table__.name, 'institute_id'),
+                           (ENTITY_TYPE_DDC, PaperDDC.__table__.name, 'ddc_dewey_number'),
+                           (ENTITY_TYPE_KEYWORD, PaperKeyword.__table__.name, 'keyword_id')]
+
+    # Returns the given columns and the count ('count') of the 10 entities of a type with the most sustainable papers
+    @classmethod
+    def get_top10(cls, entity_type, entity_id_column, *columns):
+        return db.session.query(*columns, cls.sustainable_count.label('count'))\
+            .select_from(cls)\
+            .join(entity_id_column.class_, entity_id_column == cls.entity_id)\
+            .filter(cls.entity_type == entity_type, cls.sustainable_count > 0)\
+            .order_by(cls.sustainable_count.desc())\
+            .limit(10)\
+            .all()
+
+    # Computes the statistics again from the papers and their associations
+    @classmethod
+    def rebuild(cls):
+        db.session.execute('DELETE FROM ' + cls.__tablename__)
+        for entity_type, association_table, entity_column in cls.ENTITY_ASSOCIATIONS:
+            db.session.execute('INSERT INTO ' + cls.__tablename__ + ' (entity_type, entity_id, sustainable_count) '
+                               "SELECT '" + entity_type + "', a." + entity_column + ', COUNT(*) '
+                               'FROM ' + association_table + ' a JOIN papers p ON p.uid = a.paper_uid '
+                               'WHERE p.sustainable IS 1 AND a.' + entity_column + ' IS NOT NULL '
+                               'GROUP BY a.' + entity_column)
+
+
+# The AnnotationQueueEntry table contains the papers that are handed out for annotation next. The papers are handed out
+# in the order of the ids of their entries, so the next paper is found with the primary key index. The queue is filled
+# in the background (see ServerLogic.refill_annotation_queue).
+class AnnotationQueueEntry(db.Model):
+    __tablename__ = 'annotation_queue'
+    id = db.Column(db.Integer, primary_key=True)
+    paper_uid = db.Column(db.String(256), db.ForeignKey('papers.uid'), nullable=False, unique=True)
+
+    # Method that defines how an object of this class is printed. Useful for debugging.
+    def __repr__(self):
+        return str(self.id) + ': ' + self.paper_uid
+
+    # Removes the first entry from the queue and returns its paper uid, or None if the queue is empty. The entry is
+    # removed with a DELETE of its id, so if another process takes the same entry at the same time, only one of them
+    # gets it and the other one takes the next entry.
+    @classmethod
+    def dequeue(cls):
+        while True:
+            entry = db.session.query(cls.id, cls.paper_uid).order_by(cls.id).first()
+            if not entry:
+                return None
+            result = db.session.execute(cls.__table__.delete().where(cls.id == entry.id))
+            if result.rowcount == 1:
+                return entry.paper_uid
+
+    # Returns the uids of all papers in the queue
+    @classmethod
+    def get_paper_uids(cls):
+        return {paper_uid for paper_uid, in db.session.query(cls.paper_uid)}
+
+    # Appends the papers with the given uids to the queue (in the given order). If replace is True, the queue is cleared
+    # first.
+    @classmethod
+    def enqueue(cls, uid_list, replace=False):
+        if replace:
+            db.session.execute(cls.__table__.delete())
+        if uid_list:
+            db.session.execute(cls.__table__.insert(), [{'paper_uid': uid} for uid in uid_list])
+
+
+# The AnnotationLease table contains the papers that are currently being annotated. A paper is leased until the lease
+# expires (expires_at), so that it is not handed out twice, even by different server processes. The leases are claimed
+# and released with conditional statements, so that only one process succeeds. Expired leases are removed
+# periodically (see ServerLogic.reap_annotation_leases).
+class AnnotationLease(db.Model):
+    __tablename__ = 'annotation_leases'
+    paper_uid = db.Column(db.String(256), db.ForeignKey('papers.uid'), primary_key=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    # Method that defines how an object of this class is printed. Useful for debugging.
+    def __repr__(self):
+        return self.paper_uid + ': ' + str(self.expires_at)
+
+    # Claims the lease of a paper until expires_at. Returns True if the paper was not leased (or the lease expired),
+    # otherwise False.
+    @classmethod
+    def claim(cls, uid, expires_at, now):
+        result = db.session.execute(cls.__table__.insert().prefix_with('OR IGNORE').values(paper_uid=uid,
+                                                                                           expires_at=expires_at))
+        if result.rowcount == 1:
+            return True
+
+        # There is a lease already, which we only take over if it expired
+        result = db.session.execute(cls.__table__.update()
+                                    .where(and_(cls.paper_uid == uid, cls.expires_at < now))
+                                    .values(expires_at=expires_at))
+        return result.rowcount == 1
+
+    # Releases the lease of a paper. Returns True if the paper was leased and the lease did not expire, otherwise False.
+    @classmethod
+    def release(cls, uid, now):
+        result = db.session.execute(cls.__table__.delete().where(and_(cls.paper_uid == uid, cls.expires_at >= now)))
+        return result.rowcount == 1
+
+    # Removes all expired leases and returns their amount
+    @classmethod
+    def reap(cls, now):
+        return db.session.execute(cls.__table__.delete().where(cls.expires_at < now)).rowcount
+
+    # Returns a query of the uids of the papers that are leased at the moment
+    @classmethod
+    def get_leased_paper_uids_query(cls, now):
+        return db.session.query(cls.paper_uid).filter(cls.expires_at >= now)
+
 
 # The ServerSetting table stores the different settings of the GreenZora server that can be changed manually:
 # annotation_timeout:               The annotation timeout in minutes (int)
@@ -418,6 +842,10 @@ class Language(db.Model):
 # resource_type_update_interval:    The interval in days after which the resource types should be updated (int)
 # zora_url:                         The base URL for requests to the zora API (string)
 # zora_pull_interval:               The amount of days between different ZORA repository pulls (int)
+# zora_pull_chunk_size:             The amount of papers that are stored and committed together during a pull (int)
+# zora_parse_workers:               The amount of processes that parse records during a pull, 0 to parse inline (int)
+# zora_pull_partitions:             The amount of threads that harvest partitions of a full pull, 0 to not split it (int)
+# zora_pull_partition_mode:         How a full pull is split into partitions, 'dates' or 'sets' (string)
 class ServerSetting(db.Model):
     __tablename__ = 'settings'
     name = db.Column(db.String(64), primary_key=True)                     # The name of the setting
@@ -451,6 +879,15 @@ class ServerSetting(db.Model):
 # database_initialized:         Flag that indicates whether the database is already initialized or not (bool)
 # last_zora_pull:               Timestamp of the date, when the last pull from ZORA was done (datetime)
 # legacy_annotations_imported:  Flag that indicates whether the legacy annotations are already initialized or not (bool)
+# zora_pull_started:            Timestamp of the start of the current ZORA pull, if one is running or interrupted (datetime)
+# zora_pull_resumption_token:   Resumption token of the next chunk of the current ZORA pull, if there is one (string)
+# zora_pull_committed_chunks:   The amount of chunks of the current ZORA pull that are stored already (int)
+# schema_version:               The amount of schema migrations that are applied to the database (int, see migrations.py)
+# annotation_queue_model:       The fingerprint of the model the annotation queue was last filled with (string)
+# ml_model_fingerprint:         The fingerprint of the saved model that is in use (string)
+# ml_previous_model_fingerprint: The fingerprint of the saved model a rollback restores, if there is one (string)
+# ml_model_pinned:              Flag that indicates whether the model in use was restored by a rollback and is kept
+#                               until the next training, even if annotations were made since (bool)
 class OperationParameter(db.Model):
     __tablename__ = 'operation_parameters'
     name = db.Column(db.String(64), primary_key=True)                     # The name of the parameter
@@ -556,12 +993,34 @@ def load_user(user_id):
 # ------------ END DATABASE MODELS ---------------
 
 
+# ------------ HELPER FUNCTIONS ---------------
+
+# Returns a dictionary {name: id} for the given names of a table with an id and a name column (e.g. Keyword). Names that
+# don't exist yet are inserted with one executemany statement. If a name exists more than once, the oldest entry is
+# used (like get_or_create does).
+def get_or_create_ids_by_name(cls, names):
+    id_dict = {}
+    for name_sublist in split_list(list(names), MAX_SQL_VARIABLES):
+        for id_, name in db.session.query(cls.id, cls.name).filter(cls.name.in_(name_sublist)).order_by(cls.id.desc()):
+            id_dict[name] = id_
+    missing_name_list = [name for name in names if name not in id_dict]
+    if missing_name_list:
+        db.session.execute(cls.__table__.insert(), [{'name': name} for name in missing_name_list])
+        id_dict.update(get_or_create_ids_by_name(cls, missing_name_list))
+    return id_dict
+
+# ------------ END HELPER FUNCTIONS ---------------
+
+
 # ------------ INITIALIZE DATABASE ---------------
 
 # This function initializes the database by creating it (if necessary) and the default types, settings and
 # operation parameters
 def initialize_db():
 
+    # NOTE: This import is not at the top of the file to avoid circular imports (the migrations need the models)
+    from greenzora.migrations import initialize_schema, migrate_schema
+
     # Create the database tables if they don't already exist
     db.create_all()
 
@@ -569,6 +1028,12 @@ def initialize_db():
     database_initialized = OperationParameter.get('database_initialized')
     if database_initialized:
         print('Database already initialized')
+
+        # Add the settings and operation parameters that were introduced after the database was initialized, then
+        # apply the changes of the existing tables (see migrations.py)
+        initialize_default_settings()
+        initialize_operation_parameters()
+        migrate_schema()
         return
 
         # Initialize the default types
@@ -591,7 +1056,9 @@ def initialize_db():
     if is_debug():
         print('Default users initialized')
 
-    # Remember that the database was initialized
+    # Create the triggers and the search table of the current schema (the new tables already have it), so that no
+    # migration is applied, then remember that the database was initialized
+    initialize_schema()
     OperationParameter.set('database_initialized', True)
     db.session.commit()
 
@@ -607,25 +1074,45 @@ def initialize_types():
     db.session.commit()
 
 
-# Initializes the default settings
+# Initializes the default settings. Settings that already exist are not changed.
 def initialize_default_settings():
     type_string = db.session.query(Type).get('string')
     type_int = db.session.query(Type).get('int')
-    db.session.add(ServerSetting(name='annotation_timeout', value=server_app.config['DEFAULT_ANNOTATION_TIMEOUT'], type=type_int))
-    db.session.add(ServerSetting(name='institute_update_interval', value=server_app.config['DEFAULT_INSTITUTE_UPDATE_INTERVAL'], type=type_int))
-    db.session.add(ServerSetting(name='resource_type_update_interval', value=server_app.config['DEFAULT_RESOURCE_TYPE_UPDATE_INTERVAL'], type=type_int))
-    db.session.add(ServerSetting(name='zora_pull_interval', value=server_app.config['DEFAULT_ZORA_PULL_INTERVAL'], type=type_int))
-    db.session.add(ServerSetting(name='zora_url', value=server_app.config['DEFAULT_ZORA_URL'], type=type_string))
+    default_settings = [('annotation_timeout', server_app.config['DEFAULT_ANNOTATION_TIMEOUT'], type_int),
+                        ('institute_update_interval', server_app.config['DEFAULT_INSTITUTE_UPDATE_INTERVAL'], type_int),
+                        ('resource_type_update_interval', server_app.config['DEFAULT_RESOURCE_TYPE_UPDATE_INTERVAL'], type_int),
+                        ('zora_pull_interval', server_app.config['DEFAULT_ZORA_PULL_INTERVAL'], type_int),
+                        ('zora_url', server_app.config['DEFAULT_ZORA_URL'], type_string),
+                        ('zora_pull_chunk_size', server_app.config['DEFAULT_ZORA_PULL_CHUNK_SIZE'], type_int),
+                        ('zora_parse_workers', server_app.config['DEFAULT_ZORA_PARSE_WORKERS'], type_int),
+                        ('zora_pull_partitions', server_app.config['DEFAULT_ZORA_PULL_PARTITIONS'], type_int),
+                        ('zora_pull_partition_mode', server_app.config['DEFAULT_ZORA_PULL_PARTITION_MODE'], type_string)]
+    for name, value, type_ in default_settings:
+        if not db.session.query(ServerSetting).get(name):
+            db.session.add(ServerSetting(name=name, value=value, type=type_))
     db.session.commit()
 
 
-# Initializes the operation_parameters
+# Initializes the operation_parameters. Operation parameters that already exist are not changed.
 def initialize_operation_parameters():
     type_datetime = db.session.query(Type).get('datetime')
     type_boolean = db.session.query(Type).get('boolean')
-    db.session.add(OperationParameter(name='database_initialized', value=False, type=type_boolean))
-    db.session.add(OperationParameter(name='last_zora_pull', type=type_datetime))
-    db.session.add(OperationParameter(name='legacy_annotations_imported', value=False, type=type_boolean))
+    type_string = db.session.query(Type).get('string')
+    type_int = db.session.query(Type).get('int')
+    operation_parameters = [('database_initialized', False, type_boolean),
+                            ('last_zora_pull', None, type_datetime),
+                            ('legacy_annotations_imported', False, type_boolean),
+                            ('zora_pull_started', None, type_datetime),
+                            ('zora_pull_resumption_token', None, type_string),
+                            ('zora_pull_committed_chunks', 0, type_int),
+                            ('schema_version', 0, type_int),
+                            ('annotation_queue_model', None, type_string),
+                            ('ml_model_fingerprint', None, type_string),
+                            ('ml_previous_model_fingerprint', None, type_string),
+                            ('ml_model_pinned', False, type_boolean)]
+    for name, value, type_ in operation_parameters:
+        if not db.session.query(OperationParameter).get(name):
+            db.session.add(OperationParameter(name=name, value=value, type=type_))
     db.session.commit()
 
 
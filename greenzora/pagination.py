@@ -0,0 +1,118 @@
+import base64
+import binascii
+import json
+from datetime import date, datetime
+
+from greenzora import server_app
+
+# The result pages of the papers. The pages are paginated with keyset cursors instead of offsets: the papers are sorted
+# by a column (e.g. the date) and their uid, and a page starts after the sort values of the last paper of the previous
+# page. The database finds the start of a page in the index of the sort column, so every page costs the same, no matter
+# how far back it is, and a paper that is added or removed meanwhile doesn't shift the following pages.
+#
+# The papers without a value in the sort column (e.g. without a date) come last, in the order of their uid, in both
+# sort directions. They are read with a separate query, so that the query of the other papers is a range of the index.
+#
+# The total count of the papers is only counted for the first page and is passed on in the cursors.
+#
+# The ranks of a full-text search are not stable: every write to the search index (e.g. a pull) changes the bm25 scores
+# of all papers, so the rank in a cursor can't be compared with the ranks of a later request. For such volatile sort
+# columns, the following pages start after the current sort value of the last paper of the previous page, which is read
+# again with the page (the value in the cursor is only used if the paper doesn't match anymore). A page then continues
+# where the previous page stopped, but a paper whose rank moved past the last paper meanwhile is shown twice or not at
+# all, so the pages of a search are only consistent as long as the search index doesn't change.
+
+
+# A page of papers. The rows are the papers or, if extra columns were requested, tuples of a paper and the values of the
+# extra columns. next_cursor is None on the last page.
+class Page:
+
+    def __init__(self, rows, next_cursor, total_count):
+        self.rows = rows
+        self.next_cursor = next_cursor
+        self.total_count = total_count
+
+
+# Returns the page size of a request, which is limited to RESULTS_MAX_PAGE_SIZE. Invalid page sizes raise a ValueError.
+def get_page_size(page_size_string):
+    if not page_size_string:
+        return server_app.config['RESULTS_PAGE_SIZE']
+    page_size = int(page_size_string)
+    if page_size < 1:
+        raise ValueError('Invalid page size: ' + page_size_string)
+    return min(page_size, server_app.config['RESULTS_MAX_PAGE_SIZE'])
+
+
+# Encodes the sort values of the last paper of a page and the total count as a URL safe cursor
+def encode_cursor(sort_value, uid, total_count):
+    if isinstance(sort_value, (date, datetime)):
+        sort_value = sort_value.isoformat()
+    cursor_json = json.dumps([sort_value, uid, total_count])
+    return base64.urlsafe_b64encode(cursor_json.encode('utf-8')).decode('ascii')
+
+
+# Decodes a cursor into the sort value (with the type of the sort column), the uid and the total count. Invalid cursors
+# raise a ValueError.
+def decode_cursor(cursor, sort_column):
+    try:
+        sort_value, uid, total_count = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (binascii.Error, UnicodeError, TypeError, ValueError):
+        raise ValueError('Invalid cursor: ' + cursor)
+    if sort_value is not None and sort_column.type.python_type is date:
+        sort_value = datetime.strptime(sort_value, '%Y-%m-%d').date()
+    return sort_value, uid, total_count
+
+
+# Returns the condition of the rows that come after the sort value and the uid in the order of the page
+def get_after_condition(sort_column, sort_value, uid_column, uid, descending):
+    if descending:
+        return (sort_column <= sort_value) & ((sort_column < sort_value) | (uid_column < uid))
+    return (sort_column >= sort_value) & ((sort_column > sort_value) | (uid_column > uid))
+
+
+# Returns the page of a query of papers that starts after the cursor (or the first page if the cursor is None). The
+# papers are sorted by sort_column and uid_column (the uid of the papers), both ascending or both descending. The extra
+# columns (e.g. the snippets of a search) are returned with the papers. If the values of the sort column change between
+# requests (volatile_sort, e.g. the ranks of a search), the sort value of the cursor is read again. Invalid cursors raise
+# a ValueError.
+def paginate(query, sort_column, uid_column, cursor=None, page_size=None, descending=True, extra_columns=(),
+             volatile_sort=False):
+    page_size = page_size or server_app.config['RESULTS_PAGE_SIZE']
+    if cursor:
+        sort_value, uid, total_count = decode_cursor(cursor, sort_column)
+        if volatile_sort:
+            current_row = query.with_entities(sort_column).filter(uid_column == uid).order_by(None).first()
+            if current_row is not None:
+                sort_value = current_row[0]
+    else:
+        sort_value = uid = None
+        total_count = query.order_by(None).count()
+
+    def fetch(page_query, order_by_list, limit):
+        page_query = page_query.add_columns(sort_column, uid_column, *extra_columns)
+        if descending:
+            order_by_list = [column.desc() for column in order_by_list]
+        return page_query.order_by(None).order_by(*order_by_list).limit(limit).all()
+
+    # Fetch one paper more than the page size to find out if there is a next page
+    row_list = []
+    if not cursor or sort_value is not None:
+        value_query = query.filter(sort_column.isnot(None))
+        if cursor:
+            value_query = value_query.filter(get_after_condition(sort_column, sort_value, uid_column, uid, descending))
+        row_list = fetch(value_query, [sort_column, uid_column], page_size + 1)
+    if len(row_list) <= page_size:
+        null_query = query.filter(sort_column.is_(None))
+        if cursor and sort_value is None:
+            null_query = null_query.filter(uid_column < uid if descending else uid_column > uid)
+        row_list += fetch(null_query, [uid_column], page_size + 1 - len(row_list))
+
+    next_cursor = None
+    if len(row_list) > page_size:
+        row_list = row_list[:page_size]
+        next_cursor = encode_cursor(row_list[-1][1], row_list[-1][2], total_count)
+    if extra_columns:
+        rows = [(row[0],) + tuple(row[3:]) for row in row_list]
+    else:
+        rows = [row[0] for row in row_list]
+    return Page(rows, next_cursor, total_count)
@@ -1,11 +1,15 @@
-from flask import jsonify, redirect, url_for, flash, render_template, request
+from flask import abort, jsonify, redirect, url_for, flash, render_template, request
 from greenzora import db, server_app, models
+from greenzora.database import read_session
 from greenzora.models import Paper, ServerSetting, User
+from greenzora.pagination import get_page_size, paginate
+from greenzora.search import search_papers, highlight_snippet
+from greenzora.utils import login_required
 from flask_login import current_user, login_user, logout_user
 import sqlite3
 import jinja2
-from sqlalchemy import extract
-from datetime import datetime
+from sqlalchemy.orm import joinedload, selectinload
+from datetime import date, datetime
 from flask_wtf import FlaskForm
 from wtforms import validators, StringField, PasswordField, BooleanField, SubmitField
 from flask_login import LoginManager
@@ -13,6 +17,10 @@ from flask_login import LoginManager
 login_manager = LoginManager()
 login_manager.init_app(server_app)
 
+# The fields of the search form, only these are read from the request and passed on to the following result pages
+SEARCH_FIELDS = ['text_select', 'title_select', 'description_select', 'creator_select', 'keyword_select',
+                 'language_select', 'ddc_select', 'date_min', 'date_max']
+
 #@login_manager.user_loader()
 #def load_user(user_id):
     #return User.get(user_id)
@@ -58,30 +66,32 @@ def test():
 @server_app.route('/')
 @server_app.route('/index')
 def index():
-    all_sustainable = db.session.query(Paper).filter(Paper.sustainable== True).all()
-
-    allp = db.session.query(Paper)
-
-    alt_sust = allp.filter(Paper.sustainable == True).all()
-
-    return render_template('start.html', rows=alt_sust)
+    # The newest sustainable papers, one page at a time (see pagination.py)
+    sustainable_papers = read_session.query(Paper).filter(Paper.sustainable == True)
+    try:
+        page_size = get_page_size(request.args.get('page_size'))
+        page = paginate(sustainable_papers, Paper.date, Paper.uid, request.args.get('cursor'), page_size)
+    except ValueError:
+        abort(400)
+    next_url = url_for('index', cursor=page.next_cursor, page_size=page_size) if page.next_cursor else None
+    return render_template('start.html', rows=page.rows, total_count=page.total_count, next_url=next_url)
 
 @server_app.route('/form')
 def form():
 
-    all_sustainable_papers = db.session.query(Paper).filter(Paper.sustainable == True).all()
+    all_sustainable_papers = read_session.query(Paper).filter(Paper.sustainable == True).all()
 
-    all_sustainable_paper_creators = db.session.query(models.PaperCreator).filter(models.PaperCreator.paper_uid.in_([paper.uid for paper in all_sustainable_papers])).all()
-    creators = db.session.query(models.Creator).filter(models.Creator.id.in_([c.creator_id for c in all_sustainable_paper_creators])).all()
+    all_sustainable_paper_creators = read_session.query(models.PaperCreator).filter(models.PaperCreator.paper_uid.in_([paper.uid for paper in all_sustainable_papers])).all()
+    creators = read_session.query(models.Creator).filter(models.Creator.id.in_([c.creator_id for c in all_sustainable_paper_creators])).all()
 
     #creators = db.session.query(Paper.creators).filter(Paper.sustainable == True).all()
 
-    all_sustainable_paper_keywords = db.session.query(models.PaperKeyword).filter(models.PaperKeyword.paper_uid.in_([paper.uid for paper in all_sustainable_papers])).all()
-    keywords = db.session.query(models.Keyword).filter(models.Keyword.id.in_([k.keyword_id for k in all_sustainable_paper_keywords])).all()
+    all_sustainable_paper_keywords = read_session.query(models.PaperKeyword).filter(models.PaperKeyword.paper_uid.in_([paper.uid for paper in all_sustainable_papers])).all()
+    keywords = read_session.query(models.Keyword).filter(models.Keyword.id.in_([k.keyword_id for k in all_sustainable_paper_keywords])).all()
 
-    languages = db.session.query(models.Language)
+    languages = read_session.query(models.Language)
 
-    ddcs = db.session.query(models.DDC)
+    ddcs = read_session.query(models.DDC)
     return render_template('searchlist.html', creators=creators, keywords=keywords, languages=languages, ddcs=ddcs)
 
 
@@ -91,58 +101,87 @@ def results():
         creator_select = request.form['creator_select']
         print('creator_select selected')
         print(request.form)
-    papers = db.session.query(Paper).filter(Paper.creators.id == creator_select)
+    papers = read_session.query(Paper).filter(Paper.creators.id == creator_select)
 
 
-    paperCreators = db.session.query(models.PaperCreator).filter(models.PaperCreator.creator_id == creator_select).all()
-    papers = db.session.query(Paper).filter(Paper.uid.in_([p.paper_uid for p in paperCreators])).filter(Paper.sustainable == True).all()
+    paperCreators = read_session.query(models.PaperCreator).filter(models.PaperCreator.creator_id == creator_select).all()
+    papers = read_session.query(Paper).filter(Paper.uid.in_([p.paper_uid for p in paperCreators])).filter(Paper.sustainable == True).all()
 
-    paperKeywords = db.session.query(models.PaperKeyword).filter(models.PaperKeyword.paper_uid.in_([p.uid for p in papers]))
-    keywords = db.session.query(models.Keyword).filter(models.Keyword.id.in_([k.keyword_id for k in paperKeywords]))
+    paperKeywords = read_session.query(models.PaperKeyword).filter(models.PaperKeyword.paper_uid.in_([p.uid for p in papers]))
+    keywords = read_session.query(models.Keyword).filter(models.Keyword.id.in_([k.keyword_id for k in paperKeywords]))
     return render_template('results.html', papers=papers, keywords=keywords)
 
 
 @server_app.route('/sresults', methods=['GET', 'POST'])
 def sresults():
     filter_criteria = dict([('title', 'search'), ('creator', 'drop'), ('description', 'search'), ('date', 'range'), ('language', 'drop'), ('ddc', 'drop'), ('keyword', 'drop')])
-    matching_papers = db.session.query(Paper).filter(Paper.sustainable == True)
-    if request.method == 'POST':
-        if 'title_select' in request.form:
-            if not request.form['title_select'] == '':
-                title_select = request.form['title_select']
-                matching_papers = matching_papers.filter(Paper.title.contains(title_select))
-        if 'creator_select' in request.form:
-            if not request.form['creator_select'] == '':
-                creator_select = request.form['creator_select']
-                paperCreators = db.session.query(models.PaperCreator).filter(
-                    models.PaperCreator.creator_id == creator_select).all()
-                matching_papers = matching_papers.filter(Paper.uid.in_([p.paper_uid for p in paperCreators]))
-        if 'keyword_select' in request.form:
-            if not request.form['keyword_select'] == '':
-                keyword_select = request.form['keyword_select']
-                paperKeywords = db.session.query(models.PaperKeyword).filter(
-                    models.PaperKeyword.keyword_id == keyword_select).all()
-                matching_papers = matching_papers.filter(Paper.uid.in_([p.paper_uid for p in paperKeywords]))
-        if 'language_select' in request.form:
-            if not request.form['language_select'] == '':
-                language_select = request.form['language_select']
-                matching_papers = matching_papers.filter(Paper.language_id == language_select)
-        if 'ddc_select' in request.form:
-            if not request.form['ddc_select'] == '':
-                ddc_select = request.form['ddc_select']
-                paperddcs = db.session.query(models.PaperDDC).filter(
-                    models.PaperDDC.ddc_dewey_number == ddc_select).all()
-                matching_papers = matching_papers.filter(Paper.uid.in_([p.paper_uid for p in paperddcs]))
-        if 'date_min' in request.form:
-            if not request.form['date_min'] == '':
-                date_min = request.form['date_min']
-                matching_papers = matching_papers.filter(extract('year', Paper.date) >= int(date_min))
-        if 'date_max' in request.form:
-            if not request.form['date_max'] == '':
-                date_max = request.form['date_max']
-                matching_papers = matching_papers.filter(extract('year', Paper.date) <= int(date_max))
-    matching_papers = matching_papers.all()
-    return render_template('results.html', papers=matching_papers)
+    matching_papers = read_session.query(Paper).filter(Paper.sustainable == True)
+    # The search form is posted for the first page, the following pages are requested with the same fields and the
+    # cursor of the page (see pagination.py)
+    search_values = {name: request.values[name] for name in SEARCH_FIELDS
+                     if not request.values.get(name, '').strip() == ''}
+    # The full-text searches: the papers are sorted by the rank of the first search (or by date if there is no ranked
+    # search), and its snippets are shown
+    rank_column = None
+    snippet_column = None
+    search_fields = [('text_select', ['title', 'description', 'keywords']), ('title_select', ['title']),
+                     ('description_select', ['description'])]
+    for field_name, column_list in search_fields:
+        if field_name in search_values:
+            matching_papers, search_rank_column, search_snippet_column = search_papers(
+                matching_papers, search_values[field_name], column_list)
+            if rank_column is None and snippet_column is None:
+                rank_column = search_rank_column
+                snippet_column = search_snippet_column
+    if 'creator_select' in search_values:
+        creator_select = search_values['creator_select']
+        paperCreators = read_session.query(models.PaperCreator.paper_uid).filter(
+            models.PaperCreator.creator_id == creator_select)
+        matching_papers = matching_papers.filter(Paper.uid.in_(paperCreators))
+    if 'keyword_select' in search_values:
+        keyword_select = search_values['keyword_select']
+        paperKeywords = read_session.query(models.PaperKeyword.paper_uid).filter(
+            models.PaperKeyword.keyword_id == keyword_select)
+        matching_papers = matching_papers.filter(Paper.uid.in_(paperKeywords))
+    if 'language_select' in search_values:
+        language_select = search_values['language_select']
+        matching_papers = matching_papers.filter(Paper.language_id == language_select)
+    if 'ddc_select' in search_values:
+        ddc_select = search_values['ddc_select']
+        paperddcs = read_session.query(models.PaperDDC.paper_uid).filter(
+            models.PaperDDC.ddc_dewey_number == ddc_select)
+        matching_papers = matching_papers.filter(Paper.uid.in_(paperddcs))
+    # The years are compared as date ranges, so that the index of the dates can be used
+    try:
+        if 'date_min' in search_values:
+            date_min = search_values['date_min']
+            matching_papers = matching_papers.filter(Paper.date >= date(int(date_min), 1, 1))
+        if 'date_max' in search_values:
+            date_max = search_values['date_max']
+            matching_papers = matching_papers.filter(Paper.date < date(int(date_max) + 1, 1, 1))
+    except ValueError:
+        abort(400)
+
+    # Load the creators and languages the results show with one query per page
+    matching_papers = matching_papers.options(selectinload(Paper.creators), joinedload(Paper.language))
+    try:
+        page_size = get_page_size(request.values.get('page_size'))
+        if rank_column is not None:
+            page = paginate(matching_papers, rank_column, Paper.uid, request.values.get('cursor'), page_size,
+                            descending=False, extra_columns=[snippet_column], volatile_sort=True)
+        else:
+            page = paginate(matching_papers, Paper.date, Paper.uid, request.values.get('cursor'), page_size)
+    except ValueError:
+        abort(400)
+    snippets = {}
+    if rank_column is not None:
+        matching_papers = [paper for paper, snippet in page.rows]
+        snippets = {paper.uid: highlight_snippet(snippet) for paper, snippet in page.rows}
+    else:
+        matching_papers = page.rows
+    next_url = url_for('sresults', cursor=page.next_cursor, page_size=page_size, **search_values) if page.next_cursor else None
+    return render_template('results.html', papers=matching_papers, snippets=snippets, total_count=page.total_count,
+                           next_url=next_url)
 
 
 @server_app.route('/annotate', methods=['GET', 'POST'])
@@ -240,6 +279,33 @@ def set_settings(parameters):
     db.session.commit()
     return jsonify('SOMETHING')
 
+# Returns the status of the model training and of the current model (admins only)
+@server_app.route('/model/status')
+@login_required('admin')
+def get_model_status():
+    from greenzora import server_logic
+    return jsonify(server_logic.get_model_status())
+
+
+# Trains a new model in the background (admins only)
+@server_app.route('/model/train', methods=['POST'])
+@login_required('admin')
+def train_model():
+    from greenzora import server_logic
+    if not server_logic.create_new_model():
+        return jsonify(server_logic.get_model_status()), 409
+    return jsonify(server_logic.get_model_status()), 202
+
+
+# Restores the previous model (admins only)
+@server_app.route('/model/rollback', methods=['POST'])
+@login_required('admin')
+def rollback_model():
+    from greenzora import server_logic
+    if not server_logic.rollback_model():
+        return jsonify(server_logic.get_model_status()), 409
+    return jsonify(server_logic.get_model_status()), 202
+
 # TODO: Add Rest
 #@greenzora.route('/data/papers/<parameters>', methods=['GET', 'POST'])
 
@@ -0,0 +1,163 @@
+import re
+
+from flask import Markup, escape
+from sqlalchemy import Float, String, bindparam, event, or_, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.attributes import get_history
+
+from greenzora import db
+from greenzora.models import Paper, Keyword, PaperKeyword
+from greenzora.utils import is_debug, split_list, MAX_SQL_VARIABLES
+
+# The full-text search of the papers. The titles, descriptions and keywords of the papers are indexed in the SQLite FTS5
+# table papers_fts. Its rowid is the id of the paper's uid in the table papers_fts_keys, an INTEGER PRIMARY KEY, which
+# (unlike the implicit rowid of the papers) is not changed by a VACUUM. The titles and descriptions are kept in sync
+# with the papers by triggers, so every path that writes papers (ZORA pull, legacy import, deletions) updates them. The
+# tables are created by a schema migration (see migrations.py).
+#
+# The keywords are indexed by the code that writes them: the bulk writes of the papers index the keywords of all their
+# papers at once after they replaced the associations (see index_keywords), and the keywords that are changed with the
+# ORM are indexed when the session is flushed (see index_flushed_keywords).
+#
+# A search text is split into words and every word is matched as a prefix (climat -> climate, climatic, ...). All words
+# have to match. The results are ranked with bm25, in which a match in the title weighs more than a match in the
+# keywords or the description. If SQLite was built without FTS5 or the search text contains no words, the search falls
+# back to LIKE.
+
+SEARCH_TABLE = 'papers_fts'
+SEARCH_KEY_TABLE = 'papers_fts_keys'
+SEARCH_COLUMNS = ['title', 'description', 'keywords']
+SEARCH_COLUMN_WEIGHTS = [10.0, 1.0, 5.0]
+
+# The maximum amount of words of a snippet and the highlighting of the matches in it. FTS5 marks the matches with
+# control characters, which can't be in the indexed texts, so that the snippet can be escaped before it is highlighted.
+SNIPPET_WORDS = 24
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+HIGHLIGHT_START = '<mark>'
+HIGHLIGHT_END = '</mark>'
+
+WORD_REGEX = re.compile(r'\w+', re.UNICODE)
+
+# The keywords of a paper as a single text ({} is replaced with the uid of the paper)
+KEYWORDS_EXPRESSION = ("(SELECT group_concat(k.name, ' ') FROM paper_keyword_association_table a "
+                       "JOIN keywords k ON k.id = a.keyword_id WHERE a.paper_uid = {})")
+
+# The key of a paper in the search table ({} is replaced with the uid of the paper)
+KEY_EXPRESSION = '(SELECT id FROM ' + SEARCH_KEY_TABLE + ' WHERE uid = {})'
+
+
+# Creates the search table, its key table and its triggers. Existing triggers are replaced, so changed triggers can be
+# installed by calling this function in a new migration. Returns False if SQLite was built without FTS5.
+def create_search_index():
+    try:
+        db.session.execute('CREATE VIRTUAL TABLE IF NOT EXISTS ' + SEARCH_TABLE + ' USING fts5(' +
+                           ', '.join(SEARCH_COLUMNS) + ", tokenize = 'unicode61 remove_diacritics 1', prefix = '2 3')")
+    except OperationalError as error:
+        print('Full-text search not available (' + str(error) + ')')
+        return False
+    db.session.execute('CREATE TABLE IF NOT EXISTS ' + SEARCH_KEY_TABLE + ' (id INTEGER PRIMARY KEY, '
+                       'uid VARCHAR(256) NOT NULL UNIQUE)')
+
+    trigger_dict = {
+        'papers_search_insert': ('AFTER INSERT ON papers BEGIN '
+                                 'INSERT INTO ' + SEARCH_KEY_TABLE + ' (uid) VALUES (NEW.uid); '
+                                 'INSERT INTO ' + SEARCH_TABLE + ' (rowid, title, description, keywords) '
+                                 'VALUES (' + KEY_EXPRESSION.format('NEW.uid') + ', NEW.title, NEW.description, ' +
+                                 KEYWORDS_EXPRESSION.format('NEW.uid') + '); END'),
+        'papers_search_update': ('AFTER UPDATE OF title, description ON papers '
+                                 'WHEN OLD.title IS NOT NEW.title OR OLD.description IS NOT NEW.description BEGIN '
+                                 'UPDATE ' + SEARCH_TABLE + ' SET title = NEW.title, description = NEW.description '
+                                 'WHERE rowid = ' + KEY_EXPRESSION.format('NEW.uid') + '; END'),
+        'papers_search_delete': ('AFTER DELETE ON papers BEGIN '
+                                 'DELETE FROM ' + SEARCH_TABLE + ' WHERE rowid = ' + KEY_EXPRESSION.format('OLD.uid') + '; '
+                                 'DELETE FROM ' + SEARCH_KEY_TABLE + ' WHERE uid = OLD.uid; END')}
+    for trigger_name, trigger_definition in trigger_dict.items():
+        db.session.execute('DROP TRIGGER IF EXISTS ' + trigger_name)
+        db.session.execute('CREATE TRIGGER ' + trigger_name + ' ' + trigger_definition)
+    return True
+
+
+# Indexes all papers again. This is needed if the papers were changed without the triggers.
+def rebuild_search_index():
+    db.session.execute('DELETE FROM ' + SEARCH_TABLE)
+    db.session.execute('DELETE FROM ' + SEARCH_KEY_TABLE)
+    db.session.execute('INSERT INTO ' + SEARCH_KEY_TABLE + ' (uid) SELECT uid FROM papers')
+    db.session.execute('INSERT INTO ' + SEARCH_TABLE + ' (rowid, title, description, keywords) '
+                       'SELECT k.id, p.title, p.description, ' + KEYWORDS_EXPRESSION.format('p.uid') + ' '
+                       'FROM papers p JOIN ' + SEARCH_KEY_TABLE + ' k ON k.uid = p.uid')
+    db.session.execute('INSERT INTO ' + SEARCH_TABLE + ' (' + SEARCH_TABLE + ") VALUES ('optimize')")
+
+
+# Indexes the keywords of the given papers again. Has to be called after the keyword associations of papers were
+# written with bulk statements.
+def index_keywords(uid_list, session=db.session):
+    if not is_search_index_available(session):
+        return
+    update_keywords = text('UPDATE ' + SEARCH_TABLE + ' SET keywords = ' +
+                           KEYWORDS_EXPRESSION.format('(SELECT uid FROM ' + SEARCH_KEY_TABLE + ' '
+                                                      'WHERE id = ' + SEARCH_TABLE + '.rowid)') + ' '
+                           'WHERE rowid IN (SELECT id FROM ' + SEARCH_KEY_TABLE + ' WHERE uid IN :uid_list)')\
+        .bindparams(bindparam('uid_list', expanding=True))
+    for uid_sublist in split_list(list(uid_list), MAX_SQL_VARIABLES):
+        session.execute(update_keywords, {'uid_list': uid_sublist})
+
+
+# Indexes the keywords of the papers whose keywords were changed with the ORM (e.g. by Paper.create_paper) once the
+# changes are flushed. The new, dirty and deleted objects of the session are still the ones of the flush at this point.
+@event.listens_for(db.session, 'after_flush')
+def index_flushed_keywords(session, flush_context):
+    uid_set = {instance.uid for instance in session.new | session.dirty
+               if isinstance(instance, Paper) and get_history(instance, 'keywords').has_changes()}
+    uid_set.update(instance.paper_uid for instance in session.new | session.deleted if isinstance(instance, PaperKeyword))
+    if uid_set:
+        index_keywords(uid_set, session)
+
+
+# Returns True if the search table exists
+def is_search_index_available(session):
+    return session.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name",
+                           {'name': SEARCH_TABLE}).first() is not None
+
+
+# Returns the FTS5 query of a search text, in which every word is a quoted prefix query limited to the given columns
+# (e.g. '{title} : "climat"* "chang"*'), or None if the text contains no words
+def get_match_query(search_text, column_list):
+    word_list = WORD_REGEX.findall(search_text)
+    if not word_list:
+        return None
+    return '{' + ' '.join(column_list) + '} : ' + ' '.join('"' + word + '"*' for word in word_list)
+
+
+# Restricts a query of papers to the papers that match a search text in the given columns. Returns the query, the rank
+# column (the better the match, the lower the rank) and the snippet column of the matches. If the search table is not
+# available or the text contains no words, the papers are filtered with LIKE, and the rank and snippet columns are None.
+def search_papers(query, search_text, column_list=SEARCH_COLUMNS):
+    match_query = get_match_query(search_text, column_list)
+    if not match_query or not is_search_index_available(query.session):
+        if is_debug():
+            print('Full-text search falls back to LIKE: ' + search_text)
+        condition_list = [Paper.keywords.any(Keyword.name.contains(search_text)) if column == 'keywords'
+                          else getattr(Paper, column).contains(search_text) for column in column_list]
+        return query.filter(or_(*condition_list)), None, None
+
+    # NOTE: The match query is put into the statement as a literal, since a query might be searched more than once and
+    # the parameters of the searches would have the same names. It only contains quoted words, so it is safe.
+    weights = ', '.join(str(weight) for weight in SEARCH_COLUMN_WEIGHTS)
+    snippet_column = SEARCH_COLUMNS.index(column_list[0]) if len(column_list) == 1 else -1
+    matches = text('SELECT k.uid AS uid, bm25(' + SEARCH_TABLE + ', ' + weights + ') AS rank, '
+                   'snippet(' + SEARCH_TABLE + ', ' + str(snippet_column) + ", '" + SNIPPET_START + "', '" +
+                   SNIPPET_END + "', '...', " + str(SNIPPET_WORDS) + ') AS snippet '
+                   'FROM ' + SEARCH_TABLE + ' JOIN ' + SEARCH_KEY_TABLE + ' k ON k.id = ' + SEARCH_TABLE + '.rowid '
+                   'WHERE ' + SEARCH_TABLE + " MATCH '" + match_query + "'")\
+        .columns(uid=String, rank=Float, snippet=String)\
+        .alias()
+    query = query.join(matches, matches.c.uid == Paper.uid)
+    return query, matches.c.rank, matches.c.snippet
+
+
+# Returns the HTML of a snippet, in which the matches are highlighted
+def highlight_snippet(snippet):
+    if snippet is None:
+        return None
+    return Markup(str(escape(snippet)).replace(SNIPPET_START, HIGHLIGHT_START).replace(SNIPPET_END, HIGHLIGHT_END))
@@ -1,16 +1,26 @@
+import hashlib
 import json
+import multiprocessing
+import numpy as np
+import os
 import pandas as pd
+import scipy.sparse as sp
 
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
 from flask_apscheduler import APScheduler
 from flask_sqlalchemy import event
+from oaipmh.error import BadResumptionTokenError
 from sqlalchemy.sql import func
-from threading import Timer
+from threading import Lock, Thread
 
 from greenzora import db, server_app
-from greenzora.models import Paper, Institute, ResourceType, ServerSetting, OperationParameter
-from greenzora.ml_tool import MLTool
-from greenzora.utils import is_debug
+from greenzora.archive import RecordArchive
+from greenzora.feature_cache import FeatureCache
+from greenzora.models import Paper, Institute, ResourceType, ServerSetting, OperationParameter, AnnotationQueueEntry, \
+    AnnotationLease
+from greenzora.ml_tool import MLTool, train_ml_tool
+from greenzora.utils import is_debug, split_list, MAX_SQL_VARIABLES
 from greenzora.zoraAPI import ZoraAPI
 
 
@@ -18,16 +28,39 @@ class ServerLogic:
     ZORA_API_JOB_ID = 'zoraAPI_get_records_job'
     INSTITUTE_UPDATE_JOB_ID = 'institute_update_job'
     RESOURCE_TYPE_UPDATE_JOB_ID = 'resource_type_update_job'
+    ANNOTATION_QUEUE_JOB_ID = 'annotation_queue_job'
+    ANNOTATION_LEASE_JOB_ID = 'annotation_lease_job'
+
+    # The amount of random papers get_annotation tries to lease if the annotation queue is empty
+    ANNOTATION_CLAIM_ATTEMPTS = 3
+
+    # The modes of the annotation queue (see refill_annotation_queue)
+    ANNOTATION_QUEUE_MODE_UNCERTAINTY = 'uncertainty'
+    ANNOTATION_QUEUE_MODE_RANDOM = 'random'
+
+    # The states of the model job, which trains a new model in the background (see start_model_job)
+    MODEL_STATE_IDLE = 'idle'
+    MODEL_STATE_TRAINING = 'training'
+    MODEL_STATE_CLASSIFYING = 'classifying'
+    MODEL_STATE_FINISHED = 'finished'
+    MODEL_STATE_FAILED = 'failed'
 
     # The __init__ method is used to initialize the greenzora logic
     def __init__(self):
 
-        # Initialize the list of papers that are being annotated currently
-        self.annotations = []
+        # Initialize the lock that makes sure that the annotation queue is only refilled by one thread at a time, and the
+        # thread get_annotation refills the queue with (see start_annotation_queue_refill)
+        self.annotation_queue_lock = Lock()
+        self.annotation_refill_thread = None
+        self.annotation_refill_thread_lock = Lock()
+
+        # Initialize the record archive, which stores the raw XML of the harvested records (disabled if no path is set)
+        archive_path = server_app.config['ZORA_ARCHIVE_PATH']
+        self.record_archive = RecordArchive(archive_path, server_app.config['ZORA_ARCHIVE_SEGMENT_SIZE']) if archive_path else None
 
         # Initialize the ZORA API
         url = ServerSetting.get('zora_url')
-        self.zoraAPI = ZoraAPI(url)
+        self.zoraAPI = ZoraAPI(url, self.record_archive)
         print('ZORA API initialized')
 
         # Load the institutes from ZORA
@@ -42,9 +75,37 @@ class ServerLogic:
         file_path = server_app.config['LEGACY_ANNOTATIONS_PATH']
         self.import_legacy_annotations(file_path)
 
-        # Initialize the machine learning tool
-        self.ml_tool = MLTool()
-        self.train_ml_tool()
+        # Initialize the feature cache, which stores the term counts of the papers (only in the hashing feature mode)
+        feature_cache_path = server_app.config['ML_FEATURE_CACHE_PATH']
+        if feature_cache_path and server_app.config['ML_FEATURE_MODE'] == MLTool.FEATURE_MODE_HASHING:
+            self.feature_cache = FeatureCache(feature_cache_path,
+                                              server_app.config['ML_HASHING_FEATURES'],
+                                              server_app.config['ML_FEATURE_CACHE_MAX_SEGMENTS'])
+        else:
+            self.feature_cache = None
+
+        # Initialize the machine learning tool and the buffer of annotations it has not been updated with yet. The saved
+        # model is loaded if it is still up to date (see load_ml_tool), otherwise a new model is trained and saved.
+        #
+        # The previous machine learning tool is kept after a new one was trained, so that it can be restored (also
+        # after a restart, if it was saved). If a new model is trained at startup, the model that was in use becomes
+        # the previous one. The status of the model job is reported by get_model_status.
+        self.annotation_buffer = []
+        self.annotation_buffer_lock = Lock()
+        self.previous_ml_tool = None
+        self.ml_tool = self.load_ml_tool()
+        if self.ml_tool:
+            self.previous_ml_tool = self.load_ml_tool_artifact(OperationParameter.get('ml_previous_model_fingerprint'))
+        else:
+            self.previous_ml_tool = self.load_ml_tool_artifact(OperationParameter.get('ml_model_fingerprint'))
+            self.ml_tool = self.create_ml_tool()
+            self.train_and_save_ml_tool()
+        if self.ml_tool.online:
+            print('Online updates enabled: the updates of the model are kept in this process only and are not saved')
+
+        self.model_status = {'state': ServerLogic.MODEL_STATE_IDLE, 'progress': None, 'started': None,
+                             'finished': None, 'error': None}
+        self.model_status_lock = Lock()
 
         # Initialize the task scheduler
         self.scheduler = APScheduler()
@@ -52,6 +113,21 @@ class ServerLogic:
         self.scheduler.start()
         print('Task scheduler initialized')
 
+        # Start the periodic jobs. They can be disabled in the config (e.g. for the benchmarks).
+        if server_app.config['SCHEDULE_JOBS']:
+            self.start_jobs()
+
+        # Register the database event listener for the greenzora settings table
+        @event.listens_for(ServerSetting.value, 'set')
+        def handle_setting_change(target, value, oldvalue, initiator):
+            self.handle_setting_change(target, value, oldvalue, initiator)
+        print('Database event handler registered')
+
+        print('Server initialized')
+
+    # Starts the periodic jobs of the server
+    def start_jobs(self):
+
         # Initialize the institute update job, which updates the list of institutes
         job_interval = ServerSetting.get('institute_update_interval')
         server_app.apscheduler.add_job(func=self.load_institutes,
@@ -77,59 +153,191 @@ class ServerLogic:
                                        id=ServerLogic.ZORA_API_JOB_ID)
         print('ZORA pull job started')
 
-        # Register the database event listener for the greenzora settings table
-        @event.listens_for(ServerSetting.value, 'set')
-        def handle_setting_change(target, value, oldvalue, initiator):
-            self.handle_setting_change(target, value, oldvalue, initiator)
-        print('Database event handler registered')
-
-        print('Server initialized')
+        # Initialize the annotation queue job, which refills the annotation queue in a fixed interval
+        server_app.apscheduler.add_job(func=self.run_annotation_queue_refill,
+                                       trigger='interval',
+                                       minutes=server_app.config['ANNOTATION_QUEUE_REFILL_INTERVAL'],
+                                       next_run_time=datetime.now(),
+                                       id=ServerLogic.ANNOTATION_QUEUE_JOB_ID)
+        print('Annotation queue job started')
 
-    # This function gets the latest papers from ZORA, which are then classified and stored in the database.
+        # Initialize the annotation lease job, which removes the expired annotation leases in a fixed interval
+        server_app.apscheduler.add_job(func=self.reap_annotation_leases,
+                                       trigger='interval',
+                                       minutes=server_app.config['ANNOTATION_LEASE_REAP_INTERVAL'],
+                                       id=ServerLogic.ANNOTATION_LEASE_JOB_ID)
+        print('Annotation lease job started')
+
+    # This function gets the latest papers from ZORA, which are then classified and stored in the database. The papers
+    # are processed in chunks of zora_pull_chunk_size papers and every chunk is committed on its own together with the
+    # resumption token of the next chunk. If a pull gets interrupted, the next pull resumes after the last committed
+    # chunk. last_zora_pull is only updated when a pull has finished completely.
     def zora_pull(self):
 
-        # We want to store the starting time to update last_zora_pull when we are done
-        new_last_zora_pull = datetime.utcnow()
-
         # Get the papers that were created or updated since the last pull
         from_ = OperationParameter.get('last_zora_pull')
-        metadata_dict_list = self.zoraAPI.get_metadata_dicts(from_)
+        chunk_size = ServerSetting.get('zora_pull_chunk_size')
+        parse_workers = ServerSetting.get('zora_parse_workers')
+        partition_threads = ServerSetting.get('zora_pull_partitions')
+
+        # Load the institute and resource type names once for the whole pull
+        self.zoraAPI.load_name_lookup()
+
+        # If the previous pull was interrupted, we continue where it stopped. In that case we keep its starting time,
+        # so that no changes made during the interrupted pull are missed. A partitioned pull has no resumption token, so
+        # it is restarted as a single stream pull, which can be resumed if it gets interrupted again. The papers that
+        # were already stored are skipped, since their metadata did not change.
+        resumption_token = OperationParameter.get('zora_pull_resumption_token')
+        interrupted_pull_started = OperationParameter.get('zora_pull_started')
+        if resumption_token:
+            new_last_zora_pull = interrupted_pull_started
+            committed_chunks = OperationParameter.get('zora_pull_committed_chunks')
+            print('Resuming ZORA pull after chunk ' + str(committed_chunks) + '...')
+        elif interrupted_pull_started:
+            new_last_zora_pull = interrupted_pull_started
+            committed_chunks = 0
+            print('Restarting the interrupted ZORA pull as a single stream...')
+        else:
+
+            # We want to store the starting time to update last_zora_pull when we are done
+            new_last_zora_pull = datetime.utcnow()
+            committed_chunks = 0
+            OperationParameter.set('zora_pull_started', new_last_zora_pull)
+            db.session.commit()
+
+        # A new full pull can be split into partitions that are harvested concurrently. Such a pull cannot be resumed
+        # with a resumption token, so if it gets interrupted, the next pull is a single stream pull (see above).
+        if not from_ and not interrupted_pull_started and partition_threads > 0:
+            partition_mode = ServerSetting.get('zora_pull_partition_mode')
+            partitions = self.zoraAPI.get_partitions(partition_mode, from_, new_last_zora_pull, partition_threads)
+            print('Pulling ' + str(len(partitions)) + ' partitions with ' + str(partition_threads) + ' threads...')
+            metadata_dict_chunks = self.zoraAPI.iterate_partitioned_metadata_dict_chunks(partitions, chunk_size,
+                                                                                         partition_threads, parse_workers)
+        else:
+            metadata_dict_chunks = self.zoraAPI.iterate_metadata_dict_chunks(from_, chunk_size, resumption_token,
+                                                                             parse_workers)
+
+        # If ZORA does not accept the resumption token anymore (e.g. because it expired), we start the pull over.
+        # Storing the chunks again is no problem, since existing papers are simply updated.
+        try:
+            self.store_zora_chunks(metadata_dict_chunks, committed_chunks)
+        except BadResumptionTokenError as error:
+            print('Resumption token was rejected (' + str(error) + '), restarting the ZORA pull...')
+            db.session.rollback()
+            metadata_dict_chunks = self.zoraAPI.iterate_metadata_dict_chunks(from_, chunk_size, None, parse_workers)
+            self.store_zora_chunks(metadata_dict_chunks, 0)
+
+        # After the zora_pull is completed, we update the last_zora_pull operation parameter, so that we can only get
+        # the most recent changes of the ZORA repository. We also remove the checkpoint of the pull. Then commit the
+        # transaction
+        OperationParameter.set('last_zora_pull', new_last_zora_pull)
+        OperationParameter.set('zora_pull_started', None)
+        OperationParameter.set('zora_pull_resumption_token', None)
+        OperationParameter.set('zora_pull_committed_chunks', 0)
+        db.session.commit()
+
+        if is_debug():
+            print('Duration: ' + str(datetime.utcnow() - new_last_zora_pull))
+
+    # Stores the chunks of papers from ZORA (see ZoraAPI.iterate_metadata_dict_chunks). After every chunk, the resumption
+    # token of the next chunk is stored as a checkpoint in the same transaction.
+    def store_zora_chunks(self, metadata_dict_chunks, committed_chunks):
 
         # If a paper was deleted, delete it from the database. Otherwise classify the paper and store it.
         count = 0
         print('Storing papers...')
+        for metadata_dict_list, next_resumption_token in metadata_dict_chunks:
+            self.store_metadata_dicts(metadata_dict_list)
+
+            # Commit the chunk together with the checkpoint, so that the work done so far is kept even if a later
+            # chunk fails
+            committed_chunks += 1
+            OperationParameter.set('zora_pull_resumption_token', next_resumption_token)
+            OperationParameter.set('zora_pull_committed_chunks', committed_chunks)
+            db.session.commit()
+            count += len(metadata_dict_list)
+            if is_debug():
+                print('Count: ' + str(count))
+        print(count)
+        print('Done')
+
+    # Stores a list of metadata dictionaries without committing. Deleted papers are deleted, all other papers are
+    # classified and created or updated. If skip_unchanged is True, papers whose metadata did not change are skipped.
+    def store_metadata_dicts(self, metadata_dict_list, skip_unchanged=True):
+        deleted_uid_list = []
+        paper_dict_list = []
         for metadata_dict in metadata_dict_list:
 
             # If the paper got deleted from ZORA, we want to delete it as well
             if 'deleted' in metadata_dict and metadata_dict['deleted']:
-                paper = db.session.query(Paper).get(metadata_dict['uid'])
-                if paper:
-                    db.session.delete(paper)
-                continue
-
-            # Classify the paper based on title and description
-            title = metadata_dict['title'] if 'title' in metadata_dict and metadata_dict['title'] else ''
-            description = metadata_dict['description'] if 'description' in metadata_dict and metadata_dict['description'] else ''
-            data = pd.Series([title + ' | ' + description])
-            metadata_dict['sustainable'] = self.ml_tool.classify(data).item(0)
-
-            # Create or update the paper
-            Paper.create_or_update(metadata_dict)
+                deleted_uid_list.append(metadata_dict['uid'])
+            else:
+                paper_dict_list.append(metadata_dict)
+
+        # ZORA often sends papers again although their metadata did not change. We skip those papers, so that they
+        # are neither classified nor written again.
+        for metadata_dict in paper_dict_list:
+            metadata_dict['digest'] = Paper.compute_digest(metadata_dict)
+        if skip_unchanged:
+            digest_dict = Paper.get_digests([metadata_dict['uid'] for metadata_dict in paper_dict_list])
+            changed_paper_dict_list = [metadata_dict for metadata_dict in paper_dict_list
+                                       if digest_dict.get(metadata_dict['uid']) != metadata_dict['digest']]
+            if is_debug():
+                print('Unchanged papers skipped: ' + str(len(paper_dict_list) - len(changed_paper_dict_list)))
+            paper_dict_list = changed_paper_dict_list
+
+        # Classify all papers of the chunk at once and keep their term counts in the feature cache
+        term_counts = self.classify_metadata_dicts(paper_dict_list)
+        if self.feature_cache:
+            self.feature_cache.add_rows([metadata_dict['uid'] for metadata_dict in paper_dict_list],
+                                        [metadata_dict['digest'] for metadata_dict in paper_dict_list],
+                                        term_counts)
+            self.feature_cache.delete_rows(deleted_uid_list)
+
+        # Delete, create and update the papers with bulk statements
+        Paper.bulk_delete(deleted_uid_list)
+        Paper.bulk_create_or_update(paper_dict_list)
+
+    # Parses the records in the record archive again and stores the papers, so that changes of the parsing or the
+    # classification can be applied without harvesting ZORA again. Every chunk is committed on its own. If
+    # reclassify_all is False, only the papers whose metadata changed are classified and stored again. Returns the
+    # amount of records that were parsed.
+    def reparse_archive(self, use_mmap=False, reclassify_all=False):
+        if not self.record_archive:
+            print('The record archive is disabled')
+            return 0
+        chunk_size = ServerSetting.get('zora_pull_chunk_size')
+        parse_workers = ServerSetting.get('zora_parse_workers')
+        self.zoraAPI.load_name_lookup()
 
+        count = 0
+        print('Reparsing archived records...')
+        for metadata_dict_list, next_resumption_token in self.zoraAPI.iterate_archived_metadata_dict_chunks(chunk_size,
+                                                                                                          use_mmap,
+                                                                                                          parse_workers):
+            self.store_metadata_dicts(metadata_dict_list, skip_unchanged=not reclassify_all)
+            db.session.commit()
+            count += len(metadata_dict_list)
             if is_debug():
-                count += 1
-                if is_debug() and count % 1000 == 0:
-                    print('Count: ' + str(count))
+                print('Count: ' + str(count))
         print(count)
         print('Done')
-
-        # After the zora_pull is completed, we update the last_zora_pull operation parameter, so that we can only get
-        # the most recent changes of the ZORA repository. Then commit the transaction
-        OperationParameter.set('last_zora_pull', new_last_zora_pull)
-        db.session.commit()
-
-        if is_debug():
-            print('Duration: ' + str(datetime.utcnow() - new_last_zora_pull))
+        return count
+
+    # Classifies the papers of a list of metadata dictionaries based on title and description and stores the labels in
+    # the dictionaries ('sustainable'). All papers are classified with a single call of the machine learning tool.
+    # Returns the term counts of the papers (see MLTool.get_term_counts), or None if the list is empty.
+    def classify_metadata_dicts(self, metadata_dict_list):
+        if not metadata_dict_list:
+            return None
+        data = pd.Series([(metadata_dict['title'] if 'title' in metadata_dict and metadata_dict['title'] else '') + ' | ' +
+                          (metadata_dict['description'] if 'description' in metadata_dict and metadata_dict['description'] else '')
+                          for metadata_dict in metadata_dict_list])
+        term_counts = self.ml_tool.get_term_counts(data)
+        labels = self.ml_tool.classify_term_counts(term_counts)
+        for metadata_dict, label in zip(metadata_dict_list, labels):
+            metadata_dict['sustainable'] = bool(label)
+        return term_counts
 
     # This method loads all legacy annotations from the legacy_annotations.json if they are not loaded already
     @staticmethod
@@ -176,6 +384,7 @@ class ServerLogic:
         for institute_name, children_dict in institute_name_dict.items():
             self.store_institute_hierarchy(institute_name, children_dict, None)
         db.session.commit()
+        self.zoraAPI.load_name_lookup()
 
     # A recursive method that explores the tree structure of the institutes dictionary and stores the institutes with
     # their corresponding parent institute.
@@ -195,6 +404,7 @@ class ServerLogic:
         for resource_type in resource_type_list:
             ResourceType.get_or_create(resource_type)
         db.session.commit()
+        self.zoraAPI.load_name_lookup()
 
     # This method handles changes to the settings.
     # zora_pull_interval:   Reschedules the zora_pull_job with the new interval
@@ -211,75 +421,515 @@ class ServerLogic:
         elif setting_name == 'zora_url':
 
             # Create a new connection with the new url
-            self.zoraAPI = self.zoraAPI = ZoraAPI(value)
+            self.zoraAPI = self.zoraAPI = ZoraAPI(value, self.record_archive)
+            self.zoraAPI.load_name_lookup()
 
         if is_debug():
             print('Setting "' + setting_name + '" was changed to ' + str(value) + '.')
 
-    # Picks a paper from all papers that are not yet annotated and not currently being annotated
+    # Picks a paper that is not yet annotated and not currently being annotated and leases it for annotation_timeout
+    # minutes (see AnnotationLease). The paper is taken from the annotation queue. If the queue is empty, it is refilled
+    # in the background and a random paper is picked. Returns None if there is no paper left to annotate.
     def get_annotation(self):
-        paper = db.session.query(Paper).filter(Paper.annotated == False, Paper.uid.notin_(self.annotations)).order_by(func.random()).first()
-        self.annotations.append(paper.uid)
-        annotation_timeout = ServerSetting.get('annotation_timeout')
-        timer = Timer(annotation_timeout, self.timeout_annotation, [paper.uid])
-        timer.start()
-        return paper
-
-    # Sets the annotated and sustainable properties of a paper based on how it got annotated
-    def set_annotation(self, uid, sustainable):
-        if uid in self.annotations:
-            self.annotations.remove(uid)
-            paper = db.session.query(Paper).get(uid)
-            paper.sustainable = sustainable
-            paper.annotated = True
+        now = datetime.utcnow()
+        expires_at = now + timedelta(minutes=ServerSetting.get('annotation_timeout'))
+        while True:
+            uid = AnnotationQueueEntry.dequeue()
+            if not uid:
+                break
+
+            # The queue may contain papers that were annotated, deleted or leased since the queue was filled
+            paper = db.session.query(Paper).filter(Paper.uid == uid, Paper.annotated == False).first()
+            claimed = paper and AnnotationLease.claim(uid, expires_at, now)
             db.session.commit()
-            return 200
-        else:
+            if claimed:
+                return paper
+
+        # The queue is empty. Another process might lease the random paper at the same time, so we try more than once.
+        self.start_annotation_queue_refill()
+        for attempt in range(ServerLogic.ANNOTATION_CLAIM_ATTEMPTS):
+            paper = db.session.query(Paper)\
+                .filter(Paper.annotated == False, Paper.uid.notin_(AnnotationLease.get_leased_paper_uids_query(now)))\
+                .order_by(func.random())\
+                .first()
+            if not paper:
+                break
+            claimed = AnnotationLease.claim(paper.uid, expires_at, now)
+            db.session.commit()
+            if claimed:
+                return paper
+        db.session.commit()
+        return None
+
+    # Sets the annotated and sustainable properties of a paper based on how it got annotated. The annotation is only
+    # accepted if the paper is leased and the lease did not expire (otherwise 408). The lease is released in the same
+    # transaction. If the paper was deleted meanwhile (e.g. by a ZORA pull), the lease is released and 404 is returned.
+    def set_annotation(self, uid, sustainable):
+        if not AnnotationLease.release(uid, datetime.utcnow()):
+            db.session.rollback()
             return 408
+        paper = db.session.query(Paper).get(uid)
+        if not paper:
+            db.session.commit()
+            return 404
+        paper.sustainable = sustainable
+        paper.annotated = True
+        db.session.commit()
+        self.update_ml_tool(paper)
+        return 200
 
-    # Timeouts annotations and removes them from the list of currently processed papers when they take too long.
-    def timeout_annotation(self, uid):
-        if uid in self.annotations:
-            self.annotations.remove(uid)
+    # Removes the expired annotation leases. This runs as a periodic job, so no thread is needed per annotation.
+    def reap_annotation_leases(self):
+        try:
+            count = AnnotationLease.reap(datetime.utcnow())
+            db.session.commit()
+            if is_debug():
+                print('Expired annotation leases removed: ' + str(count))
+        finally:
+            db.session.remove()
+
+    # Starts refilling the annotation queue in a background thread, unless the thread of the previous refill is still
+    # running. Otherwise every request that finds the queue empty would start a thread.
+    def start_annotation_queue_refill(self):
+        with self.annotation_refill_thread_lock:
+            if self.annotation_refill_thread and self.annotation_refill_thread.is_alive():
+                return
+            self.annotation_refill_thread = Thread(target=self.run_annotation_queue_refill, daemon=True)
+            self.annotation_refill_thread.start()
+
+    # Refills the annotation queue (see refill_annotation_queue) in a background thread or job
+    def run_annotation_queue_refill(self):
+        try:
+            self.refill_annotation_queue()
+        except Exception as error:
+            print('Annotation queue could not be refilled (' + str(error) + ')')
+            db.session.rollback()
+        finally:
+            db.session.remove()
+
+    # Refills the annotation queue with up to ANNOTATION_QUEUE_SIZE papers that are neither annotated nor leased. In the
+    # 'uncertainty' mode, the queue is replaced with the papers the classifier is most uncertain about, in the order of
+    # their uncertainty, so that the annotators get the most informative papers first. Since this classifies all papers
+    # that are not annotated, it is only done if fewer than ANNOTATION_QUEUE_LOW_WATER_MARK papers are left in the queue,
+    # the model changed since the queue was filled (annotation_queue_model) or force is True. In the 'random' mode,
+    # random papers are added until the queue is full. If another thread is already refilling the queue, nothing is
+    # done.
+    def refill_annotation_queue(self, force=False):
+        if not self.annotation_queue_lock.acquire(blocking=False):
+            return
+        try:
+            queue_size = server_app.config['ANNOTATION_QUEUE_SIZE']
+            leased_uid_query = AnnotationLease.get_leased_paper_uids_query(datetime.utcnow())
+            if server_app.config['ANNOTATION_QUEUE_MODE'] == ServerLogic.ANNOTATION_QUEUE_MODE_UNCERTAINTY:
+                queued_count = db.session.query(func.count(AnnotationQueueEntry.id)).scalar()
+                model_changed = OperationParameter.get('annotation_queue_model') != self.ml_tool.fingerprint
+                if not force and not model_changed \
+                        and queued_count >= server_app.config['ANNOTATION_QUEUE_LOW_WATER_MARK']:
+                    return
+                uid_list = self.get_most_uncertain_paper_uids(queue_size,
+                                                              {uid for uid, in leased_uid_query})
+                AnnotationQueueEntry.enqueue(uid_list, replace=True)
+                OperationParameter.set('annotation_queue_model', self.ml_tool.fingerprint)
+            else:
+                queued_uid_set = AnnotationQueueEntry.get_paper_uids()
+                missing_count = queue_size - len(queued_uid_set)
+                if missing_count <= 0:
+                    return
+                uid_list = [uid for uid, in db.session.query(Paper.uid)
+                            .filter(Paper.annotated == False,
+                                    Paper.uid.notin_(db.session.query(AnnotationQueueEntry.paper_uid)),
+                                    Paper.uid.notin_(leased_uid_query))
+                            .order_by(func.random())
+                            .limit(missing_count)]
+                AnnotationQueueEntry.enqueue(uid_list)
+            db.session.commit()
+            if is_debug():
+                print('Annotation queue refilled with ' + str(len(uid_list)) + ' papers')
+        finally:
+            self.annotation_queue_lock.release()
+
+    # Returns the uids of the amount papers that are not annotated and that the classifier is most uncertain about, the
+    # most uncertain paper first. The papers with the excluded uids (e.g. the leased papers) are left out. The papers are
+    # classified chunk by chunk, so that only the best candidates are kept in memory.
+    def get_most_uncertain_paper_uids(self, amount, excluded_uid_set=frozenset()):
+        ml_tool = self.ml_tool
+        candidate_uids = np.array([], dtype=object)
+        candidate_certainties = np.array([], dtype=float)
+        for row_list, data in self.iterate_unannotated_paper_chunks(server_app.config['ML_RECLASSIFY_CHUNK_SIZE']):
+            if self.feature_cache:
+                certainties = ml_tool.get_certainty_term_counts(data)
+            else:
+                certainties = ml_tool.get_certainty(data)
+            included = np.array([row[0] not in excluded_uid_set for row in row_list], dtype=bool)
+            candidate_uids = np.concatenate([candidate_uids,
+                                             np.array([row[0] for row in row_list], dtype=object)[included]])
+            candidate_certainties = np.concatenate([candidate_certainties, np.asarray(certainties)[included]])
+            if len(candidate_uids) > amount:
+                best_indices = np.argpartition(candidate_certainties, amount)[:amount]
+                candidate_uids = candidate_uids[best_indices]
+                candidate_certainties = candidate_certainties[best_indices]
+        order = np.argsort(candidate_certainties, kind='stable')
+        return candidate_uids[order].tolist()
+
+    # Creates a new machine learning tool with the settings of the config
+    @staticmethod
+    def create_ml_tool():
+        return MLTool(server_app.config['ML_FEATURE_MODE'],
+                      server_app.config['ML_HASHING_FEATURES'],
+                      server_app.config['ML_TFIDF'],
+                      server_app.config['ML_ONLINE_UPDATES'])
+
+    # Updates the machine learning tool with an annotated paper (only in the online mode). The annotations are collected
+    # and the classifier is updated with every ML_UPDATE_BATCH_SIZE annotations.
+    #
+    # NOTE: Only the model of this process is updated and the updated model is not saved. With several server processes,
+    # every process only learns from the annotations it received, and all updates are lost at a restart, when the saved
+    # model is loaded again. The annotations themselves are stored, so the next training includes them.
+    def update_ml_tool(self, paper):
+        if not self.ml_tool.online:
+            return
+        with self.annotation_buffer_lock:
+            self.annotation_buffer.append((self.get_classification_data(paper.title, paper.description),
+                                           paper.sustainable))
+            if len(self.annotation_buffer) < server_app.config['ML_UPDATE_BATCH_SIZE']:
+                return
+            annotation_list = self.annotation_buffer
+            self.annotation_buffer = []
+        self.ml_tool.update_classifier(pd.Series([data for data, label in annotation_list]),
+                                       pd.Series([label for data, label in annotation_list]))
+        if is_debug():
+            print('Machine learning tool updated with ' + str(len(annotation_list)) + ' annotations')
 
     # Trains the machine learning tool with all annotated papers
     def train_ml_tool(self):
 
-        # Get the relevant papers needed for the training
-        training_data_set = pd.read_sql_query(db.session.query(Paper).filter(Paper.annotated == True).statement,
-                                              db.session.bind)
-
-        # Prepare the data that is needed for the training
-        training_data = self.prepare_data(training_data_set)
-        labels = training_data_set.sustainable
-
-        # Train the classifier
-        self.ml_tool.train_classifier(training_data, labels)
+        # Get the data and labels of the annotated papers, then train the classifier
+        training_data, labels = self.get_training_data()
+        if sp.issparse(training_data):
+            self.ml_tool.train_classifier_with_term_counts(training_data, labels)
+        else:
+            self.ml_tool.train_classifier(training_data, labels)
+
+    # Returns the data and the labels of all annotated papers. If there is a feature cache, the data is a sparse matrix
+    # of term counts, otherwise a Series of texts. Only the columns that are needed for the training are read.
+    def get_training_data(self):
+        if self.feature_cache:
+            row_list = db.session.query(Paper.uid, Paper.digest, Paper.sustainable)\
+                .filter(Paper.annotated == True)\
+                .all()
+            training_data = self.get_cached_term_counts([uid for uid, digest, sustainable in row_list],
+                                                        [digest for uid, digest, sustainable in row_list])
+            labels = pd.Series([bool(sustainable) for uid, digest, sustainable in row_list])
+            return training_data, labels
+
+        row_list = db.session.query(Paper.title, Paper.description, Paper.sustainable)\
+            .filter(Paper.annotated == True)\
+            .all()
+        training_data = pd.Series([self.get_classification_data(title, description)
+                                   for title, description, sustainable in row_list])
+        labels = pd.Series([bool(sustainable) for title, description, sustainable in row_list])
+        return training_data, labels
+
+    # Trains the machine learning tool with all annotated papers and saves it together with the fingerprint of the
+    # annotations. The fingerprint is computed before the training, so that it never contains annotations that were
+    # made during the training.
+    def train_and_save_ml_tool(self):
+        fingerprint = self.get_ml_tool_fingerprint(self.ml_tool)
+        self.train_ml_tool()
+        self.save_ml_tool(fingerprint)
 
-    # This method takes a DataFrame as input and returns a Series with the prepared data
+    # Returns the fingerprint of the training data of a machine learning tool. The fingerprint is a digest of the
+    # parameters of the tool and of the uid, label and metadata digest of every annotated paper.
+    @staticmethod
+    def get_ml_tool_fingerprint(ml_tool):
+        fingerprint = hashlib.sha1(json.dumps(ml_tool.get_parameters(), sort_keys=True).encode('utf-8'))
+        annotation_query = db.session.query(Paper.uid, Paper.sustainable, Paper.digest)\
+            .filter(Paper.annotated == True)\
+            .order_by(Paper.uid)
+        for uid, sustainable, digest in annotation_query:
+            fingerprint.update((uid + '\t' + str(bool(sustainable)) + '\t' + str(digest) + '\n').encode('utf-8'))
+        return fingerprint.hexdigest()
+
+    # Returns the path of the artifact of a machine learning tool with the given fingerprint
     @staticmethod
-    def prepare_data(dataframe: pd.DataFrame):
-        dataframe['title'].fillna('', inplace=True)
-        dataframe['description'].fillna('', inplace=True)
-        dataframe['data'] = dataframe["title"] + " | " + dataframe["description"]
-        return dataframe.data
+    def get_ml_tool_artifact_path(fingerprint):
+        return os.path.join(server_app.config['ML_MODEL_PATH'],
+                            'model-v' + str(MLTool.ARTIFACT_VERSION) + '-' + fingerprint + '.joblib')
+
+    # Loads the saved machine learning tool that was trained with the current annotations. If the tool in use was
+    # restored by a rollback (ml_model_pinned), it is loaded instead, even if annotations were made since it was trained,
+    # so that the rollback also holds after a restart. Returns None if there is no such tool, so that a new one is
+    # trained.
+    def load_ml_tool(self):
+        ml_tool = None
+        if OperationParameter.get('ml_model_pinned'):
+            ml_tool = self.load_ml_tool_artifact(OperationParameter.get('ml_model_fingerprint'))
+        if not ml_tool:
+            ml_tool = self.load_ml_tool_artifact(self.get_ml_tool_fingerprint(self.create_ml_tool()))
+        if ml_tool:
+            print('Machine learning tool loaded')
+        return ml_tool
+
+    # Loads the saved machine learning tool with the given fingerprint. Returns None if models are not saved, there is
+    # no such artifact or it was created with other settings than the ones of the config.
+    def load_ml_tool_artifact(self, fingerprint):
+        if not server_app.config['ML_MODEL_PATH'] or not fingerprint:
+            return None
+        path = self.get_ml_tool_artifact_path(fingerprint)
+        if not os.path.exists(path):
+            return None
+        try:
+            ml_tool = MLTool.load(path)
+        except Exception as error:
+            print('Saved machine learning tool could not be loaded (' + str(error) + ')')
+            return None
+        if ml_tool.get_parameters() != self.create_ml_tool().get_parameters():
+            return None
+        return ml_tool
+
+    # Saves the machine learning tool with the given fingerprint and records it as the tool in use
+    def save_ml_tool(self, fingerprint):
+        model_path = server_app.config['ML_MODEL_PATH']
+        if not model_path:
+            return
+        os.makedirs(model_path, exist_ok=True)
+        path = self.get_ml_tool_artifact_path(fingerprint)
+        self.ml_tool.save(path, fingerprint)
+        self.store_ml_tool_fingerprints()
+        if is_debug():
+            print('Machine learning tool saved to ' + path)
+
+    # Records the fingerprints of the current and the previous machine learning tool and whether the current one is
+    # pinned (restored by a rollback, see load_ml_tool), and removes the artifacts of all other tools
+    def store_ml_tool_fingerprints(self, pinned=False):
+        fingerprint_list = [self.ml_tool.fingerprint,
+                            self.previous_ml_tool.fingerprint if self.previous_ml_tool else None]
+        OperationParameter.set('ml_model_fingerprint', fingerprint_list[0])
+        OperationParameter.set('ml_previous_model_fingerprint', fingerprint_list[1])
+        OperationParameter.set('ml_model_pinned', pinned)
+        db.session.commit()
+        if server_app.config['ML_MODEL_PATH']:
+            self.remove_ml_tool_artifacts([self.get_ml_tool_artifact_path(fingerprint)
+                                           for fingerprint in fingerprint_list if fingerprint])
 
-    # Creates a new model based on all currently annotated papers and classifies all the papers again.
+    # Removes the artifacts of all machine learning tools except the ones at the given paths
+    @staticmethod
+    def remove_ml_tool_artifacts(path_list):
+        model_path = server_app.config['ML_MODEL_PATH']
+        for file_name in os.listdir(model_path):
+            file_path = os.path.join(model_path, file_name)
+            if file_name.startswith('model-') and file_name.endswith('.joblib') and file_path not in path_list:
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+
+    # Creates a new model based on all currently annotated papers and classifies all the papers again. This happens in
+    # the background (see start_model_job). Returns False if a model job is already running.
     def create_new_model(self):
+        return self.start_model_job(train=True)
+
+    # Restores the previous model and classifies all the papers again in the background. Returns False if there is no
+    # previous model or a model job is already running.
+    def rollback_model(self):
+        if not self.previous_ml_tool:
+            return False
+        return self.start_model_job(train=False)
+
+    # Starts the model job in a background thread. If train is True, a new model is trained and replaces the current
+    # one. Otherwise the previous model replaces the current one. Afterwards, all papers are classified again with the
+    # new model. Returns False if a model job is already running.
+    def start_model_job(self, train):
+        with self.model_status_lock:
+            if self.model_status['state'] in [ServerLogic.MODEL_STATE_TRAINING, ServerLogic.MODEL_STATE_CLASSIFYING]:
+                return False
+            self.model_status = {'state': ServerLogic.MODEL_STATE_TRAINING if train else ServerLogic.MODEL_STATE_CLASSIFYING,
+                                 'progress': 0.0, 'started': datetime.utcnow(), 'finished': None, 'error': None}
+        Thread(target=self.run_model_job, args=[train], daemon=True).start()
+        return True
+
+    # Runs the model job (see start_model_job). The new model is trained in a separate process, so that neither the
+    # server nor the ZORA pull are slowed down by the training. The current model is used until the new one is ready
+    # and then replaced with a single assignment, so nobody ever sees a model that is not completely trained.
+    def run_model_job(self, train):
+        try:
+            if train:
+                new_ml_tool = self.train_ml_tool_in_background()
+
+                # The buffered annotations are part of the training, or will be part of the next one
+                with self.annotation_buffer_lock:
+                    self.annotation_buffer = []
+                self.previous_ml_tool, self.ml_tool = self.ml_tool, new_ml_tool
+            else:
+                self.ml_tool, self.previous_ml_tool = self.previous_ml_tool, self.ml_tool
+            self.store_ml_tool_fingerprints(pinned=not train)
+            print('Machine learning tool replaced')
+
+            # Classify all papers again with the new model
+            progress_start = 0.5 if train else 0.0
+            self.set_model_status(state=ServerLogic.MODEL_STATE_CLASSIFYING, progress=progress_start)
+            paper_count = db.session.query(func.count(Paper.uid)).filter(Paper.annotated == False).scalar()
+
+            def report_progress(count):
+                self.set_model_status(progress=progress_start + (1 - progress_start) * count / max(paper_count, 1))
+            self.reclassify_papers(report_progress)
+            self.set_model_status(state=ServerLogic.MODEL_STATE_FINISHED, progress=1.0, finished=datetime.utcnow())
+
+            # The uncertainty of the papers changed with the model
+            self.refill_annotation_queue(force=True)
+        except Exception as error:
+            print('Model job failed (' + str(error) + ')')
+            db.session.rollback()
+            self.set_model_status(state=ServerLogic.MODEL_STATE_FAILED, finished=datetime.utcnow(), error=str(error))
+        finally:
+            db.session.remove()
+
+    # Trains a new machine learning tool with all annotated papers in a separate process and returns it. If models are
+    # saved, the process saves the new model and it is loaded from the artifact (memory-mapped), otherwise the model is
+    # sent back from the process.
+    def train_ml_tool_in_background(self):
+        parameters = self.ml_tool.get_parameters()
+        fingerprint = self.get_ml_tool_fingerprint(self.ml_tool)
+        training_data, labels = self.get_training_data()
+        path = None
+        if server_app.config['ML_MODEL_PATH']:
+            os.makedirs(server_app.config['ML_MODEL_PATH'], exist_ok=True)
+            path = self.get_ml_tool_artifact_path(fingerprint)
+
+        # NOTE: The process is spawned instead of forked, since a forked process would inherit the threads of the server
+        # (e.g. of the scheduler) and its database connections in whatever state they are, including held locks. The
+        # spawned process imports greenzora without starting a server (see greenzora/__init__.py).
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            new_ml_tool = executor.submit(train_ml_tool, parameters, training_data if sp.issparse(training_data) else training_data.tolist(),
+                                          labels.tolist(), path,
+                                          fingerprint).result()
+        if path:
+            new_ml_tool = MLTool.load(path)
+        return new_ml_tool
+
+    # Updates the given fields of the model status
+    def set_model_status(self, **fields):
+        with self.model_status_lock:
+            self.model_status = {**self.model_status, **fields}
+
+    # Returns the status of the model job and of the current model as a dictionary that can be sent as JSON
+    def get_model_status(self):
+        with self.model_status_lock:
+            model_status = dict(self.model_status)
+        for field in ['started', 'finished']:
+            model_status[field] = model_status[field].isoformat() if model_status[field] else None
+        model_status['fingerprint'] = self.ml_tool.fingerprint
+        model_status['rollback_available'] = self.previous_ml_tool is not None
+        return model_status
+
+    # Classifies all papers that are not annotated again. If a progress callback is given, it is called with the amount
+    # of classified papers after every chunk. The papers are read in chunks of ML_RECLASSIFY_CHUNK_SIZE papers (see
+    # iterate_unannotated_paper_chunks), so that the memory usage does not depend on the amount of papers. Every chunk is
+    # classified at once and the changed labels are written with bulk updates.
+    #
+    # If ML_CLASSIFY_WORKERS is greater than 0, every chunk is split into batches of ML_CLASSIFY_BATCH_SIZE papers that
+    # are classified in parallel by a pool of worker processes. All chunks are classified with the machine learning tool
+    # that is current when the classification starts.
+    def reclassify_papers(self, progress_callback=None):
+        chunk_size = server_app.config['ML_RECLASSIFY_CHUNK_SIZE']
+        classify_workers = server_app.config['ML_CLASSIFY_WORKERS']
+        ml_tool = self.ml_tool
+        classifier_pool = ml_tool.create_classifier_pool(classify_workers) if classify_workers > 0 else None
+        try:
+            self.reclassify_paper_chunks(ml_tool, classifier_pool, chunk_size, progress_callback)
+        finally:
+            if classifier_pool:
+                classifier_pool.terminate()
+
+    # Classifies all papers that are not annotated again chunk by chunk (see reclassify_papers)
+    def reclassify_paper_chunks(self, ml_tool, classifier_pool, chunk_size, progress_callback):
+        count = 0
+        changed_count = 0
+        print('Classifying papers...')
+        for row_list, data in self.iterate_unannotated_paper_chunks(chunk_size):
+            if classifier_pool:
+                labels = ml_tool.classify_in_pool(classifier_pool, data, server_app.config['ML_CLASSIFY_BATCH_SIZE'])
+            elif self.feature_cache:
+                labels = ml_tool.classify_term_counts(data)
+            else:
+                labels = ml_tool.classify(data)
+
+            # Only the papers whose label changed are updated
+            changed_uid_lists = {True: [], False: []}
+            for (uid, sustainable, *columns), label in zip(row_list, labels):
+                if sustainable is None or bool(sustainable) != bool(label):
+                    changed_uid_lists[bool(label)].append(uid)
+            for label, uid_list in changed_uid_lists.items():
+                Paper.bulk_set_sustainable(uid_list, label)
+            db.session.commit()
 
-        # Reset the machine learning model
-        self.ml_tool = MLTool()
+            count += len(row_list)
+            changed_count += len(changed_uid_lists[True]) + len(changed_uid_lists[False])
+            if progress_callback:
+                progress_callback(count)
+            if is_debug():
+                print('Count: ' + str(count))
+        print(str(count) + ' papers classified, ' + str(changed_count) + ' labels changed')
+        print('Done')
 
-        self.train_ml_tool()
+    # Yields the papers that are not annotated in chunks of chunk_size papers ordered by uid. For every chunk, the rows
+    # (uid, current label, ...) and the data for the machine learning tool are yielded. The data is a sparse matrix of
+    # term counts if there is a feature cache, otherwise a Series of texts. Only the uid, the current label and the
+    # digest (with a feature cache) or the title and description (without) are read.
+    def iterate_unannotated_paper_chunks(self, chunk_size):
+        last_uid = None
+        while True:
+
+            # If there is a feature cache, the texts are only needed for the papers that are not in the cache
+            if self.feature_cache:
+                query = db.session.query(Paper.uid, Paper.sustainable, Paper.digest)
+            else:
+                query = db.session.query(Paper.uid, Paper.sustainable, Paper.title, Paper.description)
+            query = query.filter(Paper.annotated == False)
+            if last_uid is not None:
+                query = query.filter(Paper.uid > last_uid)
+            row_list = query.order_by(Paper.uid).limit(chunk_size).all()
+            if not row_list:
+                break
+            if self.feature_cache:
+                data = self.get_cached_term_counts([row[0] for row in row_list], [row[2] for row in row_list])
+            else:
+                data = pd.Series([self.get_classification_data(row[2], row[3]) for row in row_list])
+            yield row_list, data
+            last_uid = row_list[-1][0]
+
+    # Returns the term counts (see MLTool.get_term_counts) of the papers with the given uids and digests as a sparse
+    # matrix. The term counts are read from the feature cache. Papers that are not in the cache (or whose metadata
+    # changed) are vectorized and added to the cache.
+    def get_cached_term_counts(self, uid_list, digest_list):
+        found_position_list, cached_term_counts = self.feature_cache.get_rows(uid_list, digest_list)
+        found_position_set = set(found_position_list)
+        missing_position_list = [position for position in range(len(uid_list)) if position not in found_position_set]
+        if not missing_position_list:
+            return cached_term_counts
+        if is_debug():
+            print('Papers missing in the feature cache: ' + str(len(missing_position_list)))
 
-        # Prepare the data
-        data_set = pd.read_sql_query(db.session.query(Paper).filter(Paper.annotated == False).statement,
-                                     db.session.bind)
-        data = self.prepare_data(data_set)
-        data_set['label'] = self.ml_tool.classify(data)
+        missing_uid_list = [uid_list[position] for position in missing_position_list]
+        missing_term_counts = self.ml_tool.get_term_counts(self.get_classification_data_by_uids(missing_uid_list))
+        self.feature_cache.add_rows(missing_uid_list, [digest_list[position] for position in missing_position_list],
+                                    missing_term_counts)
 
-        # Update all classifications
-        for index, row in data_set.iterrows():
-            paper = db.session.query(Paper).get(row['uid'])
-            paper.sustainable = row['label']
-        db.session.commit()
+        # Put the rows back into the order of the uids
+        term_counts = sp.vstack([cached_term_counts, missing_term_counts], format='csr')
+        return term_counts[np.argsort(found_position_list + missing_position_list)]
+
+    # Returns the data (see get_classification_data) of the papers with the given uids as a Series in the same order
+    @staticmethod
+    def get_classification_data_by_uids(uid_list):
+        data_dict = {}
+        for uid_sublist in split_list(uid_list, MAX_SQL_VARIABLES):
+            for uid, title, description in db.session.query(Paper.uid, Paper.title, Paper.description)\
+                    .filter(Paper.uid.in_(uid_sublist)):
+                data_dict[uid] = ServerLogic.get_classification_data(title, description)
+        return pd.Series([data_dict.get(uid, '') for uid in uid_list])
+
+    # Returns the data of a paper that is used by the machine learning tool
+    @staticmethod
+    def get_classification_data(title, description):
+        return (title if title else '') + ' | ' + (description if description else '')
@@ -4,22 +4,31 @@ from flask import current_app
 from flask_login import current_user
 from functools import wraps
 
+# The maximum amount of values we put into a single SQL statement (e.g. an IN clause). SQLite only supports a limited
+# amount of variables per statement.
+MAX_SQL_VARIABLES = 500
+
 
 def is_debug():
     return server_app.config['DEBUG']
 
 
+# Splits a list into lists of at most size items
+def split_list(item_list, size):
+    return [item_list[index:index + size] for index in range(0, len(item_list), size)]
+
+
 # This function overwrites the login_required decorator of flask_login. It gives us the ability to distinguish between
 # normal users that can only annotate and admins that may change settings and create new users.
 def login_required(required_role='any'):
     def wrapper(fn):
         @wraps(fn)
         def inner_fn(*args, **kwargs):
-            if not current_user.is_authenticated():
+            if not current_user.is_authenticated:
                 return current_app.login_manager.unauthorized()
-            user_role = current_app.login_manager.reload_user().get_user_role()
+            user_role = current_user.get_user_role()
             if (required_role != 'any') and (user_role != required_role):
-                return current_app.login_manager.unauthorized
+                return current_app.login_manager.unauthorized()
             return fn(*args, **kwargs)
         return inner_fn
     return wrapper
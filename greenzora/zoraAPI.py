@@ -1,9 +1,15 @@
 import re
 
-from http.client import RemoteDisconnected
-from oaipmh.client import Client
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from multiprocessing.pool import AsyncResult
+from queue import Queue, Full
+from threading import Event
+from lxml import etree
+from oaipmh.client import Client, buildHeader
+from oaipmh.datestamp import datetime_to_datestamp
 from oaipmh.metadata import MetadataRegistry, oai_dc_reader
-from oaipmh.error import NoRecordsMatchError
+from oaipmh.error import IdDoesNotExistError, NoRecordsMatchError
 
 from greenzora import db
 from greenzora.models import Institute, ResourceType
@@ -14,15 +20,36 @@ from greenzora.utils import is_debug
 class ZoraAPI:
     METADATA_PREFIX = 'oai_dc'
 
-    # In the constructor, we register to the ZORA API and initialize the necessary class variables
-    def __init__(self, url):
-        registry = MetadataRegistry()
-        registry.registerReader(ZoraAPI.METADATA_PREFIX, oai_dc_reader)
-        self.client = Client(url, registry)
+    # If a subject starts with three digits and a space, we assume its a dewey decimal classification
+    DDC_REGEX = re.compile(r'^\d\d\d\s+\w')
+
+    # A partitioned harvest is either split by the resource type sets or by date windows (from/until)
+    PARTITION_MODE_SETS = 'sets'
+    PARTITION_MODE_DATES = 'dates'
+
+    # The amount of date windows per harvesting thread. Having more windows than threads evens out windows with many
+    # and windows with few records.
+    DATE_WINDOWS_PER_THREAD = 4
+
+    # In the constructor, we register to the ZORA API and initialize the necessary class variables. If a record archive
+    # is given (see RecordArchive), the raw XML of every harvested record is stored in it.
+    def __init__(self, url, archive=None):
+        self.url = url
+        self.archive = archive
+        self.registry = MetadataRegistry()
+        self.registry.registerReader(ZoraAPI.METADATA_PREFIX, oai_dc_reader)
+        self.client = self.create_client()
         self.institutes = {}
         self.resource_types = []
+        self.resource_type_set_specs = []
+        self.institute_names = set()
+        self.resource_type_names = set()
         self.load_institutes_and_types()
 
+    # Creates a new client for the ZORA API. Every thread of a partitioned harvest uses its own client.
+    def create_client(self):
+        return Client(self.url, self.registry)
+
     # Returns the hierarchical dictionary of institutes
     def get_institutes(self):
         return self.institutes
@@ -35,6 +62,7 @@ class ZoraAPI:
     def load_institutes_and_types(self):
         institutes_list = []
         resource_type_list = []
+        resource_type_set_spec_list = []
         for item in self.client.listSets():
             split = item[1].split(' = ')
             if len(split) != 2:
@@ -44,9 +72,17 @@ class ZoraAPI:
                 institutes_list.append(set_value)
             elif set_type == 'Type':
                 resource_type_list.append(set_value)
+                resource_type_set_spec_list.append(item[0])
         institutes_dict = self.parse_institutes(institutes_list)
         self.institutes = institutes_dict
         self.resource_types = resource_type_list
+        self.resource_type_set_specs = resource_type_set_spec_list
+
+    # Loads the names of all institutes and resource types that are stored in the database into sets. The sets are used
+    # to recognize institutes and resource types while parsing records, so that parsing does not need database queries.
+    def load_name_lookup(self):
+        self.institute_names = {name for name, in db.session.query(Institute.name)}
+        self.resource_type_names = {name for name, in db.session.query(ResourceType.name)}
 
     # Parses a list of institutes into a hierarchical dictionary
     @staticmethod
@@ -61,77 +97,358 @@ class ZoraAPI:
                 parent = parent[institute]
         return institutes_dict
 
-    # Get all metadata dictionaries from ZORA
-    def get_metadata_dicts(self, from_):
-        record_list = self.get_records(from_)
-        metadata_dict_list = self.parse_records(record_list)
-        return metadata_dict_list
-
     # Gets one specific paper from the ZORA repository and returns the record of it
     def get_record(self, uid):
         record = self.client.getRecord(identifier=uid, metadataPrefix=ZoraAPI.METADATA_PREFIX)
         return record
 
-    # Gets the papers from the ZORA repository and returns their records in form of a list
-    def get_records(self, from_):
-        args = {'metadataPrefix': ZoraAPI.METADATA_PREFIX}
+    # Gets one page of records from the ZORA repository. A page is either requested with the harvest arguments (from_,
+    # until and set_spec are optional) or with the resumption token of the previous page. Returns the records of the
+    # page and the resumption token of the next page, which is None if this was the last page. If no client is given,
+    # the client of the ZoraAPI is used.
+    #
+    # NOTE: We request the pages ourselves instead of using client.listRecords, because listRecords hides the
+    # resumption tokens and cannot be restarted with a token.
+    def get_record_page(self, from_, resumption_token=None, until=None, set_spec=None, client=None):
+        client = client if client else self.client
+        if resumption_token:
+            args = {'resumptionToken': resumption_token}
+        else:
+            args = {'metadataPrefix': ZoraAPI.METADATA_PREFIX}
+
+            # Add the from argument if it is defined (this is used to get only the most recent papers/changes)
+            if from_:
+                args['from'] = datetime_to_datestamp(from_)
+            if until:
+                args['until'] = datetime_to_datestamp(until)
+            if set_spec:
+                args['set'] = set_spec
+        tree = client.makeRequestErrorHandling(verb='ListRecords', **args)
+        record_list, next_resumption_token = client.buildRecords(ZoraAPI.METADATA_PREFIX,
+                                                                 client.getNamespaces(),
+                                                                 client.getMetadataRegistry(),
+                                                                 tree)
+        if self.archive:
+            self.archive.add_records([self.get_record_archive_entry(record) for record in record_list])
+        return record_list, next_resumption_token
 
-        # Add the from_ argument if it is defined (this is used to get only the most recent papers/changes)
-        if from_:
-            args['from_'] = from_
+    # Gets one page of record headers from the ZORA repository (ListIdentifiers) in the same way as get_record_page. The
+    # headers contain no metadata, so the pages are much smaller than the pages of records. Returns the headers of the
+    # page and the resumption token of the next page.
+    def get_header_page(self, from_, resumption_token=None, until=None, client=None):
+        client = client if client else self.client
+        if resumption_token:
+            args = {'resumptionToken': resumption_token}
+        else:
+            args = {'metadataPrefix': ZoraAPI.METADATA_PREFIX}
+            if from_:
+                args['from'] = datetime_to_datestamp(from_)
+            if until:
+                args['until'] = datetime_to_datestamp(until)
+        tree = client.makeRequestErrorHandling(verb='ListIdentifiers', **args)
+        return client.buildIdentifiers(client.getNamespaces(), tree)
 
-        # Get the relevant papers from ZORA and parse them
-        record_list = []
+    # Yields the records from the ZORA repository whose uids are not in the given set, page by page. Only the headers
+    # of all records are requested (see get_header_page), the missing records are requested one by one. Deleted records
+    # are skipped, since they have no metadata.
+    def iterate_missing_record_pages(self, from_, until, uid_set, client=None):
+        client = client if client else self.client
+        resumption_token = None
         try:
-            print('Loading records from ZORA API...')
-            record_iterator = self.client.listRecords(**args)
-            record_list = []
-            count = 0
-            for record in record_iterator:
-                record_list.append(record)
-                count += 1
-                if is_debug() and count % 1000 == 0:
-                    print(str(count))
-            print(count)
-            print('Done')
+            while True:
+                header_list, resumption_token = self.get_header_page(from_, resumption_token, until, client)
+                record_list = []
+                for header in header_list:
+                    if header.isDeleted() or header.identifier() in uid_set:
+                        continue
+                    try:
+                        record_list.append(client.getRecord(identifier=header.identifier(),
+                                                            metadataPrefix=ZoraAPI.METADATA_PREFIX))
+                    except IdDoesNotExistError:
+                        continue
+                if self.archive and record_list:
+                    self.archive.add_records([self.get_record_archive_entry(record) for record in record_list])
+                yield record_list
+                if not resumption_token:
+                    break
+        except NoRecordsMatchError:
+            pass
+
+    # Gets the papers from the ZORA repository page by page and yields the records of each page together with the
+    # resumption token of the next page. If a resumption token is given, the harvest continues at that page. The records
+    # are never collected in a list, so the memory usage does not depend on the size of the repository. Errors other
+    # than 'no records' are not caught, so that the caller notices an unfinished harvest.
+    def iterate_record_pages(self, from_, resumption_token=None, until=None, set_spec=None, client=None):
+        try:
+            while True:
+                record_list, resumption_token = self.get_record_page(from_, resumption_token, until, set_spec, client)
+                yield record_list, resumption_token
+                if not resumption_token:
+                    break
         except NoRecordsMatchError:
             print('No records were found')
-        except RemoteDisconnected as error:
-            print(error)
-        except Exception as error:
-            print(error)
+
+    # Gets the metadata dictionaries from ZORA in chunks (lists) of about chunk_size dictionaries. A chunk always
+    # consists of whole pages, so that it can be yielded together with the resumption token that continues the harvest
+    # after the chunk (None after the last chunk). Only one chunk is kept in memory at a time.
+    #
+    # If parse_workers is greater than 0, the records are parsed in a pool of worker processes. The workers parse a page
+    # while the next page is being downloaded.
+    def iterate_metadata_dict_chunks(self, from_, chunk_size, resumption_token=None, parse_workers=0):
+        parser_pool = self.create_parser_pool(parse_workers) if parse_workers > 0 else None
+        try:
+            metadata_dict_list = []
+            count = 0
+            pending_page = None
+            for record_list, next_resumption_token in self.iterate_record_pages(from_, resumption_token):
+                payload_list = [self.get_record_payload(record) for record in record_list]
+                if parser_pool:
+
+                    # Start parsing the current page, then finish the previous page
+                    chunk_size_per_worker = max(1, len(payload_list) // parse_workers)
+                    parse_result = parser_pool.map_async(parse_record_payload, payload_list, chunk_size_per_worker)
+                    current_page = (parse_result, len(record_list), next_resumption_token)
+                    if pending_page:
+                        metadata_dict_chunk = self.add_parsed_page(metadata_dict_list, pending_page, chunk_size)
+                        if metadata_dict_chunk:
+                            yield metadata_dict_chunk
+                            metadata_dict_list = []
+                    pending_page = current_page
+                else:
+                    parse_result = [self.parse_record_payload(payload, self.institute_names, self.resource_type_names)
+                                    for payload in payload_list]
+                    metadata_dict_chunk = self.add_parsed_page(metadata_dict_list,
+                                                               (parse_result, len(record_list), next_resumption_token),
+                                                               chunk_size)
+                    if metadata_dict_chunk:
+                        yield metadata_dict_chunk
+                        metadata_dict_list = []
+                count += len(record_list)
+                if is_debug():
+                    print('Records loaded: ' + str(count))
+
+            # Finish the last page that is still being parsed
+            if pending_page:
+                metadata_dict_chunk = self.add_parsed_page(metadata_dict_list, pending_page, chunk_size)
+                if metadata_dict_chunk:
+                    yield metadata_dict_chunk
         finally:
-            return record_list
-
-    # This method parses a list of records from ZORA in a easier to use metadata dictionary.
-    def parse_records(self, record_list):
-        metadata_dict_list = []
-        print('Parsing records...')
-        for record in record_list:
-            metadata_dict = self.parse_record(record)
-            if metadata_dict:
-                metadata_dict_list.append(metadata_dict)
-        print('Done')
-        return metadata_dict_list
-
-    # This function parses a record into a dictionary with a similar structure of the Paper database object.
+            if parser_pool:
+                parser_pool.terminate()
+
+    # Splits a harvest into partitions that can be harvested concurrently. A partition is a dictionary of the harvest
+    # arguments from_, until and set_spec. In the 'sets' mode, there is one partition per resource type set. Records
+    # without a resource type are not part of any set, they are fetched after the partitions (see
+    # iterate_partitioned_metadata_dict_chunks). In the 'dates' mode, the time between from_ (or the earliest datestamp of ZORA) and until is split into windows.
+    def get_partitions(self, partition_mode, from_, until, threads):
+        if partition_mode == ZoraAPI.PARTITION_MODE_SETS:
+            return [{'from_': from_, 'until': until, 'set_spec': set_spec} for set_spec in self.resource_type_set_specs]
+
+        start = from_ if from_ else self.client.identify().earliestDatestamp()
+        window_count = threads * ZoraAPI.DATE_WINDOWS_PER_THREAD
+        window_length = (until - start) / window_count
+        partitions = []
+        for index in range(window_count):
+
+            # The windows overlap by the granularity of the datestamps. The duplicates are removed during the harvest.
+            window_until = start + (index + 1) * window_length if index < window_count - 1 else until
+            partitions.append({'from_': start + index * window_length, 'until': window_until, 'set_spec': None})
+        return partitions
+
+    # Harvests the given partitions concurrently with a pool of threads and yields the metadata dictionaries in chunks of
+    # about chunk_size dictionaries (in the same form as iterate_metadata_dict_chunks, but without resumption tokens,
+    # since there is no single token that continues all partitions). The records are parsed in this thread or, if
+    # parse_workers is greater than 0, in a pool of worker processes.
+    #
+    # In the 'sets' mode, a record with more than one resource type is in more than one partition. The uids are
+    # remembered in that mode, so that such a record is only yielded once, and the records that were in no partition
+    # (the ones without a resource type) are fetched afterwards (see iterate_missing_record_pages). In the 'dates' mode, the windows only overlap
+    # at their borders, so the few duplicates are yielded again and skipped when they are stored (their digest did not
+    # change), and the memory usage does not depend on the size of the repository.
+    def iterate_partitioned_metadata_dict_chunks(self, partitions, chunk_size, threads, parse_workers=0):
+        page_queue = Queue(maxsize=threads * 2)
+        stop_event = Event()
+
+        # Puts an item into the page queue. Gives up if the harvest was stopped, so that no thread blocks forever.
+        def put_item(item):
+            while not stop_event.is_set():
+                try:
+                    page_queue.put(item, timeout=1)
+                    return
+                except Full:
+                    continue
+
+        # Harvests one partition and puts the payloads of its pages into the page queue. When the partition is done,
+        # None is put into the queue. If the harvest fails, the error is put into the queue instead.
+        def harvest_partition(partition):
+            try:
+                client = self.create_client()
+                record_pages = self.iterate_record_pages(partition['from_'], None, partition['until'],
+                                                         partition['set_spec'], client)
+                for record_list, next_resumption_token in record_pages:
+                    if stop_event.is_set():
+                        return
+                    put_item([self.get_record_payload(record) for record in record_list])
+                put_item(None)
+            except Exception as error:
+                put_item(error)
+
+        executor = ThreadPoolExecutor(max_workers=threads)
+        parser_pool = self.create_parser_pool(parse_workers) if parse_workers > 0 else None
+        try:
+            for partition in partitions:
+                executor.submit(harvest_partition, partition)
+
+            seen_uid_set = set() if any(partition['set_spec'] for partition in partitions) else None
+            metadata_dict_list = []
+            finished_partitions = 0
+            count = 0
+            while finished_partitions < len(partitions):
+                item = page_queue.get()
+                if item is None:
+                    finished_partitions += 1
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+
+                # Remove the records we already got from another set, then parse the rest
+                payload_list = item
+                if seen_uid_set is not None:
+                    payload_list = [payload for payload in item if payload[0] not in seen_uid_set]
+                    seen_uid_set.update(payload[0] for payload in payload_list)
+                metadata_dict_list.extend(self.parse_payloads(payload_list, parser_pool))
+                count += len(item)
+                if is_debug():
+                    print('Records loaded: ' + str(count))
+                if len(metadata_dict_list) >= chunk_size:
+                    yield metadata_dict_list, None
+                    metadata_dict_list = []
+
+            # Get the records that were in no set
+            if seen_uid_set is not None:
+                record_pages = self.iterate_missing_record_pages(partitions[0]['from_'], partitions[0]['until'],
+                                                                 seen_uid_set)
+                for record_list in record_pages:
+                    metadata_dict_list.extend(self.parse_payloads([self.get_record_payload(record)
+                                                                   for record in record_list], parser_pool))
+                    count += len(record_list)
+                    if is_debug():
+                        print('Records without a set loaded: ' + str(len(record_list)))
+                    if len(metadata_dict_list) >= chunk_size:
+                        yield metadata_dict_list, None
+                        metadata_dict_list = []
+            if metadata_dict_list:
+                yield metadata_dict_list, None
+        finally:
+            stop_event.set()
+            executor.shutdown(wait=False)
+            if parser_pool:
+                parser_pool.terminate()
+
+    # Parses the records in the record archive and yields their metadata dictionaries in chunks of about chunk_size
+    # dictionaries (in the same form as iterate_metadata_dict_chunks, but without resumption tokens). Only the latest
+    # version of every record is parsed. The records are parsed in this thread or, if parse_workers is greater than 0,
+    # in a pool of worker processes.
+    def iterate_archived_metadata_dict_chunks(self, chunk_size, use_mmap=False, parse_workers=0):
+        parser_pool = self.create_parser_pool(parse_workers) if parse_workers > 0 else None
+        try:
+            payload_list = []
+            count = 0
+            for uid, datestamp, xml in self.archive.iterate_records(use_mmap):
+                payload_list.append(self.get_archived_record_payload(xml))
+                if len(payload_list) >= chunk_size:
+                    count += len(payload_list)
+                    if is_debug():
+                        print('Archived records parsed: ' + str(count))
+                    yield self.parse_payloads(payload_list, parser_pool), None
+                    payload_list = []
+            if payload_list:
+                yield self.parse_payloads(payload_list, parser_pool), None
+        finally:
+            if parser_pool:
+                parser_pool.terminate()
+
+    # Parses a list of record payloads in this thread or, if a parser pool is given, in the parser pool and returns the
+    # metadata dictionaries
+    def parse_payloads(self, payload_list, parser_pool=None):
+        if parser_pool:
+            parse_result = parser_pool.map(parse_record_payload, payload_list)
+        else:
+            parse_result = [self.parse_record_payload(payload, self.institute_names, self.resource_type_names)
+                            for payload in payload_list]
+        return [metadata_dict for metadata_dict in parse_result if metadata_dict]
+
+    # Adds the metadata dictionaries of a parsed page (parse result, record count, resumption token) to the current
+    # chunk. If the chunk is complete (or it was the last page), the chunk and the resumption token of the next page
+    # are returned. Otherwise None is returned.
+    @staticmethod
+    def add_parsed_page(metadata_dict_list, parsed_page, chunk_size):
+        parse_result, record_count, next_resumption_token = parsed_page
+        if isinstance(parse_result, AsyncResult):
+            parse_result = parse_result.get()
+        metadata_dict_list.extend(metadata_dict for metadata_dict in parse_result if metadata_dict)
+        if len(metadata_dict_list) >= chunk_size or not next_resumption_token:
+            return metadata_dict_list, next_resumption_token
+        return None
+
+    # Creates a pool of processes that parse record payloads. Every worker gets a read-only snapshot of the institute
+    # and resource type names when it is started.
+    #
+    # NOTE: The workers are started with the default start method of multiprocessing. On platforms that spawn new
+    # processes instead of forking them (Windows), every worker imports greenzora again (without starting a server, see
+    # greenzora/__init__.py), which makes the start of the pool slow.
+    def create_parser_pool(self, parse_workers):
+        return Pool(processes=parse_workers,
+                    initializer=initialize_parser_worker,
+                    initargs=(frozenset(self.institute_names), frozenset(self.resource_type_names)))
+
+    # Returns the payload of a record, which is a tuple (uid, metadata map). The metadata map is a plain dictionary of
+    # lists, or None if the record has no metadata. In contrast to the record, the payload can be sent to other
+    # processes.
+    @staticmethod
+    def get_record_payload(record):
+        metadata_map = dict(record[1].getMap()) if record[1] else None
+        return record[0].identifier(), metadata_map
+
+    # Returns the entry of a record for the record archive, which is a tuple (uid, datestamp, xml). The xml is the
+    # complete <record> element of the OAI-PMH response.
+    @staticmethod
+    def get_record_archive_entry(record):
+        header = record[0]
+        return header.identifier(), datetime_to_datestamp(header.datestamp()), etree.tostring(header.element().getparent())
+
+    # Returns the payload (see get_record_payload) of a record that was stored in the record archive. The XML is read the
+    # same way the client of pyoai reads the records of an OAI-PMH response.
+    def get_archived_record_payload(self, xml):
+        record_node = etree.fromstring(xml)
+        namespaces = self.client.getNamespaces()
+        header = buildHeader(record_node.xpath('oai:header', namespaces=namespaces)[0], namespaces)
+        metadata_node_list = record_node.xpath('oai:metadata', namespaces=namespaces)
+        metadata = self.registry.readMetadata(ZoraAPI.METADATA_PREFIX, metadata_node_list[0]) if metadata_node_list else None
+        return self.get_record_payload((header, metadata, None))
+
+    # This function parses a record payload into a dictionary with a similar structure of the Paper database object.
     # To do so, it turns some unnecessary lists into single values and parses the 'subject' field into 'ddcs' (dewey
     # decimal classifications), 'keywords' and 'institutes'.
     #
     # NOTE: It is not possible to parse the 'subject' field properly since we lack the ability to distinguish between
     # keywords and institutes (some institutes contain commas --> they will get recognized as lists of keywords).
+    #
+    # The institute and resource type names are passed as sets (see load_name_lookup), so that no database queries are
+    # needed to parse a record.
     @staticmethod
-    def parse_record(record):
+    def parse_record_payload(payload, institute_names, resource_type_names):
+        uid, metadata_map = payload
         metadata_dict = {}
-        metadata_dict['uid'] = record[0].identifier()
+        metadata_dict['uid'] = uid
 
         # If there is no metadata, we assume that the paper has been deleted and store that information in the dict
-        if not record[1]:
+        if not metadata_map:
             metadata_dict['deleted'] = True
             return metadata_dict
 
         # If there is metadata available, we parse it into a convenient form
-        metadata_dict = {**metadata_dict, **dict(record[1].getMap())}
+        metadata_dict = {**metadata_dict, **metadata_map}
 
         metadata_dict['title'] = metadata_dict['title'][0] if 'title' in metadata_dict and len(metadata_dict['title']) > 0 else None
         metadata_dict['creators'] = metadata_dict.pop('creator') if 'creator' in metadata_dict else []
@@ -150,12 +467,11 @@ class ZoraAPI:
             for item in metadata_dict['subject']:
 
                 # If subject starts with three digits and a space, we assume its a dewey decimal classification
-                regex = re.compile('^\d\d\d\s+\w')
-                if regex.match(item):
+                if ZoraAPI.DDC_REGEX.match(item):
                     ddc_list.append(item)
 
                 # If the subject has the same name as an institute, we assume it is an institute
-                elif db.session.query(Institute).filter(Institute.name == item).first():
+                elif item in institute_names:
                     institute_list.append(item)
 
                 # If it is none of the above, we assume that it is a comma-separated list of keywords
@@ -174,10 +490,31 @@ class ZoraAPI:
         type_list = metadata_dict.pop('type') if 'type' in metadata_dict else []
         resource_type_list = []
         for resource_type in type_list:
-            if db.session.query(ResourceType).filter(ResourceType.name == resource_type).first():
+            if resource_type in resource_type_names:
                 resource_type_list.append(resource_type)
         metadata_dict['resource_types'] = resource_type_list
         metadata_dict['language'] = metadata_dict['language'][0] if 'language' in metadata_dict and len(metadata_dict['language']) > 0 else None
         metadata_dict['relation'] = metadata_dict['relation'][0] if 'relation' in metadata_dict and len(metadata_dict['relation']) > 0 else None
 
         return metadata_dict
+
+
+# ------------ PARSER WORKERS ---------------
+
+# The snapshot of the institute and resource type names of a parser worker process
+worker_institute_names = frozenset()
+worker_resource_type_names = frozenset()
+
+
+# Initializes a parser worker process with the snapshot of the institute and resource type names
+def initialize_parser_worker(institute_names, resource_type_names):
+    global worker_institute_names, worker_resource_type_names
+    worker_institute_names = institute_names
+    worker_resource_type_names = resource_type_names
+
+
+# Parses a record payload in a parser worker process
+def parse_record_payload(payload):
+    return ZoraAPI.parse_record_payload(payload, worker_institute_names, worker_resource_type_names)
+
+# ------------ END PARSER WORKERS ---------------